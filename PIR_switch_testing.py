@@ -4,38 +4,21 @@ import pigpio
 import asyncio
 import sys
 
-import numpy as np
 import time
 
+from edge_rate import EdgeRateDetector
+
 
 class testClass:
 
     def switch_callback(self, gpio, level, tick):
         #print(gpio, level, tick, self.tally_count)
         self.tally_count += 1
-        self.tally.append(tick)
-
-        if len(self.tally) > 100:
-            time_of_interest = 5  # [s]
-
-            #print(self.tally)
-            _arr = np.asarray(self.tally)
-            # trim dictionary
-            #print(f'array is {_arr}')
-            #print(f'time window stars at {tick - time_of_interest*1e6}')
-
-            # indices to be trimmed
-            ind = np.where(_arr < (tick - time_of_interest*1e6))[0]
-
-            # so check if there is enough ticks to meet criteria to trigger switch
-            if (len(self.tally) - len(ind)):
-                print('TRIGGERED SWITCH')
-                self.tally = []
 
-            # trim the array of old values
-            if len(ind) > 100:
-                print(f'trimming tally from {len(self.tally)} to {len(self.tally[-len(ind):])}')
-                self.tally = self.tally[-len(ind):]
+        # O(1) sliding window count, no allocation in the callback thread
+        if self.tally.add(tick):
+            print('TRIGGERED SWITCH')
+            self.tally.reset()
 
     def __init__(self):
         print('Inside __init__')
@@ -54,7 +37,8 @@ class testClass:
 
         self.tally_count = 0
         self.tally_count0 = 0
-        self.tally = []
+        time_of_interest = 5  # [s]
+        self.tally = EdgeRateDetector(window=time_of_interest, threshold=100)
 
     def monitor_loop(self):
 
@@ -0,0 +1,93 @@
+import os
+import time
+
+import pigpio
+
+
+class RealClock:
+    """Wall clock time and condition waits for the real hardware"""
+
+    def time(self):
+        return time.perf_counter()
+
+    def wait_for(self, condition, predicate, timeout=None):
+        """condition.wait_for, the caller must hold condition"""
+        return condition.wait_for(predicate, timeout)
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class PigpioButton:
+    """The gpiozero.Button interface Garbage uses, on a pigpio callback.
+    Works over any pigpiod connection, local or remote, without gpiozero
+    opening a connection of its own."""
+
+    def __init__(self, pi, pin, pull_up):
+        self.pi = pi
+        self.pin = pin
+        self.pull_up = pull_up
+        self.when_pressed = None
+        self.when_released = None
+        self.tick = None  # of the last edge, set before its callback runs
+        pi.set_mode(pin, pigpio.INPUT)
+        pi.set_pull_up_down(pin, pigpio.PUD_UP if pull_up else pigpio.PUD_DOWN)
+        self.callback = pi.callback(pin, pigpio.EITHER_EDGE, self._edge)
+
+    @property
+    def is_pressed(self):
+        return self.pi.read(self.pin) != self.pull_up
+
+    def _edge(self, gpio, level, tick):
+        if level not in (0, 1):
+            return  # watchdog timeout, not an edge
+        self.tick = tick
+        callback = self.when_pressed if level != self.pull_up else self.when_released
+        if callback is not None:
+            callback()
+
+    def rebind(self, pi):
+        """Set the pin and callback up again on a new connection"""
+        self.pi = pi
+        pi.set_mode(self.pin, pigpio.INPUT)
+        pi.set_pull_up_down(self.pin, pigpio.PUD_UP if self.pull_up else pigpio.PUD_DOWN)
+        self.callback = pi.callback(self.pin, pigpio.EITHER_EDGE, self._edge)
+
+    def close(self):
+        self.callback.cancel()
+
+
+class PigpioBackend:
+    """Hardware of a real Pi: a pigpiod connection and gpiozero buttons.
+
+    Garbage only talks to hardware through a backend, so a simulator with
+    the same attributes (pi, clock, button(), attach()) can stand in for it.
+    pigpio_buttons:  make buttons from pigpio callbacks instead of gpiozero
+    wave_registry:  registry of a pigpiod shared with other cans, Garbage
+        makes (and clears) its own if None
+    host, port:  of pigpiod, pigpio's defaults if None
+    """
+
+    def __init__(self, pi=None, pigpio_buttons=False, wave_registry=None, host=None, port=None):
+        self.host = host or os.getenv("PIGPIO_ADDR", "localhost")
+        self.port = int(port or os.getenv("PIGPIO_PORT", 8888))
+        # Connect to pigpiod daemon
+        self.pi = pigpio.pi(self.host, self.port) if pi is None else pi
+        self.clock = RealClock()
+        self.pigpio_buttons = pigpio_buttons
+        self.wave_registry = wave_registry
+
+    def button(self, pin, pull_up):
+        if self.pigpio_buttons:
+            return PigpioButton(self.pi, pin, pull_up)
+        from gpiozero import Button  # slow to import, and not needed with --fast-stop switches
+
+        return Button(pin, pull_up=pull_up)
+
+    def attach(self, garbage):
+        """Called once Garbage has finished setting up"""
+        pass
+
+    def connect(self):
+        """A new connection to pigpiod, check its connected attribute"""
+        return pigpio.pi(self.host, self.port, show_errors=False)
@@ -0,0 +1,248 @@
+from collections import deque
+import logging
+import math
+
+from position_estimator import chain_timeline
+
+logger = logging.getLogger(__name__)
+
+
+class Leg:
+    """Belt travel between two switch arrivals of one chain, planned and measured"""
+
+    def __init__(self, timeline, start, end, planned_mm, actual_mm):
+        self.timeline = timeline
+        self.start = start  # [s] after the chain started
+        self.end = end
+        self.planned_mm = planned_mm
+        self.actual_mm = actual_mm
+        self._peaks = None
+
+    @property
+    def lag(self):
+        """Fraction of the planned travel the belt fell short by"""
+        return (self.planned_mm - self.actual_mm) / self.planned_mm
+
+    def peaks(self, steps_per_mm):
+        """Highest planned speed [mm/s] and acceleration [mm/s2] within the leg"""
+        if self._peaks is None:
+            self._peaks = self._find_peaks(steps_per_mm)
+        return self._peaks
+
+    def _find_peaks(self, steps_per_mm):
+        timeline = self.timeline
+        first = timeline.level_at(self.start)
+        last = timeline.level_at(self.end)
+        speeds = [1 / (timeline.periods[i] * steps_per_mm) for i in range(first, last + 1)]
+        durations = [timeline.cum_time[i + 1] - timeline.cum_time[i] for i in range(first, last + 1)]
+        acceleration = 0.0
+        for i in range(1, len(speeds)):
+            # Between level midpoints, a looping level has no end to take half of
+            dt = 0.5 * (durations[i - 1] + min(durations[i], durations[i - 1]))
+            acceleration = max(acceleration, abs(speeds[i] - speeds[i - 1]) / dt)
+        return max(speeds), acceleration
+
+
+class BeltMonitor:
+    """Belt speed from the switch arrivals, against the plan of the running chain.
+
+    The chain's timeline says how far the belt should have gone at any
+    time, the switches say how far it has: the difference is steps lost
+    to slip or stalling. Every arrival sets a deadline for the next switch
+    ahead, the planned time plus some slack, so a stalled belt is noticed
+    within one leg.
+
+    When the belt keeps up, headroom() fits how the lag grows with the
+    legs' peak speed and acceleration, and extrapolates to where the
+    longest leg would come within a margin of a slip. Arrivals run in the
+    switch callbacks, so they only do arithmetic, the fit is left to the
+    caller.
+
+    switch_positions:  [mm] along the belt loop
+    slip_tolerance:  [mm] lag at a switch counted as a slip
+    stall_slack, stall_fraction:  a switch is overdue stall_slack seconds
+        or stall_fraction of the leg's planned time after it was due,
+        whichever is longer
+    """
+
+    def __init__(self, steps_per_mm, belt_length, switch_positions, slip_tolerance=3.0,
+                 stall_slack=0.25, stall_fraction=0.25, max_legs=500):
+        self.steps_per_mm = steps_per_mm
+        self.belt_length = belt_length
+        self.switch_positions = sorted(switch_positions)
+        self.slip_tolerance = slip_tolerance
+        self.stall_slack = stall_slack
+        self.stall_fraction = stall_fraction
+        self.stop_window = 0.05  # [s] after a stop an arrival still counts
+        self.legs = deque(maxlen=max_legs)
+
+        self.timeline = None  # of the running chain, None if not monitored
+        self.chain_start = None
+        self.chain_end = None  # [s] into the chain it was stopped at
+        self.start_mm = None
+        self.planned_offset = 0.0  # [mm] planned by chains spliced over before the running one
+        self.spliced = False  # the leg to the next arrival spans a splice
+        self.last = None  # (seconds into the chain, planned mm, actual mm) at the last arrival
+        self.deadline = None  # clock time the next switch is overdue
+        self.expected_mm = None
+        self.expected_at = None  # [mm] of travel since the chain started the next switch is at
+
+        self.slips = 0
+        self.stalls = 0
+        self.lags = []  # [mm] at each arrival, taken by the control loop
+
+    def start(self, chain, t, position_mm):
+        """A chain started at time t with the belt at position_mm, None if unknown"""
+        if position_mm is None:
+            self.stop()
+            return
+        self.timeline, _ = chain_timeline(chain)
+        self.chain_start = t
+        self.chain_end = None
+        self.start_mm = position_mm
+        self.planned_offset = 0.0
+        self.spliced = False
+        self.last = (0.0, 0.0, 0.0)
+        self._expect(position_mm, 0.0, 0.0)
+
+    def splice(self, chain, t, position_mm):
+        """The running chain was replaced by chain at time t without stopping.
+        The plan carries on from where the old chain had got to, and the
+        switch expected next stays the one it was, its deadline only comes
+        earlier if the new chain gets there sooner. Starts watching from
+        position_mm if the old chain wasn't watched."""
+        if self.timeline is None or self.chain_end is not None:
+            self.start(chain, t, position_mm)
+            return
+        elapsed = t - self.chain_start
+        self.planned_offset += self.timeline.steps_at(elapsed) / self.steps_per_mm
+        self.timeline, _ = chain_timeline(chain)
+        self.chain_start = t
+        start, planned, actual = self.last
+        self.last = (start - elapsed, planned, actual)
+        self.spliced = True
+        if self.deadline is not None:
+            deadline = self.deadline
+            self._arm(0.0)
+            if self.deadline is None or self.deadline > deadline:
+                self.deadline = deadline
+
+    def stop(self, t=None):
+        """The chain stopped at time t. A fast stop comes before the arrival
+        that caused it, so an arrival just after is still measured."""
+        self.deadline = None
+        if t is None or self.timeline is None:
+            self.timeline = None
+        else:
+            self.chain_end = t - self.chain_start
+
+    def arrived(self, position_mm, t):
+        """Belt reached the switch at position_mm at time t"""
+        timeline = self.timeline
+        if timeline is None:
+            return
+        elapsed = t - self.chain_start
+        if self.chain_end is not None:
+            self.timeline = None  # only the one arrival after a stop
+            if elapsed - self.chain_end > self.stop_window:
+                return  # pushed there by hand
+            elapsed = self.chain_end
+        planned = timeline.steps_at(elapsed) / self.steps_per_mm + self.planned_offset
+        actual = (position_mm - self.start_mm) % self.belt_length
+        start, planned_last, actual_last = self.last
+        if actual < actual_last:
+            actual += self.belt_length  # once round the loop
+        # A leg across a splice has no one timeline to find its peaks in
+        if actual - actual_last > self.slip_tolerance and not self.spliced:
+            self.legs.append(Leg(timeline, start, elapsed, planned - planned_last,
+                                 actual - actual_last))
+        self.last = (elapsed, planned, actual)
+        self.spliced = False
+        lag = planned - actual
+        self.lags.append(lag)
+        if abs(lag) > self.slip_tolerance:
+            self.slips += 1
+            logger.warning('Belt is %.1f mm behind the plan at the switch at %.0f mm',
+                           lag, position_mm)
+        if self.timeline is not None:
+            self._expect(position_mm, elapsed, actual)
+
+    def _expect(self, position_mm, elapsed, actual):
+        """Deadline for the next switch ahead of position_mm"""
+        gap = min((p - position_mm) % self.belt_length for p in self.switch_positions
+                  if (p - position_mm) % self.belt_length > self.slip_tolerance)
+        self.expected_mm = (position_mm + gap) % self.belt_length
+        self.expected_at = actual + gap
+        self._arm(elapsed)
+
+    def _arm(self, elapsed):
+        """Deadline for the belt to travel expected_at, timed from elapsed
+        seconds into the running chain"""
+        due = self.timeline.time_at((self.expected_at - self.planned_offset) * self.steps_per_mm)
+        if math.isinf(due):
+            self.deadline = None  # the chain ends first
+            return
+        slack = max(self.stall_slack, self.stall_fraction * (due - elapsed))
+        self.deadline = self.chain_start + max(due, elapsed) + slack
+
+    def overdue(self, t):
+        """True if the next switch should have been reached by time t"""
+        return self.deadline is not None and t >= self.deadline
+
+    def take_lags(self):
+        lags, self.lags = self.lags, []
+        return lags
+
+    def headroom(self, margin=0.75, max_step=0.25):
+        """Factors the highest speed and acceleration seen could be raised
+        by, each with the other kept, before the lag over the longest leg
+        is expected to reach margin times the slip tolerance. Below 1 if
+        they should come down. None if no legs were measured yet. At most
+        1 + max_step, beyond that the fit is extrapolating from too little
+        lag to trust. If the fit puts all the lag on one of the two, the
+        legs can't tell them apart, and both factors are the one to scale
+        speed and acceleration by together.
+        Returns (speed factor, acceleration factor, speed, acceleration).
+        """
+        if not self.legs:
+            return None
+        samples = [(leg.lag, *leg.peaks(self.steps_per_mm)) for leg in self.legs]
+        speed = max(v for _, v, _ in samples)
+        acceleration = max(a for _, _, a in samples)
+        limit = margin * self.slip_tolerance / max(leg.planned_mm for leg in self.legs)
+        k_speed, k_acceleration = fit_lag(samples)
+        cap = 1 + max_step
+        speed_factor = acceleration_factor = cap
+        if (k_speed > 0) != (k_acceleration > 0):
+            # Lag scales with both when both are scaled, however it splits
+            predicted = k_speed * speed + k_acceleration * acceleration
+            speed_factor = acceleration_factor = min(cap, limit / predicted)
+            return speed_factor, acceleration_factor, speed, acceleration
+        if k_speed > 0:
+            speed_factor = min(cap, max(0.0, limit - k_acceleration * acceleration) / (k_speed * speed))
+        if k_acceleration > 0:
+            acceleration_factor = min(cap, max(0.0, limit - k_speed * speed)
+                                      / (k_acceleration * acceleration))
+        return speed_factor, acceleration_factor, speed, acceleration
+
+
+def fit_lag(samples):
+    """Least squares lag = k_speed * speed + k_acceleration * acceleration
+    through the origin, neither coefficient negative.
+    samples:  (lag, speed, acceleration)
+    """
+    svv = sum(v * v for _, v, _ in samples)
+    saa = sum(a * a for _, _, a in samples)
+    sva = sum(v * a for _, v, a in samples)
+    slv = sum(lag * v for lag, v, _ in samples)
+    sla = sum(lag * a for lag, _, a in samples)
+    det = svv * saa - sva * sva
+    if det > 1e-12 * svv * saa:
+        k_speed = (slv * saa - sla * sva) / det
+        k_acceleration = (sla * svv - slv * sva) / det
+        if k_speed >= 0 and k_acceleration >= 0:
+            return k_speed, k_acceleration
+    # One of them alone explains it better, or they can't be told apart
+    fits = [(max(0.0, slv / svv) if svv else 0.0, 0.0),
+            (0.0, max(0.0, sla / saa) if saa else 0.0)]
+    return min(fits, key=lambda k: sum((lag - k[0] * v - k[1] * a) ** 2 for lag, v, a in samples))
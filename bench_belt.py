@@ -0,0 +1,121 @@
+"""Benchmark belt stall detection and the speed headroom estimate on the simulator.
+
+Stalls: the belt jams at points along the open and close moves while the
+chain keeps running. The belt monitor gives up once the next switch is
+overdue. Before, only the move's 30 s timeout caught it, timed here by
+running the same jams with the monitor's deadlines switched off.
+
+Headroom: the simulated belt creeps, losing a fraction of the steps that
+grows with speed and acceleration. After a run of cycles the monitor
+fits the lag and reports how far max_speed and acceleration could
+change. The cycles are then run again with the profiles' max_speed and
+acceleration both scaled by the smaller factor: the worst leg's lag
+should land near the margin, 0.75 of the 3 mm slip tolerance, with no
+slips. Without creep any slip or stall it reports is a false alarm.
+
+    python bench_belt.py [cycles]
+"""
+import logging
+import sys
+
+from garbage import Garbage, DEFAULT_GEOMETRY
+from belt_monitor import fit_lag
+from sim_backend import SimBackend
+
+PHASES = [0.1, 0.3, 0.5, 0.7, 0.9]  # fraction of the move the belt jams at
+MOVE = 1.733  # [s] of the open move, the close move is longer
+CREEP = [(0, 0), (1e-5, 0), (0, 1e-5), (2e-5, 5e-6), (3e-5, 1e-5), (6e-5, 0)]  # per mm/s, per mm/s2
+
+
+class ScaledGarbage(Garbage):
+    """Garbage with the foot switch profiles' max_speed and acceleration scaled"""
+
+    speed_factor = 1.0
+    acceleration_factor = 1.0
+
+    def plan_ramps(self):
+        for profile in self.profiles.values():
+            profile.max_speed *= self.speed_factor
+            profile.acceleration *= self.acceleration_factor
+        return super().plan_ramps()
+
+
+def make(creep_per_speed=0.0, creep_per_acceleration=0.0, speed_factor=1.0, acceleration_factor=1.0):
+    backend = SimBackend(start_mm=420, creep_per_speed=creep_per_speed,
+                         creep_per_acceleration=creep_per_acceleration)
+    ScaledGarbage.speed_factor = speed_factor
+    ScaledGarbage.acceleration_factor = acceleration_factor
+    # The simulated switches sit where the defaults say, so stalls stop the move
+    garbage = ScaledGarbage(backend=backend, profile_cache=None, journal_path=None,
+                            geometry=DEFAULT_GEOMETRY)
+    garbage.home()
+    garbage.run_once(timeout=0)
+    return backend, garbage
+
+
+def press(backend, garbage):
+    foot = garbage.switch_foot.pin
+    backend.press(foot)
+    backend.release(foot)
+
+
+def stall(phase, closing, monitored):
+    """Seconds from the jam until the move gives up"""
+    backend, garbage = make()
+    if closing:
+        press(backend, garbage)
+        garbage.run_once(timeout=0)
+    if not monitored:
+        garbage.belt._expect = lambda *args: None
+    press(backend, garbage)
+    jam_at = backend.clock.now + phase * MOVE
+    backend.schedule(phase * MOVE, backend.jam)
+    try:
+        garbage.run_once(timeout=0)
+    except (TimeoutError, SystemError):
+        return backend.clock.now - jam_at
+    return float("nan")
+
+
+def cycle(creep_per_speed, creep_per_acceleration, cycles, speed_factor=1.0, acceleration_factor=1.0):
+    """Belt monitor after the cycles, and the worst leg's lag [mm]"""
+    backend, garbage = make(creep_per_speed, creep_per_acceleration, speed_factor, acceleration_factor)
+    for _ in range(2 * cycles):
+        press(backend, garbage)
+        garbage.run_once(timeout=0)
+    belt = garbage.belt
+    return belt, max(leg.planned_mm - leg.actual_mm for leg in belt.legs)
+
+
+def main(cycles=40):
+    logging.getLogger().setLevel(logging.CRITICAL)
+    print("belt jams, jam to giving up [s of simulated time]")
+    print(f"  {'move':>5s}  {'jam at':>6s}  {'monitor':>7s}  {'before':>7s}")
+    detected = []
+    for closing in (False, True):
+        for phase in PHASES:
+            now = stall(phase, closing, True)
+            before = stall(phase, closing, False)
+            detected.append(now)
+            print(f"  {'close' if closing else 'open':>5s}  {phase:6.0%}  {now:7.3f}  {before:7.3f}")
+    print(f"  worst {max(detected):.3f} s")
+
+    print(f"creeping belt over {cycles} cycles, lags of the worst leg [mm]")
+    print(f"  {'creep per':>19s}  {'':>4s}  {'':>5s}  {'':>6s}  {'worst':>5s}  {'fitted per':>17s}  "
+          f"{'speed':>6s}  {'accel':>5s}  {'rerun at both':>16s}")
+    print(f"  {'mm/s':>8s}  {'mm/s2':>8s}  {'legs':>4s}  {'slips':>5s}  {'stalls':>6s}  {'lag':>5s}  "
+          f"{'mm/s':>8s} {'mm/s2':>8s}  {'factor':>6s}  {'factor':>5s}  {'worst lag':>9s}  {'slips':>5s}")
+    for creep_per_speed, creep_per_acceleration in CREEP:
+        belt, worst = cycle(creep_per_speed, creep_per_acceleration, cycles)
+        samples = [(leg.lag, *leg.peaks(belt.steps_per_mm)) for leg in belt.legs]
+        k_speed, k_acceleration = fit_lag(samples)
+        speed_factor, acceleration_factor, _, _ = belt.headroom()
+        factor = min(speed_factor, acceleration_factor)
+        rerun, rerun_worst = cycle(creep_per_speed, creep_per_acceleration, cycles, factor, factor)
+        print(f"  {creep_per_speed:8.0e}  {creep_per_acceleration:8.0e}  {len(belt.legs):4d}  {belt.slips:5d}  "
+              f"{belt.stalls:6d}  {worst:5.2f}  {k_speed:8.1e} {k_acceleration:8.1e}  {speed_factor:6.2f}  "
+              f"{acceleration_factor:5.2f}  {rerun_worst:9.2f}  {rerun.slips:5d}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 40)
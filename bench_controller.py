@@ -0,0 +1,193 @@
+"""Load test the multi-unit controller against stand-in pigpiod hosts.
+
+Every unit is a simulated can (sim_backend) with the foot switch pressed
+every few virtual seconds and the belt now and then pushed on by hand, so
+moves are planned from the estimate too. The controller runs all of them
+from one process for a fixed wall time. Several cans share each host: one pooled
+connection, one wave registry and one transmitter, so they queue on the
+connection's move lock. Besides move latency (press seen to move done)
+the lock wait and the registry's evictions are reported. One unit's
+pigpiod fails every few chains to show the fault stays in that unit.
+
+    python bench_controller.py [units] [seconds] [units per host]
+"""
+import asyncio
+import logging
+import sys
+import threading
+import time
+
+import numpy as np
+import pigpio
+
+from controller import Controller, ConnectionPool
+from sim_backend import SimBackend
+from wave_registry import DEFAULT_MAX_WAVES
+
+# Motor pins of each can on a host, the step pin keys its waves in the
+# shared registry. Switch pins are the same for all, each can's switches
+# are simulated on their own.
+MOTOR_PINS = [
+    {"step": 27, "direction": 22, "enable": 17},
+    {"step": 23, "direction": 25, "enable": 26},
+    {"step": 5, "direction": 6, "enable": 13},
+    {"step": 16, "direction": 19, "enable": 4},
+    {"step": 7, "direction": 8, "enable": 9},
+    {"step": 10, "direction": 11, "enable": 14},
+]
+
+
+class FlakyPi:
+    """Wraps a SimPi, every nth wave_chain fails like a lost pigpiod would"""
+
+    def __init__(self, pi, n):
+        self._pi = pi
+        self.n = n
+        self.chains = 0
+
+    def __getattr__(self, name):
+        return getattr(self._pi, name)
+
+    def wave_chain(self, data):
+        self.chains += 1
+        if self.chains % self.n == 0:
+            raise pigpio.error("'pigpiod went away'")
+        self._pi.wave_chain(data)
+
+
+class HostPi:
+    """One can's SimPi on a pigpiod shared with other cans: waves live in
+    the daemon's table, GPIO and playback stay with the can."""
+
+    WAVE_CALLS = {"wave_clear", "wave_add_generic", "wave_create", "wave_delete",
+                  "wave_get_max_cbs", "wave_get_max_pulses", "wave_get_cbs"}
+
+    def __init__(self, pi, daemon):
+        self._pi = pi
+        self.daemon = daemon
+
+    @property
+    def waves(self):
+        return self.daemon.waves
+
+    def __getattr__(self, name):
+        if name in self.WAVE_CALLS:
+            return getattr(self.daemon, name)
+        return getattr(self._pi, name)
+
+
+def press_every(backend, pin, period):
+    def press():
+        backend.press(pin)
+        backend.release(pin)
+        backend.schedule(period, press)
+    backend.schedule(period, press)
+
+
+def push_every(backend, period, rng):
+    def push():
+        backend.push(rng.uniform(20, 300))
+        backend.schedule(period, push)
+    backend.schedule(period, push)
+
+
+async def load_test(n_units, seconds, per_host=4, flaky_every=5):
+    if per_host > len(MOTOR_PINS):
+        raise ValueError(f"at most {len(MOTOR_PINS)} units per host")
+
+    def connect(host, port):
+        # The daemon only holds waves, each can plays its chains itself
+        return SimBackend().pi
+
+    def backend_factory(connection):
+        backend = SimBackend(start_mm=20)
+        backend.pi = HostPi(backend.pi, connection.pi)
+        if not controller.units:
+            backend.pi = FlakyPi(backend.pi, flaky_every)
+        backend.wave_registry = connection.wave_registry
+        return backend
+
+    controller = Controller(pool=ConnectionPool(connect), backend_factory=backend_factory,
+                            retry_delay=0.01)
+    latencies = []
+    rng = np.random.default_rng(1)
+    for i in range(n_units):
+        unit = controller.add_unit(f"can{i}", host=f"host{i // per_host}",
+                                   pins=MOTOR_PINS[i % per_host],
+                                   profile_cache=None, journal_path=None)
+        garbage = unit.garbage
+        press_every(garbage.backend, garbage.switch_foot.pin, 5.0)
+        push_every(garbage.backend, 17.0, rng)
+        time_moves(garbage, latencies)
+
+    registries = {unit.connection.host: unit.connection.wave_registry
+                  for unit in controller.units.values()}
+    misses = sum(registry.misses for registry in registries.values())
+    threads = threading.active_count()
+    start = time.perf_counter()
+    task = asyncio.ensure_future(controller.run())
+    await asyncio.sleep(seconds)
+    controller.stop()
+    await task
+    elapsed = time.perf_counter() - start
+    threads = threading.active_count() - threads
+
+    units = list(controller.units.values())
+    moves = [unit.moves for unit in units]
+    lock_wait = sum(unit.lock_wait for unit in units)
+    longest_wait = max(unit.longest_lock_wait for unit in units)
+    faults = {unit.name: unit.faults for unit in units if unit.faults}
+    evictions = {host: registry.evictions for host, registry in registries.items()}
+    waves = max(len(registry) for registry in registries.values())
+    created = sum(registry.misses for registry in registries.values()) - misses
+    controller.close()
+    return (elapsed, moves, latencies, lock_wait, longest_wait, evictions, waves, created,
+            faults, threads)
+
+
+def time_moves(garbage, latencies):
+    """Append the wall time from next_move returning a move to that move
+    being done, lock wait included, to latencies"""
+    next_move = garbage.next_move
+    move_to_target = garbage.move_to_target
+    seen = []
+
+    def timed_next_move(*args):
+        move = next_move(*args)
+        if move is not None:
+            seen[:] = [time.perf_counter()]
+        return move
+
+    def timed_move_to_target(*args):
+        move_to_target(*args)
+        latencies.append(time.perf_counter() - seen[0])
+
+    garbage.next_move = timed_next_move
+    garbage.move_to_target = timed_move_to_target
+
+
+def main(n_units=20, seconds=3.0, per_host=4):
+    logging.getLogger().setLevel(logging.CRITICAL)
+    (elapsed, moves, latencies, lock_wait, longest_wait, evictions, waves, created, faults,
+     threads) = asyncio.run(load_test(n_units, seconds, per_host))
+    hosts = len(evictions)
+    print(f"{n_units} units on {hosts} hosts in one process for {elapsed:.1f} s, "
+          f"{threads} worker threads")
+    print(f"  {sum(moves) / elapsed:8.0f} moves per second of wall time")
+    print(f"  moves per unit: min {min(moves)}, max {max(moves)}")
+    if latencies:
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1e3
+        print(f"  move latency: median {p50:.2f} ms, 99th percentile {p99:.2f} ms")
+    print(f"  move lock wait: {lock_wait / max(1, sum(moves)) * 1e3:.2f} ms per move, "
+          f"longest {longest_wait * 1e3:.2f} ms")
+    print(f"  wave registry: up to {waves} of {DEFAULT_MAX_WAVES} waves per host, {created} created "
+          f"and {sum(evictions.values())} evicted while running")
+    if any(evictions.values()):
+        print(f"  evictions by host: {evictions}")
+    print(f"  faults: {faults or 'none'}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20,
+         float(sys.argv[2]) if len(sys.argv) > 2 else 3.0,
+         int(sys.argv[3]) if len(sys.argv) > 3 else 4)
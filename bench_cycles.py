@@ -0,0 +1,44 @@
+"""Run open/close cycles on the simulated hardware backend.
+
+Reports the simulated cycle time of the lid and how many cycles per second
+of wall time the simulation gets through.
+
+    python bench_cycles.py [cycles]
+"""
+import logging
+import sys
+import time
+
+import numpy as np
+
+from garbage import Garbage
+from sim_backend import SimBackend
+
+
+def main(cycles=1000):
+    backend = SimBackend(start_mm=20)
+    garbage = Garbage(backend=backend, profile_cache=None, journal_path=None)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    garbage.home()
+    garbage.run_once(timeout=0)  # Settle onto a ready position
+
+    foot = garbage.switch_foot.pin
+    moves = np.zeros(cycles)
+    start = time.perf_counter()
+    for i in range(cycles):
+        t0 = backend.clock.time()
+        backend.press(foot)
+        backend.release(foot)
+        if not garbage.run_once(timeout=0):
+            raise RuntimeError(f"Foot press did not start a move on cycle {i} at {garbage.position}")
+        moves[i] = backend.clock.time() - t0
+    wall = time.perf_counter() - start
+
+    print(f"{cycles} moves, {cycles / wall:.0f} moves per second of wall time")
+    print(f"  simulated move time {moves.mean():.4f} s (min {moves.min():.4f}, max {moves.max():.4f})")
+    print(f"  open + close cycle  {2 * moves.mean():.4f} s")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
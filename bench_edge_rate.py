@@ -0,0 +1,66 @@
+"""Benchmark the PIR edge-rate window at high edge rates.
+
+Compares the old per-callback approach (append to a list, rebuild a NumPy
+array and np.where over it) with EdgeRateDetector, feeding both the same
+tick stream starting just before the 32 bit tick wraparound.
+
+    python bench_edge_rate.py [edges]
+"""
+import sys
+import time
+
+import numpy as np
+
+from edge_rate import EdgeRateDetector, TICK_MASK
+
+WINDOW = 5  # [s]
+THRESHOLD = 100
+
+
+class ListWindow:
+    """The window from PIR_switch_testing before EdgeRateDetector"""
+
+    def __init__(self):
+        self.tally = []
+
+    def add(self, tick):
+        self.tally.append(tick)
+        if len(self.tally) > THRESHOLD:
+            _arr = np.asarray(self.tally)
+            ind = np.where(_arr < (tick - WINDOW * 1e6))[0]
+            if len(ind):
+                self.tally = self.tally[len(ind):]
+        return len(self.tally) >= THRESHOLD
+
+
+def ticks(rate, edges):
+    # Start 1 s before the wrap so both sides of it are exercised
+    start = TICK_MASK - 1000000
+    return [(start + int(i * 1e6 / rate)) & TICK_MASK for i in range(edges)]
+
+
+def per_edge_us(window, stream):
+    start = time.perf_counter()
+    for tick in stream:
+        window.add(tick)
+    return (time.perf_counter() - start) / len(stream) * 1e6
+
+
+def main(edges=20000):
+    print(f"{'rate [Hz]':>10} {'list+np.where [us]':>20} {'ring [us]':>10}")
+    for rate in (100, 1000, 10000, 100000):
+        stream = ticks(rate, edges)
+        # The old window keeps every edge of the last 5 s, so it is capped to
+        # keep the run short at high rates
+        old = per_edge_us(ListWindow(), stream[:min(edges, 5000)])
+        new = per_edge_us(EdgeRateDetector(WINDOW, THRESHOLD), stream)
+        print(f"{rate:>10} {old:>20.2f} {new:>10.3f}")
+
+    # Wraparound check: 100 edges 10 ms apart straddling the wrap must fire
+    detector = EdgeRateDetector(WINDOW, THRESHOLD)
+    fired = [detector.add(tick) for tick in ticks(100, THRESHOLD)]
+    print(f"fires across tick wraparound: {fired[-1]}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
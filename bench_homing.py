@@ -0,0 +1,58 @@
+"""Benchmark restart-to-ready time of homing on the simulated hardware.
+
+Starts the lid at evenly spaced belt positions and homes it in each mode:
+- crawl:    the old homing, crawling until any switch
+- seek:     seek speed until any switch, no journal
+- journal:  plan from the journalled position to the next switch
+A lid resting on a switch is found by reading the switches and takes no
+homing at all. Times are virtual seconds from Garbage() to a known position.
+
+    python bench_homing.py [starts]
+"""
+import logging
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+from garbage import Garbage
+from position_journal import PositionJournal
+from sim_backend import SimBackend
+
+
+def home_time(start_mm, mode, journal_path):
+    if mode == "journal":
+        journal = PositionJournal(journal_path)
+        journal.record(None, start_mm)
+        journal.close()
+    backend = SimBackend(start_mm=start_mm)
+    garbage = Garbage(backend=backend, profile_cache=None,
+                      journal_path=journal_path if mode == "journal" else None)
+    if mode == "crawl":
+        garbage.seek_waveform = garbage.crawl_waveform
+    start = backend.clock.time()
+    garbage.home()
+    elapsed = backend.clock.time() - start
+    if garbage.journal is not None:
+        garbage.journal.close()
+    if os.path.exists(journal_path):
+        os.remove(journal_path)
+    return elapsed
+
+
+def main(starts=40):
+    logging.getLogger().setLevel(logging.WARNING)
+    with tempfile.TemporaryDirectory() as directory:
+        journal_path = os.path.join(directory, "position.journal")
+        positions = np.linspace(0, 780, starts, endpoint=False)
+        print(f"homing from {starts} belt positions [virtual s]")
+        for mode in ("crawl", "seek", "journal"):
+            times = np.array([home_time(mm, mode, journal_path) for mm in positions])
+            print(f"  {mode:8s} mean {times.mean():6.2f}   max {times.max():6.2f}   "
+                  f"on a switch {np.sum(times == 0)}")
+
+
+if __name__ == "__main__":
+    logging.disable(logging.INFO)
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 40)
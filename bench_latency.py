@@ -0,0 +1,112 @@
+"""Benchmark foot-press to wave_chain latency of the Garbage control loop.
+
+Runs off the Pi using gpiozero's mock pins and a pigpio stand-in that
+records when wave_chain is called.
+
+    python bench_latency.py [cycles]
+"""
+import logging
+import sys
+import threading
+import time
+
+import numpy as np
+from gpiozero import Device
+from gpiozero.pins.mock import MockFactory
+
+from backend import PigpioBackend
+from garbage import Garbage
+
+
+class RecordingPi:
+    """Just enough of pigpio.pi for Garbage, records wave_chain calls"""
+
+    def __init__(self):
+        self.chain_called = threading.Event()
+        self.chain_time = None
+        self.busy = 0
+        self.wave_count = 0
+
+    def set_mode(self, gpio, mode):
+        pass
+
+    def write(self, gpio, level):
+        pass
+
+    def wave_clear(self):
+        self.wave_count = 0
+
+    def wave_add_generic(self, pulses):
+        return len(pulses)
+
+    def wave_create(self):
+        self.wave_count += 1
+        return self.wave_count - 1
+
+    def wave_chain(self, data):
+        self.chain_time = time.perf_counter()
+        self.busy = 1
+        self.chain_called.set()
+
+    def wave_tx_busy(self):
+        return self.busy
+
+    def wave_tx_stop(self):
+        self.busy = 0
+
+    def wave_tx_at(self):
+        return 9999  # pigpio.NO_TX_WAVE
+
+    def set_PWM_dutycycle(self, gpio, dutycycle):
+        pass
+
+    def stop(self):
+        pass
+
+
+def main(cycles=200):
+    Device.pin_factory = MockFactory()
+    pi = RecordingPi()
+    garbage = Garbage(backend=PigpioBackend(pi=pi), profile_cache=None, journal_path=None)
+    # The switches are flipped far faster than the lid could, which the
+    # chatter detection rightly complains about
+    logging.getLogger().setLevel(logging.ERROR)
+
+    pins = {
+        "ReadyToClose": Device.pin_factory.pin(garbage.switch_idler_bottom.pin),
+        "ReadyToOpen": Device.pin_factory.pin(garbage.switch_motor_top.pin),
+    }
+    foot = Device.pin_factory.pin(garbage.switch_foot.pin)
+
+    # Start resting at ReadyToClose
+    pins["ReadyToClose"].drive_high()
+    threading.Thread(target=garbage.run, daemon=True).start()
+
+    latencies = np.zeros(cycles)
+    here, there = "ReadyToClose", "ReadyToOpen"
+    for i in range(cycles):
+        pi.chain_called.clear()
+        start = time.perf_counter()
+        foot.drive_low()
+        if not pi.chain_called.wait(1.0):
+            raise RuntimeError(f"No wave_chain after foot press on cycle {i}")
+        latencies[i] = pi.chain_time - start
+        foot.drive_high()
+
+        # Travel to the other ready position
+        pins[here].drive_low()
+        pins[there].drive_high()
+        while garbage.moving or garbage.target_position is not None:
+            time.sleep(0.0005)
+        here, there = there, here
+
+    garbage.state.stop()
+    latencies *= 1e6
+    print(f"foot press -> wave_chain over {cycles} cycles [us]")
+    print(f"  median {np.median(latencies):8.1f}")
+    print(f"  p99    {np.percentile(latencies, 99):8.1f}")
+    print(f"  max    {latencies.max():8.1f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
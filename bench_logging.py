@@ -0,0 +1,97 @@
+"""Benchmark switch callback latency with synchronous and queued logging.
+
+Runs open/close cycles on the simulated hardware and times every switch
+and foot callback in wall time. The log goes to a stand-in for the SD
+card that stalls for STALL seconds on every STALL_EVERY-th write, as
+cards do while they erase. Logging is at DEBUG as garbage.py sets it up,
+either straight to the card from the calling thread, or through
+LogPipeline which writes INFO and up and keeps DEBUG for errors.
+
+    python bench_logging.py [cycles]
+"""
+import logging
+import sys
+import time
+
+import numpy as np
+
+from garbage import Garbage
+from log_pipeline import LogPipeline, FORMAT, DATEFMT
+from sim_backend import SimBackend
+
+STALL = 0.02  # [s]
+STALL_EVERY = 200
+
+
+class StallingCard:
+    """Write sink that now and then blocks like an SD card"""
+
+    def __init__(self):
+        self.writes = 0
+        self.bytes = 0
+
+    def write(self, text):
+        self.writes += 1
+        self.bytes += len(text)
+        if self.writes % STALL_EVERY == 0:
+            time.sleep(STALL)
+
+    def flush(self):
+        pass
+
+
+def timed(function, latencies):
+    def call(*args, **kwargs):
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        latencies.append(time.perf_counter() - start)
+
+    return call
+
+
+def run(cycles, queued):
+    card = StallingCard()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    pipeline = None
+    if queued:
+        pipeline = LogPipeline(stream=card).install()
+    else:
+        handler = logging.StreamHandler(card)
+        handler.setFormatter(logging.Formatter(FORMAT, DATEFMT))
+        root.addHandler(handler)
+        root.setLevel(logging.DEBUG)
+
+    backend = SimBackend(start_mm=20)
+    garbage = Garbage(backend=backend, profile_cache=None, journal_path=None)
+    latencies = []
+    garbage.arrived = timed(garbage.arrived, latencies)
+    garbage.departed = timed(garbage.departed, latencies)
+    garbage.switch_foot.button.when_pressed = timed(garbage.switch_pressed_foot_callback, latencies)
+    garbage.home()
+    garbage.run_once(timeout=0)
+    foot = garbage.switch_foot.pin
+    for _ in range(cycles):
+        backend.press(foot)
+        backend.release(foot)
+        garbage.run_once(timeout=0)
+
+    if pipeline is not None:
+        logging.getLogger(__name__).error("Benchmark error, the DEBUG ring is dumped before this")
+        pipeline.close()
+    return np.array(latencies) * 1e6, card, pipeline
+
+
+def main(cycles=500):
+    print(f"switch callback time over {cycles} moves, card stalls {STALL * 1e3:.0f} ms "
+          f"every {STALL_EVERY} writes [us]")
+    for name, queued in (("synchronous", False), ("queued", True)):
+        latencies, card, pipeline = run(cycles, queued)
+        print(f"  {name:12s} median {np.median(latencies):7.1f}   p99 {np.percentile(latencies, 99):8.1f}   "
+              f"max {latencies.max():8.1f}   ({len(latencies)} callbacks, {card.writes} writes"
+              + (f", {pipeline.written} lines, {pipeline.dumps} dump)" if pipeline else ")"))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
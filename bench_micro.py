@@ -0,0 +1,312 @@
+"""Micro-benchmarks of planning, chain compilation and event dispatch.
+
+Each case is timed with timeit against a pigpio stand-in, the median of
+several repeats per call, and compared with the baselines stored next to
+this script. Exits with status 1 if any case got slower than its
+baseline by more than its limit, so performance work on the controller
+shows up as a number and regressions fail.
+
+Saving times every case in several separate runs of this script and
+stores each case's median and its noise, half the spread between the
+runs relative to the median. A case's limit is the threshold, or
+NOISE_BANDS times its noise if that is wider. Cases faster than
+MIN_COUNTED are reported but never fail the run, and a case over its
+limit is timed twice more before it counts.
+
+Baselines are only comparable on the machine they were saved on, save
+them again after moving (or after a deliberate slowdown):
+
+    python bench_micro.py [--save [--rounds 5]] [--threshold 0.25] [--only NAME]
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import timeit
+
+from backend import PigpioBackend
+from chain_compiler import compile_chain, compile_level
+from edge_rate import EdgeRateDetector, TICK_MASK
+from garbage import Garbage
+from PIR_switch_testing import testClass
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_micro_baselines.json")
+RAMP_LEVELS = [7, 35, 80]  # 80 looped levels are about as many as fit a 600 byte chain
+ENCODE_LEVELS = [7, 35, 80, 300, 1000]
+PIR_RATES = [100, 10000, 100000]  # [Hz] edges on the PIR pin
+NOISE_BANDS = 3  # a case's limit is at least this many times its noise
+MIN_COUNTED = 1e-6  # [s] per call, faster cases are too noisy to fail the run
+
+
+class StandInPi:
+    """Just enough of pigpio.pi for Garbage to start up and move"""
+
+    def __init__(self):
+        self.wave_count = 0
+
+    def set_mode(self, gpio, mode):
+        pass
+
+    def write(self, gpio, level):
+        pass
+
+    def set_pull_up_down(self, gpio, pud):
+        pass
+
+    def read(self, gpio):
+        return 0
+
+    def callback(self, gpio, edge, func):
+        return None
+
+    def get_current_tick(self):
+        return 0
+
+    def wave_clear(self):
+        self.wave_count = 0
+
+    def wave_add_generic(self, pulses):
+        return len(pulses)
+
+    def wave_create(self):
+        self.wave_count += 1
+        return self.wave_count - 1
+
+    def wave_delete(self, wid):
+        pass
+
+    def wave_chain(self, data):
+        pass
+
+    def wave_tx_stop(self):
+        pass
+
+    def wave_tx_busy(self):
+        return 0
+
+
+class StandInButton:
+    def __init__(self):
+        self.when_pressed = None
+        self.when_released = None
+        self.is_pressed = False
+
+
+def make_garbage():
+    backend = PigpioBackend(pi=StandInPi())
+    backend.button = lambda pin, pull_up: StandInButton()
+    return Garbage(backend=backend, profile_cache=None, journal_path=None)
+
+
+def ramp(levels):
+    """[Frequency, Steps] ramp from 1 kHz to 38 kHz, every level looped"""
+    return [[1000 + 37000 * i / (levels - 1), 2 + 5 * i] for i in range(levels)]
+
+
+def startup_cases():
+    garbage = make_garbage()
+
+    def chains():
+        # As Garbage.__init__ does, from an empty registry
+        garbage.wave_registry.clear()
+        for name in ("crawl", "seek", *(profile.name for profile in garbage.profiles.values())):
+            garbage.generate_ramp(ramps[name], loop_forever=True)
+
+    ramps = garbage.plan_ramps()
+    yield "startup: plan_ramps", garbage.plan_ramps
+    yield "startup: generate the chains", chains
+    yield "startup: Garbage()", make_garbage
+
+
+def generate_ramp_cases():
+    garbage = make_garbage()
+    registry = garbage.wave_registry
+    for levels in RAMP_LEVELS:
+        r = ramp(levels)
+
+        def cold(r=r):
+            registry.clear()
+            garbage.generate_ramp(r)
+
+        yield f"generate_ramp: {levels} levels, new waves", cold
+        garbage.generate_ramp(r)
+        yield f"generate_ramp: {levels} levels, cached waves", lambda r=r: garbage.generate_ramp(r)
+
+
+def encode_cases():
+    for levels in ENCODE_LEVELS:
+        chain_levels = [[i % 250, 2 + 5 * i] for i in range(levels)]
+        if levels <= RAMP_LEVELS[-1]:
+            yield f"encode: compile_chain {levels} levels", lambda l=chain_levels: compile_chain(l, True)
+        else:
+            # Longer than pigpiod takes, so only the encoding of the levels
+            yield (f"encode: compile_level x {levels}",
+                   lambda l=chain_levels: [compile_level(wid, steps) for wid, steps in l])
+
+
+def dispatch_cases():
+    garbage = make_garbage()
+    garbage.state.position = garbage.switch_idler_bottom.position_name
+
+    def idle_edges():
+        garbage.switch_released_idler_bottom_callback()
+        garbage.switch_pressed_idler_bottom_callback()
+
+    def fast_stop_edges():
+        t = garbage.pi.get_current_tick()
+        garbage.switch_edge_callback(garbage.switch_idler_bottom.pin, 0, t)
+        garbage.switch_edge_callback(garbage.switch_idler_bottom.pin, 1, t)
+
+    yield "dispatch: departed + arrived", idle_edges
+    yield "dispatch: switch_edge_callback x 2", fast_stop_edges
+
+
+def pir_cases():
+    for rate in PIR_RATES:
+        pir = testClass.__new__(testClass)  # without connecting to pigpiod
+        pir.tally_count = 0
+        pir.tally = EdgeRateDetector(window=5, threshold=100)
+        # 1000 edges, starting 1 ms before the tick wraps
+        ticks = [(TICK_MASK - 1000 + int(i * 1e6 / rate)) & TICK_MASK for i in range(1000)]
+
+        def edges(pir=pir, ticks=ticks):
+            callback = pir.switch_callback
+            for tick in ticks:
+                callback(27, 1, tick)
+
+        yield f"PIR switch_callback: 1000 edges at {rate} Hz", edges
+
+
+def time_case(func, repeat):
+    """Median seconds per call of func"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return statistics.median(timer.repeat(repeat, number)) / number
+
+
+def cases(only=None):
+    for group in (startup_cases, generate_ramp_cases, encode_cases, dispatch_cases, pir_cases):
+        for name, func in group():
+            if not only or only in name:
+                yield name, func
+
+
+def time_cases(selected, repeat):
+    """{name: seconds per call} of the selected cases"""
+    results = {}
+    # The PIR callback prints each trigger, keep it off the report
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for name, func in selected:
+            results[name] = time_case(func, repeat)
+    return results
+
+
+def save_rounds(args):
+    """Time every case in args.rounds runs of this script, in their own
+    processes, as memory layout and the like differ between runs.
+    Returns {name: {"median": seconds, "noise": fraction}}"""
+    command = [sys.executable, os.path.abspath(__file__), "--json", "--repeat", str(args.repeat)]
+    if args.only:
+        command += ["--only", args.only]
+    rounds = []
+    for i in range(args.rounds):
+        print(f"round {i + 1} of {args.rounds}", flush=True)
+        rounds.append(json.loads(subprocess.run(command, check=True, capture_output=True, text=True).stdout))
+    saved = {}
+    for name in rounds[0]:
+        times = [results[name] for results in rounds]
+        median = statistics.median(times)
+        saved[name] = {"median": median, "noise": (max(times) - min(times)) / (2 * median)}
+    return saved
+
+
+def limit(baseline, threshold):
+    """Fraction slower than the baseline a case may get"""
+    return max(threshold, NOISE_BANDS * baseline["noise"])
+
+
+def machine():
+    return f"{platform.machine()}, {os.cpu_count()} CPUs, Python {platform.python_version()}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--save", action="store_true", help="store the results as the new baselines")
+    parser.add_argument("--rounds", type=int, default=5,
+                        help="separate runs timed by --save, their spread is each case's noise")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="fail if a case is this fraction slower than its baseline, "
+                             "or more if its noise is wider")
+    parser.add_argument("--repeat", type=int, default=7, help="timing runs per case, the median is kept")
+    parser.add_argument("--only", metavar="NAME", help="only cases whose name contains NAME")
+    parser.add_argument("--baselines", default=BASELINE_PATH, metavar="PATH")
+    parser.add_argument("--json", action="store_true", help=argparse.SUPPRESS)  # one round of --save
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)  # chatter and pre-open warnings are not what's timed
+
+    if args.json:
+        json.dump(time_cases(cases(args.only), args.repeat), sys.stdout)
+        return 0
+
+    baselines = {}
+    saved_on = None
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as f:
+            stored = json.load(f)
+        # Baselines saved before noise was measured are a bare median
+        baselines = {name: baseline if isinstance(baseline, dict) else {"median": baseline, "noise": 0.0}
+                     for name, baseline in stored["cases"].items()}
+        saved_on = stored["machine"]
+    if saved_on is not None and saved_on != machine() and not args.save:
+        print(f"baselines were saved on {saved_on}, not comparable with {machine()}")
+
+    if args.save:
+        saved = save_rounds(args)
+        print(f"{'case':48s} {'us per call':>12s} {'noise':>8s}")
+        for name, baseline in saved.items():
+            print(f"{name:48s} {baseline['median'] * 1e6:12.2f} {baseline['noise']:8.1%}")
+        baselines.update(saved)
+        with open(args.baselines, "w") as f:
+            json.dump({"machine": machine(), "cases": baselines}, f, indent=1, sort_keys=True)
+            f.write("\n")
+        print(f"saved {len(saved)} baselines to {args.baselines}")
+        return 0
+
+    selected = dict(cases(args.only))
+    results = time_cases(selected.items(), args.repeat)
+    over = [name for name, seconds in results.items()
+            if name in baselines and seconds / baselines[name]["median"] - 1 > limit(baselines[name], args.threshold)]
+    if over:
+        # Time them twice more before calling it a regression, a busy
+        # machine slows a whole run of repeats
+        again = [time_cases([(name, selected[name]) for name in over], args.repeat) for _ in range(2)]
+        for name in over:
+            results[name] = statistics.median([results[name]] + [times[name] for times in again])
+
+    regressions = []
+    print(f"{'case':48s} {'us per call':>12s} {'baseline':>10s} {'change':>8s} {'limit':>7s}")
+    for name, seconds in results.items():
+        line = f"{name:48s} {seconds * 1e6:12.2f}"
+        baseline = baselines.get(name)
+        if baseline is not None:
+            change = seconds / baseline["median"] - 1
+            line += f" {baseline['median'] * 1e6:10.2f} {change:+8.1%} {limit(baseline, args.threshold):+7.0%}"
+            if baseline["median"] < MIN_COUNTED:
+                line += "  not counted, too fast to time reliably"
+            elif change > limit(baseline, args.threshold):
+                regressions.append(name)
+                line += "  REGRESSED"
+        print(line)
+    if regressions:
+        print(f"{len(regressions)} cases slower than their baselines by more than their limits")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
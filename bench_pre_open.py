@@ -0,0 +1,92 @@
+"""Benchmark the PIR pre-open on the simulated hardware.
+
+Visitors walk up every so often, setting the PIR off as they come. Most
+press the foot switch a second or few later and again to close once done,
+the rest walk past. Reports how long the users waited from their foot
+press to an open lid, with and without pre-opening, and how many of the
+pre-opens were used.
+
+    python bench_pre_open.py [visitors]
+"""
+import logging
+import random
+import sys
+
+import numpy as np
+
+from edge_rate import EdgeRateDetector
+from garbage import Garbage
+from sim_backend import SimBackend
+
+PIR_PIN = 5
+
+
+def run(visitors, pir, seed=1):
+    backend = SimBackend(start_mm=420)  # closed
+    garbage = Garbage(backend=backend, profile_cache=None, journal_path=None,
+                      pins={"pir": PIR_PIN} if pir else None)
+    if pir:
+        garbage.pre_open.detector = EdgeRateDetector(window=0.5, threshold=10)
+    garbage.home()
+    garbage.run_once(timeout=0)
+    foot = garbage.switch_foot.pin
+    clock = backend.clock
+
+    waiting = []  # foot press times of users waiting for the lid to open
+    waits = []
+
+    def press_open():
+        if garbage.position == "ReadyToClose" and not garbage.moving:
+            waits.append(0.0)
+        else:
+            waiting.append(clock.time())
+        press_close()
+
+    def press_close():
+        backend.press(foot)
+        backend.release(foot)
+
+    arrived = garbage.arrived
+
+    def arrived_and_served(data, tick=None):
+        arrived(data, tick)
+        if data.position_name == "ReadyToClose":
+            waits.extend(clock.time() - t for t in waiting)
+            waiting.clear()
+
+    garbage.arrived = arrived_and_served
+
+    rng = random.Random(seed)
+    t = 1.0
+    users = 0
+    for _ in range(visitors):
+        for i in range(50):  # PIR pulses for a second as they come
+            backend.schedule(t + 0.02 * i, lambda i=i: backend.set_switch(PIR_PIN, i % 2 == 0))
+        if rng.random() < 0.7:
+            users += 1
+            approach = rng.uniform(1.0, 4.0)
+            backend.schedule(t + approach, press_open)
+            backend.schedule(t + approach + rng.uniform(4.0, 8.0), press_close)
+        t += rng.uniform(15.0, 40.0)
+
+    while clock.time() < t:
+        garbage.run_once(timeout=1.0)
+    return np.array(waits), users, garbage.pre_open
+
+
+def main(visitors=200):
+    logging.getLogger().setLevel(logging.WARNING)
+    print(f"{visitors} visitors, foot press to open lid [s]")
+    for name, pir in (("foot only", False), ("pre-open", True)):
+        waits, users, pre_open = run(visitors, pir)
+        print(f"  {name:10s} mean {waits.mean():.3f}   p90 {np.percentile(waits, 90):.3f}   "
+              f"max {waits.max():.3f}   ({len(waits)} of {users} users)")
+        if pre_open is not None:
+            used = pre_open.hits / max(pre_open.moves, 1)
+            print(f"  {'':10s} {pre_open.moves} pre-opens, {pre_open.hits} hit ({used:.0%}), "
+                  f"{pre_open.wasted} wasted, {pre_open.cancelled} cancelled")
+
+
+if __name__ == "__main__":
+    logging.disable(logging.INFO)
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
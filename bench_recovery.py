@@ -0,0 +1,97 @@
+"""Benchmark recovery from pigpiod restarts on the simulator.
+
+pigpiod is restarted with the lid resting on a switch, and at points
+along an open move. The monitor loop notices, reconnects with backoff,
+creates the waves and chains again and resumes from the last switch or
+the position estimate. Lost to ready is from the restart until the lid
+can move again, in simulated time. Before, the program exited and had
+to be restarted by hand, then home from wherever the belt stopped. That
+is timed here as if the restart were instant: startup and a seek from
+the true belt position, with no human, interpreter start or imports.
+
+    python bench_recovery.py
+"""
+import logging
+import time
+
+from garbage import Garbage
+from sim_backend import SimBackend
+
+DOWNTIMES = [0.2, 1.0, 5.0]  # [s] pigpiod takes to come back
+PHASES = [None, 0.1, 0.3, 0.5, 0.7, 0.9]  # fraction of the open move, None for idle
+MOVE = 1.733  # [s] of the open move
+PRESS = 1.0  # [s] foot press time
+
+
+def trial(phase, downtime):
+    backend = SimBackend(start_mm=420)
+    garbage = Garbage(backend=backend, profile_cache=None, journal_path=None)
+    garbage.home()
+    garbage.run_once(timeout=0)
+    foot = garbage.switch_foot.pin
+    restart_at = PRESS + (0.5 if phase is None else phase * MOVE)
+    if phase is not None:
+        backend.schedule(PRESS, lambda: (backend.press(foot), backend.release(foot)))
+
+    stopped = {}
+
+    def restart():
+        backend.restart_daemon(downtime)
+        stopped["belt_mm"] = backend.belt_mm
+        stopped["time"] = backend.clock.now
+
+    backend.schedule(restart_at, restart)
+    supervisor = garbage.supervisor
+    recover = supervisor.recover
+    ready = {}
+
+    def timed_recover():
+        start = time.perf_counter()
+        recover()
+        ready["time"] = backend.clock.now
+        ready["wall"] = time.perf_counter() - start
+
+    supervisor.recover = timed_recover
+    home = garbage.home
+    homings = []
+    garbage.home = lambda: (homings.append(backend.clock.now), home())
+    backend.schedule(restart_at + downtime + 15, garbage.state.stop)
+    garbage.monitor()
+    return (ready["time"] - stopped["time"], supervisor.recovery_time, ready["wall"],
+            stopped["belt_mm"], len(garbage.wave_registry), len(list(garbage.chains())), bool(homings))
+
+
+def blind_homing(belt_mm):
+    """Startup and homing time of a restarted program, the belt at belt_mm"""
+    backend = SimBackend(start_mm=belt_mm)
+    start = time.perf_counter()
+    garbage = Garbage(backend=backend, profile_cache=None, journal_path=None)
+    startup = time.perf_counter() - start
+    if garbage.position is not None:
+        return startup
+    t = backend.clock.now
+    garbage.home()
+    return startup + backend.clock.now - t
+
+
+def main():
+    logging.getLogger().setLevel(logging.CRITICAL)
+    print("pigpiod restarts [s of simulated time]")
+    print(f"  {'down':>5s}  {'restart':>12s}  {'lost to ready':>13s}  {'recover':>8s}  "
+          f"{'re-homed':>8s}  {'before, instant restart':>23s}")
+    worst = {}
+    for downtime in DOWNTIMES:
+        for phase in PHASES:
+            lost_to_ready, recovery, wall, belt_mm, waves, chains, homed = trial(phase, downtime)
+            before = downtime + blind_homing(belt_mm)
+            worst[downtime] = max(worst.get(downtime, 0), lost_to_ready)
+            where = "idle" if phase is None else f"{phase:.0%} of open"
+            print(f"  {downtime:5.1f}  {where:>12s}  {lost_to_ready:13.3f}  {recovery:8.3f}  "
+                  f"{'yes' if homed else 'no':>8s}  {before:23.3f}")
+    print(f"  {waves} waves and {chains} chains created again per recovery, "
+          f"{wall * 1e3:.1f} ms of wall time on the simulator")
+    print("  worst lost to ready: " + ", ".join(f"{w:.2f} s down {d} s" for d, w in worst.items()))
+
+
+if __name__ == "__main__":
+    main()
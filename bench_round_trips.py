@@ -0,0 +1,68 @@
+"""Count pigpiod round trips per move for each way of stopping on a switch.
+
+Every pigpio.pi call is a socket round trip to pigpiod. Runs open/close
+moves on the simulated hardware and counts the calls Garbage makes:
+- callback:  gpiozero switch callbacks, chain stopped by the control loop
+- fast-stop: pigpio switch callbacks stop the chain
+- daemon:    the chain is stopped by a script running inside pigpiod
+
+    python bench_round_trips.py [moves]
+"""
+from collections import Counter
+import logging
+import sys
+
+from garbage import Garbage
+from sim_backend import SimBackend
+
+
+class CountingPi:
+    """Counts the calls made through it to a pigpio.pi"""
+
+    def __init__(self, pi):
+        self._pi = pi
+        self.calls = Counter()
+
+    def __getattr__(self, name):
+        attr = getattr(self._pi, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            self.calls[name] += 1
+            return attr(*args, **kwargs)
+
+        return call
+
+
+def count_moves(moves, fast_stop=False, daemon_stop=False):
+    backend = SimBackend(start_mm=20)
+    garbage = Garbage(backend=backend, fast_stop=fast_stop, daemon_stop=daemon_stop,
+                      profile_cache=None, journal_path=None)
+    garbage.home()
+    garbage.run_once(timeout=0)
+
+    pi = CountingPi(garbage.pi)
+    garbage.pi = pi
+    if garbage.stop_script is not None:
+        garbage.stop_script.pi = pi
+    foot = garbage.switch_foot.pin
+    for _ in range(moves):
+        backend.press(foot)
+        backend.release(foot)
+        garbage.run_once(timeout=0)
+    return pi.calls
+
+
+def main(moves=100):
+    logging.getLogger().setLevel(logging.WARNING)
+    print(f"pigpiod round trips per move over {moves} moves")
+    for name, options in [("callback", {}), ("fast-stop", {"fast_stop": True}),
+                          ("daemon", {"daemon_stop": True})]:
+        calls = count_moves(moves, **options)
+        detail = ", ".join(f"{call} {n / moves:.1f}" for call, n in calls.most_common())
+        print(f"  {name:10s} {sum(calls.values()) / moves:5.1f}   ({detail})")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100)
@@ -0,0 +1,165 @@
+"""Benchmark stop jitter of the switch I/O in a thread and in its own process.
+
+A pigpio stand-in fires the armed switch's edge 10 ms after each chain
+starts, from a callback thread as pigpio does, stamped with the time the
+switch closed rather than when the thread got to run. The I/O server
+stops the chain from the callback and records the edge to stop latency. It runs either as a thread of the supervisor, as
+Garbage's callbacks do today, or as rt_io's forked I/O process. The
+supervisor meanwhile loads its GIL with pure Python and numpy threads,
+and burner processes load every CPU.
+
+    python bench_rt_io.py [moves]
+"""
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+from rt_io import Channel, State, IoServer, io_main, MAX_DATA, CHAIN, WATCH, ARM, QUIT, STATE
+
+PIN = 20
+EDGE_DELAY = 0.01  # [s] chain start to the target switch edge
+
+
+class StandInPi:
+    """Just enough of pigpio.pi for the I/O server, fires the switch edges"""
+
+    def __init__(self):
+        self.callbacks = {}
+        self.busy = False
+        self.started = threading.Event()
+        threading.Thread(target=self._switches, daemon=True).start()
+
+    def _tick(self):
+        return int(time.perf_counter() * 1e6) & 0xFFFFFFFF
+
+    def _switches(self):
+        while True:
+            self.started.wait()
+            self.started.clear()
+            # The switch closes on time, however late this thread gets to run
+            edge = time.perf_counter() + EDGE_DELAY
+            time.sleep(EDGE_DELAY)
+            tick = int(edge * 1e6) & 0xFFFFFFFF
+            for func in list(self.callbacks.values()):
+                func(PIN, 1, tick)
+                func(PIN, 0, tick)
+
+    def callback(self, gpio, edge, func):
+        self.callbacks[gpio] = func
+        return self
+
+    def cancel(self):
+        pass
+
+    def wave_chain(self, data):
+        self.busy = True
+        self.started.set()
+
+    def wave_tx_stop(self):
+        self.busy = False
+
+    def wave_tx_busy(self):
+        return self.busy
+
+    def read(self, gpio):
+        return 0
+
+    def get_current_tick(self):
+        return self._tick()
+
+    def stop(self):
+        pass
+
+
+def burn(stop):
+    while not stop.is_set():
+        pass
+
+
+def hog_gil(stop):
+    while not stop.is_set():
+        sum(range(20000))
+
+
+def allocate(stop):
+    while not stop.is_set():
+        np.ones(1_000_000).cumsum()
+
+
+def read_state(events, state):
+    """state updated from the snapshots the server sent since"""
+    while True:
+        event = events.pop()
+        if event is None:
+            return state
+        if event[0] == STATE:
+            state = State.unpack(event[5])
+
+
+def run(moves, isolated, loaded):
+    commands = Channel(MAX_DATA)
+    events = Channel(State.LAYOUT.size)
+    if isolated:
+        server = multiprocessing.get_context("fork").Process(
+            target=io_main, args=(commands, events, StandInPi, 0.0005, None, 50), daemon=True)
+    else:
+        server = threading.Thread(target=IoServer(commands, events, StandInPi()).serve, daemon=True)
+    server.start()
+
+    stop = threading.Event()
+    burners = []
+    if loaded:
+        stop_burners = multiprocessing.get_context("fork").Event()
+        burners = [multiprocessing.get_context("fork").Process(target=burn, args=(stop_burners,), daemon=True)
+                   for _ in range(os.cpu_count() or 1)]
+        for process in burners:
+            process.start()
+        for load in (hog_gil, hog_gil, allocate):
+            threading.Thread(target=load, args=(stop,), daemon=True).start()
+
+    send = lambda kind, pin=0, value=0: commands.push(kind, pin, 0, value, time.perf_counter())
+    send(WATCH, PIN)
+    state = State.initial()
+    latencies = []
+    for i in range(moves):
+        send(CHAIN)
+        send(ARM, PIN, i + 1)
+        deadline = time.perf_counter() + 2.0
+        while state["stops"] <= i and time.perf_counter() < deadline:
+            time.sleep(0.001)
+            state = read_state(events, state)
+        if state["stop_latency_us"] >= 0:  # -1 if it was already pressed when armed
+            latencies.append(state["stop_latency_us"])
+        time.sleep(0.002)
+    time.sleep(0.05)  # for the loop counters' next snapshot
+    state = read_state(events, state)
+    send(QUIT)
+    server.join(5)
+
+    stop.set()
+    if burners:
+        stop_burners.set()
+        for process in burners:
+            process.join()
+    commands.close()
+    events.close()
+    return np.array(latencies), state
+
+
+def main(moves=100):
+    print(f"switch edge to chain stop over {moves} moves [us]")
+    for loaded in (False, True):
+        for isolated in (False, True):
+            latencies, state = run(moves, isolated, loaded)
+            name = f"{'process' if isolated else 'thread'}, {'loaded' if loaded else 'idle'}"
+            print(f"  {name:16s} median {np.median(latencies):7.0f}   p99 {np.percentile(latencies, 99):7.0f}   "
+                  f"max {latencies.max():7.0f}   (loop late max {state['max_late_us']} us, "
+                  f"command max {state['max_command_us']} us)")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100)
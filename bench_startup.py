@@ -0,0 +1,101 @@
+"""Benchmark time-to-ready of Garbage, with and without the profile cache.
+
+Each start runs in a fresh interpreter so module imports are counted: the
+clock starts before garbage is imported and stops once Garbage() returns,
+ready to move. A pigpio stand-in replaces the daemon, so pigpiod's own wave
+building time is not included.
+
+    python bench_startup.py [starts]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+HEAVY_MODULES = ("numpy", "gpiozero", "motion_planner")
+
+
+class StandInPi:
+    """Just enough of pigpio.pi for Garbage to start up"""
+
+    def __init__(self):
+        self.wave_count = 0
+
+    def set_mode(self, gpio, mode):
+        pass
+
+    def write(self, gpio, level):
+        pass
+
+    def set_pull_up_down(self, gpio, pud):
+        pass
+
+    def read(self, gpio):
+        return 0
+
+    def callback(self, gpio, edge, func):
+        return None
+
+    def wave_clear(self):
+        self.wave_count = 0
+
+    def wave_add_generic(self, pulses):
+        return len(pulses)
+
+    def wave_create(self):
+        self.wave_count += 1
+        return self.wave_count - 1
+
+
+class StandInButton:
+    def __init__(self):
+        self.when_pressed = None
+        self.when_released = None
+
+
+def child(cache_path):
+    start = time.perf_counter()
+    import logging
+
+    from backend import PigpioBackend
+    from garbage import Garbage
+
+    logging.getLogger().setLevel(logging.WARNING)
+    backend = PigpioBackend(pi=StandInPi())
+    backend.button = lambda pin, pull_up: StandInButton()
+    Garbage(backend=backend, fast_stop=True, profile_cache=cache_path, journal_path=None)
+    elapsed = time.perf_counter() - start
+    loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+    print(f"{elapsed} {','.join(loaded) or '-'}")
+
+
+def start_once(cache_path):
+    out = subprocess.run([sys.executable, __file__, "--child", cache_path],
+                         capture_output=True, text=True, check=True).stdout.split()
+    return float(out[0]), out[1]
+
+
+def main(starts=5):
+    with tempfile.TemporaryDirectory() as directory:
+        cache_path = os.path.join(directory, "profiles.json")
+        cold = []
+        warm = []
+        for _ in range(starts):
+            if os.path.exists(cache_path):
+                os.remove(cache_path)
+            elapsed, cold_modules = start_once(cache_path)
+            cold.append(elapsed)
+            elapsed, warm_modules = start_once(cache_path)
+            warm.append(elapsed)
+
+    print(f"time to ready over {starts} starts [ms], best of each")
+    print(f"  no cache   {min(cold) * 1e3:8.1f}   imported {cold_modules}")
+    print(f"  cached     {min(warm) * 1e3:8.1f}   imported {warm_modules}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--child":
+        child(sys.argv[2])
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
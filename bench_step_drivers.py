@@ -0,0 +1,123 @@
+"""Benchmark the step drivers' achievable rate and timing on the simulator.
+
+Each driver sends a one second run at a sweep of step rates, and a three
+level ramp. The simulated pigpiod charges CALL_LATENCY for every call and
+sleeps overshoot by SLEEP_OVERSHOOT plus a random tail, as Linux sleeps
+do. Wave chain step times come from the pulses themselves
+(pulse_analyzer), the others from the edges and PWM changes they make.
+
+    python bench_step_drivers.py
+"""
+import logging
+import random
+
+import numpy as np
+
+from pulse_analyzer import step_times
+from sim_backend import SimBackend
+from step_driver import BitBangDriver, HardwarePWMDriver, WaveChainDriver, select_driver
+
+PIN = 18  # a hardware PWM pin, so every driver can run on it
+CALL_LATENCY = 60e-6  # [s] pigpiod socket round trip
+SLEEP_OVERSHOOT = 50e-6  # [s] least a sleep oversleeps by
+SLEEP_TAIL = 30e-6  # [s] mean of the random rest
+
+RATES = [250, 1000, 4000, 16000, 64000]
+RAMP = [[2000, 400], [6000, 1500], [12000, 6000]]
+
+
+class TimedPi:
+    """Logs the step pin's writes and PWM changes, each call costing CALL_LATENCY"""
+
+    def __init__(self, backend):
+        self._pi = backend.pi
+        self.backend = backend
+        self.rises = []  # times the step pin went high
+        self.pwm = []  # (time, actual frequency)
+
+    def __getattr__(self, name):
+        return getattr(self._pi, name)
+
+    def _call(self):
+        self.backend.run_until(self.backend.clock.now + CALL_LATENCY)
+
+    def write(self, gpio, level):
+        self._call()
+        self._pi.write(gpio, level)
+        if gpio == PIN and level:
+            self.rises.append(self.backend.clock.now)
+
+    def hardware_PWM(self, gpio, frequency, duty):
+        self._call()
+        self._pi.hardware_PWM(gpio, frequency, duty)
+        self.pwm.append((self.backend.clock.now, self._pi.get_PWM_frequency(gpio)))
+
+
+class OversleepingClock:
+    def __init__(self, clock, seed=1):
+        self.clock = clock
+        self.rng = random.Random(seed)
+
+    def time(self):
+        return self.clock.time()
+
+    def sleep(self, seconds):
+        self.clock.sleep(seconds + SLEEP_OVERSHOOT + self.rng.expovariate(1 / SLEEP_TAIL))
+
+
+def send(driver_class, ramp):
+    """Steps sent, time taken [s] and step period jitter [s] of a ramp"""
+    backend = SimBackend()
+    pi = TimedPi(backend)
+    clock = OversleepingClock(backend.clock)
+    driver = driver_class(pi, PIN, clock)
+    start = backend.clock.now
+    if driver_class is WaveChainDriver:
+        chain = driver.compile(ramp)
+        times, duration = step_times(chain, driver.wave_registry.pulses(), PIN)
+        return len(times), duration, 0.0
+    driver.run(ramp)
+    duration = backend.clock.now - start
+    if driver_class is HardwarePWMDriver:
+        # Steps are the frequency times how long each setting lasted
+        times, frequencies = zip(*pi.pwm)
+        steps = float(np.sum(np.array(frequencies[:-1]) * np.diff(times)))
+        return steps, times[-1] - times[0], 0.0
+    rises = np.array(pi.rises)
+    return len(rises), duration, float(np.std(np.diff(rises))) if len(rises) > 2 else 0.0
+
+
+def main():
+    logging.getLogger().setLevel(logging.WARNING)
+    drivers = (WaveChainDriver, HardwarePWMDriver, BitBangDriver)
+    print(f"one second runs on GPIO {PIN}: rate sent [Hz] (error), step count error")
+    print(f"  {'asked':>8s}" + "".join(f"  {d.name:>26s}" for d in drivers))
+    achievable = dict.fromkeys(drivers, 0)
+    for rate in RATES:
+        row = f"  {rate:8d}"
+        for driver in drivers:
+            steps, duration, _ = send(driver, [[rate, rate]])
+            error = steps / duration / rate - 1
+            if abs(error) < 0.05 and abs(steps - rate) < 0.01 * rate:
+                achievable[driver] = rate
+            row += f"  {steps / duration:9.0f} ({error:+7.2%}) {steps - rate:+7.1f}"
+        print(row)
+    print(f"  highest within 5% and 1% of the steps: "
+          + ", ".join(f"{d.name} {achievable[d] or '-'} Hz" for d in drivers))
+
+    asked = sum(f and n / f for f, n in RAMP)
+    total = sum(n for _, n in RAMP)
+    print(f"ramp of {len(RAMP)} levels, {total} steps in {asked:.4f} s")
+    for driver in drivers:
+        steps, duration, jitter = send(driver, RAMP)
+        print(f"  {driver.name:14s} {steps:9.1f} steps in {duration:.4f} s ({duration / asked - 1:+.2%})"
+              + (f", period jitter {jitter * 1e6:.1f} us" if jitter else ""))
+
+    print("selection")
+    for pin, rate, exact in [(27, 6441, False), (18, 6441, False), (18, 40000, True), (27, 40000, True)]:
+        print(f"  GPIO {pin:2d} at {rate:5d} Hz{' exactly' if exact else '':8s} -> "
+              f"{select_driver(pin, rate, exact).name}")
+
+
+if __name__ == "__main__":
+    main()
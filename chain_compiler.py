@@ -0,0 +1,90 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# pigpio wave_chain command bytes
+LOOP_START = [255, 0]
+LOOP_REPEAT = [255, 1]  # followed by count & 255, count >> 8
+LOOP_FOREVER = [255, 3]
+
+MAX_LOOP_COUNT = 65535  # loop counters are 16 bit
+MAX_CHAIN_LENGTH = 600  # bytes pigpiod accepts in one wave_chain
+MAX_LOOP_DEPTH = 4  # kept well inside pigpiod's chain counter nesting limit
+
+
+class Chain(list):
+    """Wave chain bytes that remember the levels they were compiled from"""
+
+    def __init__(self, data, levels, loop_forever):
+        super().__init__(data)
+        self.levels = levels  # [wave id, steps]
+        self.loop_forever = loop_forever
+        self.step_periods = None  # seconds per step of each level, if known
+
+    def rebuild(self, wids):
+        """Compile again in place with the wave ids mapped through wids
+        (old id -> new id), after the waves were created again"""
+        chain = compile_chain([[wids[wid], steps] for wid, steps in self.levels],
+                              self.loop_forever)
+        self[:] = chain
+        self.levels = chain.levels
+
+
+def compile_level(wid, steps):
+    """Chain bytes sending wave wid steps times, for any number of steps.
+    Counts above the 16 bit loop counter are split into nested loops:
+    steps = q * 65535 + r sends a 65535 loop q times, then r more.
+    Returns (chain, loop depth).
+    """
+    steps = int(steps)
+    if steps <= 0:
+        return [], 0
+    if steps == 1:
+        return [wid], 0
+    if steps <= MAX_LOOP_COUNT:
+        return LOOP_START + [wid] + LOOP_REPEAT + [steps & 255, steps >> 8], 1
+
+    repeats, remainder = divmod(steps, MAX_LOOP_COUNT)
+    inner, inner_depth = compile_level(wid, MAX_LOOP_COUNT)
+    if repeats == 1:
+        chain, depth = inner, inner_depth
+    else:
+        # Nest the full inner loop inside a counter of its own repeats
+        outer, outer_depth = compile_level(None, repeats)
+        chain = []
+        for byte in outer:
+            chain += inner if byte is None else [byte]
+        depth = outer_depth + inner_depth
+    rest, rest_depth = compile_level(wid, remainder)
+    return chain + rest, max(depth, rest_depth)
+
+
+def compile_chain(levels, loop_forever=False):
+    """Compile [wave id, steps] levels into a wave_chain.
+    loop_forever:  keep sending the wave of the last level once the chain ends
+    Raises ValueError if pigpiod would reject the chain.
+    """
+    chain = []
+    depth = 0
+    for wid, steps in levels:
+        level, level_depth = compile_level(wid, steps)
+        chain += level
+        depth = max(depth, level_depth)
+
+    if loop_forever and levels:
+        # loop the last speed forever
+        chain += LOOP_START + [levels[-1][0]] + LOOP_FOREVER
+        depth = max(depth, 1)
+
+    validate_chain(chain, depth)
+    logger.debug(f'Compiled {len(levels)} levels into a chain of {len(chain)} bytes')
+    return Chain(chain, [list(level) for level in levels], loop_forever)
+
+
+def validate_chain(chain, depth=0):
+    if len(chain) > MAX_CHAIN_LENGTH:
+        raise ValueError(
+            f"Chain of {len(chain)} bytes is longer than the {MAX_CHAIN_LENGTH} pigpiod accepts"
+        )
+    if depth > MAX_LOOP_DEPTH:
+        raise ValueError(f"Chain loops nest {depth} deep, more than {MAX_LOOP_DEPTH}")
@@ -0,0 +1,198 @@
+"""Drive many cans from one process.
+
+Each can is a Garbage unit with its own pin map, on a local or remote
+pigpiod. Units on the same pigpiod share one pooled connection and one
+wave registry, and take turns moving since pigpiod has a single wave
+transmitter. A fault in one unit is logged and retried after a delay
+without touching the others.
+
+    python controller.py units.json
+
+units.json is a list of {"name", "host", "port", "pins"}, host, port and
+pins are optional.
+"""
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import time
+
+import pigpio
+
+from backend import PigpioBackend
+from garbage import Garbage
+import position_journal
+import profile_cache
+from wave_registry import WaveRegistry
+
+logger = logging.getLogger(__name__)
+
+
+class Connection:
+    """One pigpiod and what the units using it share"""
+
+    def __init__(self, host, port, pi):
+        self.host = host
+        self.port = port
+        self.pi = pi
+        self.wave_registry = WaveRegistry(pi)
+        self.wave_registry.clear()
+        self.move_lock = asyncio.Lock()  # one wave transmitter per pigpiod
+        self.units = 0
+
+
+class ConnectionPool:
+    """pigpiod connections by (host, port), opened on first use"""
+
+    def __init__(self, connect=None):
+        self.connect = connect or (lambda host, port: pigpio.pi(host, port))
+        self.connections = {}
+
+    def get(self, host="localhost", port=8888):
+        connection = self.connections.get((host, port))
+        if connection is None:
+            pi = self.connect(host, port)
+            if not pi.connected:
+                raise ConnectionError(f"Could not connect to pigpiod on {host}:{port}")
+            connection = self.connections[(host, port)] = Connection(host, port, pi)
+        connection.units += 1
+        return connection
+
+    def release(self, connection):
+        connection.units -= 1
+        if connection.units == 0:
+            del self.connections[(connection.host, connection.port)]
+            connection.wave_registry.clear()
+            connection.pi.stop()
+
+    def close(self):
+        for connection in list(self.connections.values()):
+            connection.units = 1
+            self.release(connection)
+
+
+class Unit:
+    def __init__(self, name, connection, garbage):
+        self.name = name
+        self.connection = connection
+        self.garbage = garbage
+        self.moves = 0
+        self.faults = 0
+        self.error = None  # last fault
+        self.lock_wait = 0.0  # [s] in all, waiting for the other units on its pigpiod
+        self.longest_lock_wait = 0.0  # [s]
+
+
+class Controller:
+    """asyncio supervisor of many Garbage units.
+
+    Garbage waits on condition variables, so every blocking call runs in a
+    worker thread and the event loop only sequences them. Threads sleep
+    until a switch or foot event, so tens of units cost little.
+    """
+
+    def __init__(self, pool=None, backend_factory=None, poll=1.0, retry_delay=5.0):
+        self.pool = ConnectionPool() if pool is None else pool
+        self.backend_factory = backend_factory or (
+            lambda connection: PigpioBackend(pi=connection.pi, pigpio_buttons=True,
+                                             wave_registry=connection.wave_registry))
+        self.poll = poll  # [s] longest a unit's wait blocks, so stop() is noticed
+        self.retry_delay = retry_delay  # [s] after a fault
+        self.units = {}
+        self.executor = None
+        self.stopped = False
+
+    def add_unit(self, name, host="localhost", port=8888, pins=None, **options):
+        """Set up a can, options go to Garbage"""
+        if name in self.units:
+            raise ValueError(f"unit {name} already exists")
+        connection = self.pool.get(host, port)
+        try:
+            options.setdefault("fast_stop", True)
+            # Each can remembers its own position and profiles
+            options.setdefault("journal_path", os.path.join(
+                os.path.dirname(position_journal.DEFAULT_PATH), f"{name}.journal"))
+            options.setdefault("profile_cache", os.path.join(
+                os.path.dirname(profile_cache.DEFAULT_PATH), f"{name}-profiles.json"))
+            garbage = Garbage(backend=self.backend_factory(connection), pins=pins, **options)
+        except Exception:
+            self.pool.release(connection)
+            raise
+        unit = self.units[name] = Unit(name, connection, garbage)
+        return unit
+
+    async def run(self):
+        """Run every unit until stop()"""
+        loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, len(self.units)),
+                                           thread_name_prefix="unit")
+        try:
+            await asyncio.gather(*(self._run_unit(loop, unit) for unit in self.units.values()))
+        finally:
+            self.executor.shutdown(wait=False)
+
+    async def _run_unit(self, loop, unit):
+        garbage = unit.garbage
+        while not self.stopped:
+            try:
+                if garbage.position is None:
+                    await self._take_turn(loop, unit, garbage.home)
+                    continue
+                move = await loop.run_in_executor(self.executor, garbage.next_move, self.poll)
+                if move is None:
+                    continue
+                await self._take_turn(loop, unit, garbage.move_to_target, *move)
+                unit.moves += 1
+            except Exception as e:
+                unit.faults += 1
+                unit.error = e
+                logger.error(f"Unit {unit.name} faulted ({unit.faults} so far): {e!r}")
+                try:
+                    garbage.stop_chain()
+                except Exception:
+                    pass
+                await asyncio.sleep(self.retry_delay)
+
+    async def _take_turn(self, loop, unit, func, *args):
+        """Run func once the transmitter of the unit's pigpiod is free"""
+        start = time.perf_counter()
+        async with unit.connection.move_lock:
+            wait = time.perf_counter() - start
+            unit.lock_wait += wait
+            unit.longest_lock_wait = max(unit.longest_lock_wait, wait)
+            await loop.run_in_executor(self.executor, func, *args)
+
+    def stop(self):
+        self.stopped = True
+        for unit in self.units.values():
+            unit.garbage.state.stop()
+
+    def close(self):
+        for unit in self.units.values():
+            if unit.garbage.journal is not None:
+                unit.garbage.journal.close()
+            self.pool.release(unit.connection)
+        self.units.clear()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run many garbage cans from one process")
+    parser.add_argument("units", help="JSON file listing the units")
+    args = parser.parse_args()
+
+    with open(args.units) as f:
+        config = json.load(f)
+
+    controller = Controller()
+    for entry in config:
+        controller.add_unit(entry["name"], entry.get("host", "localhost"),
+                            entry.get("port", 8888), entry.get("pins"))
+    try:
+        asyncio.run(controller.run())
+    except KeyboardInterrupt:
+        print("\nCtrl-C pressed.  Stopping units...")
+    finally:
+        controller.stop()
+        controller.close()
@@ -0,0 +1,84 @@
+import logging
+
+import pigpio
+
+from edge_rate import TICK_MASK
+
+logger = logging.getLogger(__name__)
+
+# Runs inside pigpiod once the chain has been sent. Polls the target switch
+# every p1 microseconds and stops the chain the moment it reads high, with
+# no socket round trip or Python thread in the way.
+#   p0  target switch GPIO (pulled down, pressed is high)
+#   p1  poll interval [us]
+#   p8  tick the chain was stopped at, once ARRIVED
+#   p9  result, one of RUNNING, ARRIVED, CHAIN_ENDED
+STOP_SCRIPT = """
+tag 1
+r p0
+jnz 2
+wvbsy
+jz 3
+mics p1
+jmp 1
+tag 2
+wvhlt
+tick
+sta p8
+ld p9 1
+halt
+tag 3
+ld p9 2
+halt
+"""
+
+RUNNING = 0
+ARRIVED = 1
+CHAIN_ENDED = 2
+
+
+class StopScript:
+    """The transmit-until-target-edge loop of a move, run by pigpiod.
+
+    Python sends the chain and starts the script, then only asks for the
+    result once in a while, so a move costs a handful of round trips and
+    the stop latency is the poll interval whatever Python is doing.
+    """
+
+    def __init__(self, pi, poll_us=100):
+        self.pi = pi
+        self.poll_us = poll_us
+        self.halt_tick = None  # tick pigpiod stopped the chain at, once ARRIVED
+        self.sid = pi.store_script(STOP_SCRIPT.strip().encode())
+        if self.sid < 0:
+            raise pigpio.error(f"store_script failed with {self.sid}")
+        # pigpiod compiles the script in the background before it can run
+        status = pigpio.PI_SCRIPT_INITING
+        for _ in range(100):
+            status, _ = pi.script_status(self.sid)
+            if status != pigpio.PI_SCRIPT_INITING:
+                break
+        if status != pigpio.PI_SCRIPT_HALTED:
+            raise pigpio.error(f"stop script is not ready, status {status}")
+
+    def start(self, target_pin):
+        """Watch target_pin and stop the running chain when it goes high"""
+        self.halt_tick = None
+        self.pi.run_script(self.sid, [target_pin, self.poll_us] + [0] * 7 + [RUNNING])
+
+    def result(self):
+        """RUNNING, ARRIVED or CHAIN_ENDED"""
+        status, params = self.pi.script_status(self.sid)
+        if status == pigpio.PI_SCRIPT_FAILED:
+            raise SystemError("pigpiod stop script failed")
+        if status == pigpio.PI_SCRIPT_RUNNING or not params:
+            return RUNNING
+        if params[9] == ARRIVED:
+            self.halt_tick = params[8] & TICK_MASK
+        return params[9]
+
+    def stop(self):
+        self.pi.stop_script(self.sid)
+
+    def delete(self):
+        self.pi.delete_script(self.sid)
@@ -0,0 +1,89 @@
+import logging
+import struct
+
+import pigpio
+
+logger = logging.getLogger(__name__)
+
+# What pigpio raises on a connection whose pigpiod has gone: the send
+# fails, or the reply comes back short and won't unpack
+CONNECTION_ERRORS = (OSError, struct.error, pigpio.error)
+
+
+class DaemonSupervisor:
+    """Brings a Garbage back on a new connection after pigpiod restarts.
+
+    A restart takes every wave, chain, callback and script with it. The
+    supervisor reconnects with exponential backoff, then Garbage re-creates
+    its waves from the registry's (pin, period) keys, rebuilds every chain
+    in place from its levels and sets its pins and callbacks up again.
+    The lid carries on from its last known or estimated position instead
+    of waiting for a restart by hand and homing blind.
+
+    connect:  opens a new pigpio.pi, the backend's connect()
+    heartbeat:  [s] longest the idle monitor loop goes without checking
+    timeout:  [s] recovery gives up (ConnectionError) after this long
+    """
+
+    def __init__(self, garbage, connect, min_backoff=0.1, max_backoff=1.0, timeout=30.0,
+                 heartbeat=1.0):
+        self.garbage = garbage
+        self.connect = connect
+        self.min_backoff = min_backoff  # [s]
+        self.max_backoff = max_backoff  # [s] also the most a comeback goes unnoticed
+        self.timeout = timeout
+        self.heartbeat = heartbeat
+        self.recoveries = 0
+        self.attempts = 0
+        self.recovery_time = None  # [s] of the last recovery
+
+    def alive(self):
+        """True if the connection still reaches pigpiod"""
+        pi = self.garbage.pi
+        if not getattr(pi, "connected", True):
+            return False
+        try:
+            pi.get_current_tick()
+        except CONNECTION_ERRORS:
+            return False
+        return True
+
+    def check(self):
+        """Recover if pigpiod has gone. Returns True if it had"""
+        if self.alive():
+            return False
+        self.recover()
+        return True
+
+    def reconnect(self):
+        """New connection, retried with exponential backoff until timeout"""
+        clock = self.garbage.clock
+        deadline = clock.time() + self.timeout
+        delay = self.min_backoff
+        while True:
+            self.attempts += 1
+            try:
+                pi = self.connect()
+                if getattr(pi, "connected", True):
+                    return pi
+            except CONNECTION_ERRORS as e:
+                logger.debug(f"Connecting to pigpiod failed: {e!r}")
+            if clock.time() + delay > deadline:
+                raise ConnectionError(f"pigpiod did not come back within {self.timeout} s")
+            logger.warning(f"pigpiod is not back yet, retrying in {delay:.2f} s")
+            clock.sleep(delay)
+            delay = min(2 * delay, self.max_backoff)
+
+    def recover(self):
+        """Reconnect, put the daemon's state back and resume"""
+        garbage = self.garbage
+        start = garbage.clock.time()
+        logger.error("Lost pigpiod, reconnecting")
+        garbage.rebind(self.reconnect())
+        garbage.resume(start)
+        self.recoveries += 1
+        self.recovery_time = garbage.clock.time() - start
+        garbage.telemetry.count("reconnects_total")
+        garbage.telemetry.observe("recovery_seconds", self.recovery_time)
+        logger.info(f"Recovered from the pigpiod restart in {self.recovery_time:.3f} s, "
+                    f"at {garbage.position or 'an unknown position'}")
@@ -0,0 +1,53 @@
+TICK_MASK = 0xFFFFFFFF  # pigpio ticks are unsigned 32 bit microseconds
+
+
+class EdgeRateDetector:
+    """Fires when threshold edges arrive within a sliding time window.
+
+    Ticks go into a preallocated ring of threshold slots. Once it is full
+    the oldest tick is overwritten, so only the newest threshold edges are
+    ever kept and each add() is O(1) with no allocation, which keeps it
+    cheap enough to call from a pigpio callback thread. Ages are taken
+    modulo 2**32 so the tick wrap every ~72 minutes is harmless (windows
+    must be shorter than that).
+    """
+
+    def __init__(self, window=5.0, threshold=100):
+        if threshold < 1:
+            raise ValueError(f"threshold of {threshold} must be at least 1")
+        self.window = window  # [s]
+        self.window_us = int(window * 1e6)
+        self.threshold = threshold
+        self.ticks = [0] * threshold
+        self.head = 0  # slot the next tick is written to
+        self.count = 0  # valid ticks in the ring
+        self.total = 0  # edges seen since reset
+
+    def add(self, tick):
+        """Record an edge at tick [us]. Returns True if the rate threshold is met"""
+        self.ticks[self.head] = tick
+        self.head += 1
+        if self.head == self.threshold:
+            self.head = 0
+        if self.count < self.threshold:
+            self.count += 1
+        self.total += 1
+
+        if self.count < self.threshold:
+            return False
+        # Ring is full, so head now holds the oldest of the newest threshold ticks
+        return (tick - self.ticks[self.head]) & TICK_MASK <= self.window_us
+
+    def edges_in_window(self, tick):
+        """Number of kept edges no older than window at tick (at most threshold)"""
+        n = 0
+        for i in range(self.count):
+            if (tick - self.ticks[(self.head - 1 - i) % self.threshold]) & TICK_MASK > self.window_us:
+                break
+            n += 1
+        return n
+
+    def reset(self):
+        self.head = 0
+        self.count = 0
+        self.total = 0
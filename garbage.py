@@ -1,15 +1,32 @@
-from copy import copy
-
 import pigpio
 import sys
-from gpiozero import Button
 import logging
 import argparse
+import json
+import math
+import os
+import threading
 import time
-from time import sleep
-import numpy as np
 from signal import pause
 
+from backend import PigpioBackend
+import daemon_script
+from daemon_script import StopScript
+from belt_monitor import BeltMonitor
+from daemon_supervisor import DaemonSupervisor
+from edge_rate import EdgeRateDetector, TICK_MASK
+from log_pipeline import LogPipeline
+from position_estimator import PositionEstimator
+import position_journal
+from position_journal import PositionJournal
+from pre_open import PreOpen
+from profile_cache import ProfileCache, DEFAULT_PATH, config_key
+from recorder import EventRecorder, EDGE, FOOT, CHAIN_START, CHAIN_STOP
+from telemetry import Telemetry
+from wave_registry import WaveRegistry
+from step_driver import WaveChainDriver
+from state_machine import LidStateMachine, FOOT_PRESSED, ARRIVED, DEPARTED
+
 logging.basicConfig(
     format="%(asctime)s %(levelname)-8s %(message)s",
     level=logging.DEBUG,
@@ -19,6 +36,49 @@ logger = logging.getLogger(__name__)
 logger.propagate = True
 
 
+# Where each limit switch sits along the belt loop [mm] from the Open switch,
+# and the length of the loop. PLACEHOLDERS: the layout the simulator was
+# written against, never measured on a can. Measure a can's own with
+# `python garbage.py --calibrate` and it is used from then on
+DEFAULT_GEOMETRY = {
+    "belt_length": 780.0,
+    "Open": 0.0,
+    "ReadyToClose": 50.0,
+    "Closed": 390.0,
+    "ReadyToOpen": 440.0,
+}
+GEOMETRY_PATH = os.path.join(os.path.expanduser("~"), ".config", "garbage_can", "geometry.json")
+
+
+def load_geometry(path):
+    """Geometry saved by --calibrate, None if there is none"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_geometry(path, geometry):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(geometry, f, indent=1)
+        f.write("\n")
+
+
+# GPIO pins of one can, override any of them with Garbage(pins=...)
+DEFAULT_PINS = {
+    "direction": 22,
+    "step": 27,
+    "enable": 17,
+    "idler_top": 20,
+    "idler_bottom": 24,
+    "motor_top": 21,
+    "motor_bottom": 12,
+    "foot": 18,
+}
+
+
 class Motor:
     def __init__(self):
         self.pin_direction = None
@@ -32,35 +92,57 @@ class Switch:
         self.name = None
         self.position_name = None
         self.pin = None
+        self.edges = None
+        self.callback = None
+        self.position_mm = None
+
+
+class Profile:
+    """Motion profile of one move between two positions"""
+
+    def __init__(self, name, distance, max_speed, acceleration):
+        self.name = name
+        self.distance = distance  # [mm]
+        self.max_speed = max_speed  # [mm/s]
+        self.acceleration = acceleration  # [mm/s2]
+        self.chain = None  # compiled at startup
+        self.end_speed = None  # [mm/s] speed it reaches its switch at
 
 
 class Garbage:
-    def __init__(self):
+    def __init__(self, backend=None, fast_stop=False, profile_cache=DEFAULT_PATH,
+                 metrics_path=None, journal_path=position_journal.DEFAULT_PATH,
+                 daemon_stop=False, pins=None, recording_path=None, geometry=None):
         # TODO: Check that pigpiod is running
-
-        # Connect to pigpiod daemon
-        self.pi = pigpio.pi()
+        start_time = time.perf_counter()
+
+        # Connect to pigpiod daemon, or whatever hardware backend was given
+        self.backend = PigpioBackend() if backend is None else backend
+        self.pi = self.backend.pi
+        self.clock = self.backend.clock
+        # Binary recording of every switch edge, foot press and chain, for replay.py
+        self.recorder = None if recording_path is None else EventRecorder(recording_path)
+        # Stop on the target switch edge in pigpiod's callback thread
+        # instead of waiting for the control loop to notice the arrival
+        self.fast_stop = fast_stop
+        # Or leave watching the target switch and stopping to a script
+        # running inside pigpiod
+        self.daemon_stop = daemon_stop
+
+        self.pins = dict(DEFAULT_PINS, **(pins or {}))
 
         self.motor = Motor()
-        self.motor.pin_direction = 22  # Direction GPIO Pin
-        self.motor.pin_step = 27  # Step GPIO Pin
+        self.motor.pin_direction = self.pins["direction"]  # Direction GPIO Pin
+        self.motor.pin_step = self.pins["step"]  # Step GPIO Pin
         
-        self.motor.pin_enable = 17 # enables drive
+        self.motor.pin_enable = self.pins["enable"] # enables drive
 
-        # Set up pins as an output
-        self.pi.set_mode(self.motor.pin_direction, pigpio.OUTPUT)
-        self.pi.set_mode(self.motor.pin_step, pigpio.OUTPUT)
-        self.pi.set_mode(self.motor.pin_enable, pigpio.OUTPUT)
-        
-        # Enable the drive
-        self.pi.write(self.motor.pin_enable, 1)
-        
         # set direction to CW
         # motor should only ever rotate CW. CCW rotation just spins
         # the sprag bearing
         # CW = 0 , CCW = 1
         self.rotation_direction = 1
-        self.pi.write(self.motor.pin_direction, self.rotation_direction)
+        self.setup_motor_pins()
 
         self.position_names = ["Open", "ReadyToClose", "Closed", "ReadyToOpen"]
 
@@ -68,73 +150,93 @@ class Garbage:
         self.switch_idler_top = Switch()
         self.switch_idler_top.name = "Idler Top"
         self.switch_idler_top.position_name = self.position_names[0]
-        self.switch_idler_top.pin = 20
-        self.switch_idler_top.button = Button(self.switch_idler_top.pin, pull_up=False)
+        self.switch_idler_top.pin = self.pins["idler_top"]
 
         self.switch_idler_bottom = Switch()
         self.switch_idler_bottom.name = "Idler Bottom"
         self.switch_idler_bottom.position_name = self.position_names[1]
-        self.switch_idler_bottom.pin = 24
-        self.switch_idler_bottom.button = Button(
-            self.switch_idler_bottom.pin, pull_up=False
-        )
+        self.switch_idler_bottom.pin = self.pins["idler_bottom"]
 
         self.switch_motor_top = Switch()
         self.switch_motor_top.name = "Motor Top"
         self.switch_motor_top.position_name = self.position_names[3]
-        self.switch_motor_top.pin = 21
-        self.switch_motor_top.button = Button(self.switch_motor_top.pin, pull_up=False)
+        self.switch_motor_top.pin = self.pins["motor_top"]
 
         self.switch_motor_bottom = Switch()
         self.switch_motor_bottom.name = "Motor Bottom"
         self.switch_motor_bottom.position_name = self.position_names[2]
-        self.switch_motor_bottom.pin = 12
-        self.switch_motor_bottom.button = Button(
-            self.switch_motor_bottom.pin, pull_up=False
-        )
+        self.switch_motor_bottom.pin = self.pins["motor_bottom"]
+
+        self.limit_switches = [
+            self.switch_idler_top,
+            self.switch_idler_bottom,
+            self.switch_motor_top,
+            self.switch_motor_bottom,
+        ]
+
+        # A limit switch can't legitimately change this often, so more edges
+        # than this means it is bouncing or failing
+        for switch in self.limit_switches:
+            switch.edges = EdgeRateDetector(window=0.1, threshold=6)
+
+        self.limit_switches_by_pin = {switch.pin: switch for switch in self.limit_switches}
+        for switch in self.limit_switches:
+            if self.fast_stop:
+                # pigpiod reports edges with hardware ticks, and the target
+                # switch stops the chain straight from its callback
+                self.pi.set_mode(switch.pin, pigpio.INPUT)
+                self.pi.set_pull_up_down(switch.pin, pigpio.PUD_DOWN)
+                switch.callback = self.pi.callback(
+                    switch.pin, pigpio.EITHER_EDGE, self.switch_edge_callback
+                )
+            else:
+                switch.button = self.backend.button(switch.pin, pull_up=False)
 
         self.switch_foot = Switch()
         self.switch_foot.name = "Foot switch"
-        self.switch_foot.pin = 18
-        self.switch_foot.button = Button(self.switch_foot.pin, pull_up=True)
+        self.switch_foot.pin = self.pins["foot"]
+        self.switch_foot.button = self.backend.button(self.switch_foot.pin, pull_up=True)
 
         # Set switch methods and callbacks
         # Callbacks can't take inputs, so we have to create individual
         # callbacks for each switch.
 
-        self.switch_idler_top.button.when_pressed = (
-            self.switch_pressed_idler_top_callback
-        )
-        self.switch_idler_top.button.when_released = (
-            self.switch_released_idler_top_callback
-        )
-        
-        self.switch_idler_bottom.button.when_pressed = (
-            self.switch_pressed_idler_bottom_callback
-        )
-        self.switch_idler_bottom.button.when_released = (
-            self.switch_released_idler_bottom_callback
-        )
-        
-        self.switch_motor_top.button.when_pressed = (
-            self.switch_pressed_motor_top_callback
-        )
-        self.switch_motor_top.button.when_released = (
-            self.switch_released_motor_top_callback
-        )
-
-        self.switch_motor_bottom.button.when_pressed = (
-            self.switch_pressed_motor_bottom_callback
-        )
-        self.switch_motor_bottom.button.when_released = (
-            self.switch_released_motor_bottom_callback
-        )
+        if not self.fast_stop:
+            self.switch_idler_top.button.when_pressed = (
+                self.switch_pressed_idler_top_callback
+            )
+            self.switch_idler_top.button.when_released = (
+                self.switch_released_idler_top_callback
+            )
+
+            self.switch_idler_bottom.button.when_pressed = (
+                self.switch_pressed_idler_bottom_callback
+            )
+            self.switch_idler_bottom.button.when_released = (
+                self.switch_released_idler_bottom_callback
+            )
+
+            self.switch_motor_top.button.when_pressed = (
+                self.switch_pressed_motor_top_callback
+            )
+            self.switch_motor_top.button.when_released = (
+                self.switch_released_motor_top_callback
+            )
+
+            self.switch_motor_bottom.button.when_pressed = (
+                self.switch_pressed_motor_bottom_callback
+            )
+            self.switch_motor_bottom.button.when_released = (
+                self.switch_released_motor_bottom_callback
+            )
 
         self.switch_foot.button.when_pressed = self.switch_pressed_foot_callback
 
+        self.stop_script = StopScript(self.pi) if self.daemon_stop else None
+
         self.pulse_per_motor_rev = 1600
         self.gearbox_ratio = 20
-        self.dist_per_rev = 2 * np.pi * 79.070/2.0  # 496.8 [mm]
+        self.dist_per_rev = 2 * math.pi * 79.070/2.0  # 496.8 [mm]
         self.steps_per_mm = (self.gearbox_ratio * self.pulse_per_motor_rev) / self.dist_per_rev # 128.8
         logger.debug(f'motor will do {self.steps_per_mm} steps per mm')
         
@@ -143,78 +245,274 @@ class Garbage:
         self.crawl_speed = 50 # mm/s
         self.crawl_speedfreq = self.crawl_speed * self.steps_per_mm # Hertz
         logger.debug(f'Crawl speed is {self.crawl_speed} mm/s which is equal to {self.crawl_speedfreq} Hz')
+        self.seek_speed = 150  # mm/s, homing without any idea where the belt is
+
+        # Switch positions along the belt loop [mm], each ready switch sits
+        # just past the open or closed switch. Only measured if all of them
+        # were given, the defaults are placeholders
+        self.geometry = dict(DEFAULT_GEOMETRY, **(geometry or {}))
+        self.geometry_measured = geometry is not None and set(DEFAULT_GEOMETRY) <= set(geometry)
+        if not self.geometry_measured:
+            logger.info("Switch positions are placeholders, not measured on this can (--calibrate)")
+        self.belt_length = self.geometry["belt_length"]
+        for switch in self.limit_switches:
+            switch.position_mm = self.geometry[switch.position_name]
+        self.switches_by_position = {switch.position_name: switch for switch in self.limit_switches}
+        self.separation_distance = self.gap("ReadyToOpen", "ReadyToClose")  # [mm] of the open move
 
-        self.separation_distance = 390  # [mm]
         _reduction_factor = 1.0
         self.max_speed = 300 * _reduction_factor  # 300 mm/s ~ 45000 Hz
         self.acceleration = 500 * _reduction_factor  # mm/s2
 
-        # time to accelerate
-        _accel_time = self.max_speed / self.acceleration  # [s]
-        # distance covered in accelleration d= Vi*t + 0.5 a * t^2
-        _accel_dist_steps = (0.5 * self.acceleration * _accel_time**2) * self.steps_per_mm  #
-        # So need a ramp that goes from 0 to self.max_speed in_accel_dist_steps
-        # intervals need to be defined as frequencies
-        # assume a smooth ramp
-        _number_of_intervals = 7
-        logger.debug(f'acceleration ramp starting speed is {repr(self.max_speed*self.steps_per_mm / _number_of_intervals)}')
-        logger.debug(f'max acceleration ramp speed is {self.max_speed*self.steps_per_mm}')
-        accel_intervals = np.arange(self.max_speed*self.steps_per_mm / _number_of_intervals,
-                                    self.max_speed*self.steps_per_mm,
-                                    self.max_speed*self.steps_per_mm / _number_of_intervals, dtype=np.int32)
-        accel_steps_per_interval = int(_accel_dist_steps / _number_of_intervals)
-        # Assume deceleration is the reverse of acceleration
-        deccel_intervals = np.arange(self.max_speed*self.steps_per_mm,
-                                     self.crawl_speed*self.steps_per_mm,
-                                     (self.crawl_speed-self.max_speed) * self.steps_per_mm / _number_of_intervals,
-                                     dtype=np.int32)
-
-        ramp_list = []
-        _interval = 0
-        _steps = 0.0
-        _deceleration_start = self.separation_distance*self.steps_per_mm - _accel_dist_steps
-        _steps_at_max_speed = np.int32(1+self.separation_distance * self.steps_per_mm - 2*_accel_dist_steps)
-
-        # Create ramp
-        # Create acceleration
-        for i in accel_intervals:
-            ramp_list.append([i, accel_steps_per_interval])
-        logger.debug(f'ramp list after acceleration is {ramp_list}')
-
-        # Section at max speed
-        ramp_list.append([np.int32(self.max_speed * self.steps_per_mm), _steps_at_max_speed])
-        logger.debug(f'ramp list after max_speed is {repr(ramp_list)}')
-
-        # Decellerate
-        for i in deccel_intervals:
-            ramp_list.append([i, accel_steps_per_interval])
-        logger.debug(f'ramp list after deceleration is {ramp_list}')
+        self.jerk = 5000 * _reduction_factor  # mm/s3, only used by the s-curve profile
+        self.motion_profile = "trapezoidal"  # or "s-curve"
+        self.max_velocity_error = 0.05  # allowed velocity error of a ramp level
+
+        # Profile of every foot switch move, looked up by (from, to) position.
+        # Opening runs as fast as the mechanism tolerates, closing is gentler
+        self.profiles = {
+            ("ReadyToOpen", "ReadyToClose"): Profile(
+                "open", self.separation_distance, self.max_speed, self.acceleration),
+            ("ReadyToClose", "ReadyToOpen"): Profile(
+                "close", self.gap("ReadyToClose", "ReadyToOpen"), 200 * _reduction_factor,
+                300 * _reduction_factor),
+        }
+
+        # Planned ramps are cached on disk under a hash of everything they
+        # depend on, the planner (and numpy) is only loaded to replan
+        self._planner = None
+        self.profile_cache = None if profile_cache is None else ProfileCache(profile_cache)
+        ramps = self.load_ramps()
 
         # Generate ALL the waveforms
-        self.pi.wave_clear()  # Clear any forms in memory (shouldn't be any)
-        self.open_waveform = self.generate_ramp(ramp_list, loop_forever=True)
-        self.crawl_waveform = self.generate_ramp([[self.crawl_speedfreq, 3000]], loop_forever=True)
+        # A backend with a pigpiod shared between cans brings the registry of
+        # its waves, clearing them would pull them from under the other cans
+        self.wave_registry = getattr(self.backend, "wave_registry", None)
+        shared_waves = self.wave_registry is not None
+        if self.wave_registry is None:
+            self.wave_registry = WaveRegistry(self.pi)
+            self.wave_registry.clear()  # Clear any forms in memory (shouldn't be any)
+        # Moves need exact step counts at DMA timing, so always wave chains
+        self.step_driver = WaveChainDriver(self.pi, self.motor.pin_step, self.clock,
+                                           self.wave_registry)
+        self.crawl_waveform = self.generate_ramp(ramps["crawl"], loop_forever=True)
+        self.seek_waveform = self.generate_ramp(ramps["seek"], loop_forever=True)
+        for profile in self.profiles.values():
+            ramp = ramps[profile.name]
+            profile.chain = self.generate_ramp(ramp, loop_forever=True)
+            profile.end_speed = ramp[-1][0] / self.steps_per_mm
+
+        # Dead-reckoned position between switches from the steps sent
+        self.estimator = PositionEstimator(self.steps_per_mm, self.belt_length)
+        # Switch arrivals against the plan: lost steps, stalls within a leg,
+        # and how much faster the belt could be driven
+        self.belt = BeltMonitor(self.steps_per_mm, self.belt_length,
+                                [switch.position_mm for switch in self.limit_switches])
+        self.headroom_every = 100  # moves between headroom reports
+        # An overdue switch only ends the move once the layout it is due by
+        # has been measured, against the placeholders it is only counted
+        self.stop_on_stall = self.geometry_measured
+        # Moves planned from the estimate end their deceleration this far
+        # before the switch and crawl the rest, to absorb estimate error
+        self.estimate_margin = 30  # [mm]
+        self.estimate_plans = {}  # (target, whole mm to go, whole mm/s start) -> chain
+        self.max_estimate_plans = 8
+        # Swap a crawl for a planned move as soon as a switch on the way
+        # makes the position known, without stopping
+        self.splice_crawls = True
+        self.crawling = False
+
+        # Measured on every stop, from the target switch edge to the stop
+        self.arrival_time = None
+        # Held from checking arrival_time to acting on it, so a splice can't
+        # restart the belt after a switch callback stopped it
+        self.arrival_lock = threading.Lock()
+        self.arrival_tick = None  # pigpio tick of the target switch edge, if known
+        self.stopped_remotely = False  # by the stop script, which times the stop itself
+        self.arrival_speed = self.crawl_speed
+        self.stop_latency = None  # [s]
+        self.overshoot = None  # [mm], estimated from the speed at the switch
+
+        # Per-move metrics, written to metrics_path after every move if set
+        self.telemetry = Telemetry()
+        self.metrics_path = metrics_path
+        self.move_start = None  # clock time the current move's chain started
+        self.failed_target = None  # target the last move didn't reach
+        self.chain_checked = None  # clock time pigpiod last answered for the running chain
+        self.calibration = None  # (switch, steps sent) of each arrival while calibrating
+
+        # State used in control loops, only ever woken by switch events
+        self.state = LidStateMachine(self.position_names, clock=self.clock)
+
+        # Open on the PIR seeing someone coming, if there is one
+        self.pre_open = None
+        if self.pins.get("pir") is not None:
+            self.pre_open = PreOpen(self.state, self.clock)
+            self.pi.set_mode(self.pins["pir"], pigpio.INPUT)
+            self.pir_callback = self.pi.callback(self.pins["pir"], pigpio.EITHER_EDGE,
+                                                 self.pir_edge_callback)
+
+        # Reconnect and carry on if pigpiod restarts, where the backend can
+        # open connections and the waves are this can's alone to re-create
+        self.supervisor = None
+        connect = getattr(self.backend, "connect", None)
+        if connect is not None and not shared_waves:
+            self.supervisor = DaemonSupervisor(self, connect)
+
+        self.backend.attach(self)
+
+        # Where the lid is without moving it: on a switch, or where the
+        # journal last saw it
+        self.journal = None if journal_path is None else PositionJournal(journal_path)
+        self.read_switches()
+        if self.position is None and self.journal is not None and self.journal.last is not None:
+            name, position_mm = self.journal.last
+            self.estimator.restore(position_mm)
+            logger.info(f"Journal last saw the belt at {position_mm:.1f} mm ({name or 'between switches'})")
+
+        self.startup_time = time.perf_counter() - start_time
+        logger.info(f"Ready to move {self.startup_time * 1e3:.1f} ms after starting up")
+
+    def gap(self, start, end):
+        """Belt travel [mm] from the switch of position start on to end's"""
+        return (self.switches_by_position[end].position_mm
+                - self.switches_by_position[start].position_mm) % self.belt_length
+
+    def setup_motor_pins(self):
+        # Set up pins as an output
+        self.pi.set_mode(self.motor.pin_direction, pigpio.OUTPUT)
+        self.pi.set_mode(self.motor.pin_step, pigpio.OUTPUT)
+        self.pi.set_mode(self.motor.pin_enable, pigpio.OUTPUT)
+
+        # Enable the drive
+        self.pi.write(self.motor.pin_enable, 1)
+        self.pi.write(self.motor.pin_direction, self.rotation_direction)
 
-        # Variables used in control loops
-        self.position = None
-        self.target_position = None
-        self.target_waveform = self.crawl_waveform
-        self.moving = None
+    def make_planner(self, max_speed, acceleration, start_speed=None, end_speed=None):
+        """Plans every step of a move, starting and ending (unless the speeds
+        are given) at crawl speed so the chain can keep crawling onto the
+        switch, then groups the steps into as few wave levels as the velocity
+        error allows"""
+        from motion_planner import MotionPlanner
+
+        return MotionPlanner(self.steps_per_mm, max_speed, acceleration, jerk=self.jerk,
+                             start_speed=self.crawl_speed if start_speed is None else start_speed,
+                             end_speed=self.crawl_speed if end_speed is None else end_speed)
+
+    @property
+    def planner(self):
+        """Planner at the default max_speed and acceleration"""
+        if self._planner is None:
+            self._planner = self.make_planner(self.max_speed, self.acceleration)
+        return self._planner
+
+    def kinematic_config(self):
+        """Everything the planned ramps depend on"""
+        return {
+            "pulse_per_motor_rev": self.pulse_per_motor_rev,
+            "gearbox_ratio": self.gearbox_ratio,
+            "dist_per_rev": self.dist_per_rev,
+            "max_speed": self.max_speed,
+            "acceleration": self.acceleration,
+            "jerk": self.jerk,
+            "crawl_speed": self.crawl_speed,
+            "seek_speed": self.seek_speed,
+            "separation_distance": self.separation_distance,
+            "profiles": {profile.name: [profile.distance, profile.max_speed, profile.acceleration]
+                         for profile in self.profiles.values()},
+            "motion_profile": self.motion_profile,
+            "max_velocity_error": self.max_velocity_error,
+            "pin_step": self.motor.pin_step,
+            "pin_direction": self.motor.pin_direction,
+        }
+
+    def plan_ramps(self):
+        """[Frequency, Steps] ramps by profile name, plus crawl"""
+        ramps = {"crawl": [[self.crawl_speedfreq, 3000]]}
+        # Speed up from crawl to seek speed, then hold it
+        planner = self.make_planner(self.seek_speed, self.acceleration, end_speed=self.seek_speed)
+        ramps["seek"] = planner.plan_ramp((self.seek_speed**2 - self.crawl_speed**2) / (2 * self.acceleration),
+                                          self.motion_profile, self.max_velocity_error)
+        for profile in self.profiles.values():
+            planner = self.make_planner(profile.max_speed, profile.acceleration)
+            ramps[profile.name] = planner.plan_ramp(profile.distance, self.motion_profile,
+                                                    self.max_velocity_error)
+        return ramps
+
+    def load_ramps(self):
+        """Ramps from the profile cache, planned and cached if missing"""
+        if self.profile_cache is None:
+            return self.plan_ramps()
+        key = config_key(self.kinematic_config())
+        ramps = self.profile_cache.load(key)
+        if ramps is not None:
+            logger.debug(f"Loaded {len(ramps)} ramps from {self.profile_cache.path}")
+            return ramps
+        ramps = self.plan_ramps()
+        self.profile_cache.save(key, ramps)
+        return ramps
+
+    @property
+    def position(self):
+        return self.state.position
+
+    @property
+    def target_position(self):
+        return self.state.target_position
+
+    @property
+    def last_position(self):
+        return self.state.last_position
+
+    @property
+    def moving(self):
+        return self.state.moving
+
+    @property
+    def position_mm(self):
+        """Live estimate of the belt position [mm], None if unknown"""
+        return self.estimator.position_mm(self.clock.time())
+
+    def send_chain(self, chain):
+        self.pi.wave_chain(chain)  # Transmit chain
+        self.start_tracking(chain)
+        self.record_event(CHAIN_START, value=len(chain))
+
+    def start_tracking(self, chain, splice=False):
+        t = self.clock.time()
+        self.estimator.start_chain(chain, t)
+        # Only measured from a position that is more than a lower bound
+        position_mm = None if self.estimator.lower_bound else self.estimator.position_mm(t)
+        if splice:
+            # Keep watching for the same switch, not one the new plan aims at
+            self.belt.splice(chain, t, position_mm)
+        else:
+            self.belt.start(chain, t, position_mm)
+
+    def stop_chain(self):
+        self.pi.wave_tx_stop()
+        self.estimator.stop(self.clock.time())
+        self.belt.stop(self.clock.time())
+        self.record_event(CHAIN_STOP)
+
+    def record_event(self, kind, pin=0, value=0, tick=None):
+        if self.recorder is not None:
+            t = self.clock.time()
+            if tick is None:
+                tick = int(t * 1e6) & TICK_MASK
+            self.recorder.record(kind, pin, value, tick, t)
 
     def switch_pressed_foot_callback(self):
         logger.info("Foot switch triggered")
-        if self.position == "ReadyToClose":
-            self.target_position = "ReadyToOpen"
-            self.target_waveform = self.open_waveform
-        elif self.position == "ReadyToOpen":
-            self.target_position = "ReadyToClose"
-            # TODO: Assume close_waveform is the same as the open_waveform for now
-            self.target_waveform = self.open_waveform
-        else:
-            logger.info(
-                f"Current position [{self.position}] is not"
-                f"appropriate to change target from {self.target_position}"
-            )
+        self.record_event(FOOT, self.switch_foot.pin, 1)
+        if self.pre_open is not None and self.pre_open.foot_pressed():
+            logger.info("Foot press was seen coming, the lid is already open or opening")
+            return
+        self.state.dispatch(FOOT_PRESSED)
+
+    def pir_edge_callback(self, gpio, level, tick):
+        self.record_event(EDGE, gpio, level, tick)
+        self.pre_open.edge(tick)
 
     def switch_pressed_idler_top_callback(self):
         self.arrived(self.switch_idler_top)
@@ -240,97 +538,378 @@ class Garbage:
     def switch_released_motor_bottom_callback(self):
         self.departed(self.switch_motor_bottom)
 
-    def arrived(self, data):
-        logger.info(f"Hello! Arrived at {data.position_name} position, heading to {self.target_position}.")
-        self.position = data.position_name
-
-    def departed(self, data):
-        logger.info(f"Goodbye! Departed from {data.position_name}, , heading to {self.target_position}")
-        self.last_position = data.position_name
-        self.position = None
+    def switch_edge_callback(self, gpio, level, tick):
+        """pigpio callback of the limit switches when fast_stop is set"""
+        switch = self.limit_switches_by_pin[gpio]
+        if level == 1:
+            if self.moving and self.target_position in (None, switch.position_name):
+                # Stop right here in the callback thread
+                with self.arrival_lock:
+                    self.arrival_time = self.clock.time()
+                    self.stop_chain()
+                self.record_stop(((self.pi.get_current_tick() - tick) & TICK_MASK) / 1e6)
+            self.arrived(switch, tick)
+        elif level == 0:
+            self.departed(switch, tick)
+
+    def record_stop(self, latency):
+        self.stop_latency = latency
+        self.overshoot = latency * self.arrival_speed
+        # Switch callbacks log with lazy arguments, the log thread formats them
+        logger.debug('Stopped %.2f ms after the switch edge, overshoot about %.2f mm',
+                     latency * 1e3, self.overshoot)
+
+    def check_chatter(self, switch):
+        tick = int(self.clock.time() * 1e6) & TICK_MASK
+        if switch.edges.add(tick):
+            logger.warning(f"{switch.name} switch is chattering, {switch.edges.threshold} edges "
+                           f"within {switch.edges.window} s")
+
+    def arrived(self, data, tick=None):
+        self.record_event(EDGE, data.pin, 1, tick)
+        self.check_chatter(data)
+        if self.calibration is not None and (not self.calibration or self.calibration[-1][0] is not data):
+            self.calibration.append((data, self.estimator.steps_sent(self.clock.time())))
+        self.belt.arrived(data.position_mm, self.clock.time())
+        self.estimator.rezero(data.position_mm, self.clock.time())
+        if self.moving and self.arrival_time is None:
+            if self.target_position in (None, data.position_name):
+                if tick is None:
+                    # pigpio buttons keep the tick of the edge, gpiozero's don't
+                    tick = getattr(getattr(data, "button", None), "tick", None)
+                with self.arrival_lock:
+                    self.arrival_time = self.clock.time()
+                    self.arrival_tick = tick
+        logger.info("Hello! Arrived at %s position, heading to %s.", data.position_name, self.target_position)
+        self.state.dispatch(ARRIVED, data.position_name)
+
+    def departed(self, data, tick=None):
+        self.record_event(EDGE, data.pin, 0, tick)
+        self.check_chatter(data)
+        if not self.moving:
+            # Pushed by hand, the belt is somewhere past the estimate now
+            self.estimator.lower_bound = True
+        logger.info("Goodbye! Departed from %s, heading to %s", data.position_name, self.target_position)
+        self.state.dispatch(DEPARTED, data.position_name)
+
+    def chains(self):
+        """Every compiled chain held on to"""
+        yield self.crawl_waveform
+        yield self.seek_waveform
+        for profile in self.profiles.values():
+            yield profile.chain
+        yield from self.estimate_plans.values()
+
+    def rebind(self, pi):
+        """Carry on over a new connection to a restarted pigpiod: set the
+        pins, callbacks and stop script up again, and create the waves
+        again with every chain rebuilt from its levels, in place"""
+        self.pi = self.backend.pi = pi
+        self.step_driver.pi = pi
+        self.setup_motor_pins()
+        for switch in self.limit_switches + [self.switch_foot]:
+            if switch.callback is not None:
+                pi.set_mode(switch.pin, pigpio.INPUT)
+                pi.set_pull_up_down(switch.pin, pigpio.PUD_DOWN)
+                switch.callback = pi.callback(switch.pin, pigpio.EITHER_EDGE,
+                                              self.switch_edge_callback)
+            elif hasattr(switch.button, "rebind"):
+                switch.button.rebind(pi)  # gpiozero buttons don't go through pigpiod
+        if self.pre_open is not None:
+            pi.set_mode(self.pins["pir"], pigpio.INPUT)
+            self.pir_callback = pi.callback(self.pins["pir"], pigpio.EITHER_EDGE,
+                                            self.pir_edge_callback)
+        wids = self.wave_registry.recreate(pi)
+        for chain in self.chains():
+            chain.rebuild(wids)
+        if self.stop_script is not None:
+            self.stop_script = StopScript(pi)
+
+    def resume(self, lost_at):
+        """After a pigpiod restart: close the move it cut short and find
+        the lid again, from its last switch or the position estimate.
+        lost_at:  clock time pigpiod was found gone, the chain had stopped by then"""
+        # The move's own clean up ran into the dead connection
+        self.crawling = False
+        if self.moving and self.chain_checked is not None:
+            # The chain ran until some time after pigpiod last answered
+            self.estimator.stop(min(self.chain_checked, lost_at))
+            self.estimator.lower_bound = self.estimator.known
+        else:
+            self.estimator.stop(lost_at)
+        if self.moving:
+            self.state.end_move()
+        self.read_switches()
+        self.record_position()
+        if self.position is None:
+            self.home()
 
     def generate_ramp(self, ramp, loop_forever=False):
         """Generate ramp wave forms.
         ramp:  List of [Frequency, Steps]
         """
-        logger.debug(f'Generating ramp from {ramp}')
-
-        length = len(ramp)  # number of ramp levels
-        wid = [-1] * length
-
-        # Generate a wave per ramp level
-        for i in range(length):
-            frequency = ramp[i][0]
-            micros = int(500000 / frequency)
-            wf = []
-            wf.append(pigpio.pulse(1 << self.motor.pin_step, 0, micros))  # pulse on
-            wf.append(pigpio.pulse(0, 1 << self.motor.pin_step, micros))  # pulse off
-            self.pi.wave_add_generic(wf)
-            wid[i] = self.pi.wave_create()
-
-        # Generate a chain of waves
-        chain = []
-        for i in range(length):
-            steps = ramp[i][1]
-            x = steps & 255
-            y = steps >> 8
-            chain += [255, 0, wid[i], 255, 1, x, y]
-
-        if loop_forever:
-            # loop the last speed forever
-            chain += [255, 0]
-            chain += [255, 0, wid[i], 255, 1, x, y]
-            chain += [255, 3]
-
-        return chain
-
-    def move_to_target(self, waveform=None):
+        return self.step_driver.compile(ramp, loop_forever)
+
+    def plan_from_estimate(self, target_position, start_speed=None):
+        """Chain from the estimated position to a target switch, decelerating
+        to crawl estimate_margin before it. Falls back to crawling when the
+        position is unknown or the move is too short to speed up.
+        start_speed:  speed the belt is already running at [mm/s], crawl if None
+        Returns (chain, end_speed).
+        """
+        crawl = (self.crawl_waveform, self.crawl_speed)
+        position_mm = self.position_mm
+        if position_mm is None:
+            return crawl
+        # After a push by hand the belt may be further along than estimated
+        margin = self.estimate_margin * (2 if self.estimator.lower_bound else 1)
+        target_mm = self.switches_by_position[target_position].position_mm
+        to_go = int((target_mm - position_mm) % self.belt_length - margin)
+        if to_go < margin:
+            return crawl
+
+        start_speed = round(self.crawl_speed if start_speed is None else start_speed)
+        key = (target_position, to_go, start_speed)
+        chain = self.estimate_plans.get(key)
+        if chain is None:
+            if len(self.estimate_plans) >= self.max_estimate_plans:
+                # Forget the oldest plan, its waves stay resident until evicted
+                old = self.estimate_plans.pop(next(iter(self.estimate_plans)))
+                self.wave_registry.release([wid for wid, _ in old.levels])
+            planner = self.planner
+            if start_speed != round(self.crawl_speed):
+                planner = self.make_planner(self.max_speed, self.acceleration, start_speed)
+            ramp = planner.plan_ramp(to_go, self.motion_profile, self.max_velocity_error)
+            chain = self.estimate_plans[key] = self.generate_ramp(ramp, loop_forever=True)
+        logger.info(f"Position estimated at {position_mm:.1f} mm, moving {to_go} mm "
+                    f"at speed before crawling onto {target_position}")
+        return chain, self.crawl_speed
+
+    def splice_chain(self, chain, end_speed=None):
+        """Replace the running chain without stopping. chain should start at
+        the speed the belt runs at now, so the velocity stays continuous."""
+        # wave_chain takes over from the running chain straight away, at
+        # worst cutting one step short, where wave_tx_stop would stop the belt
+        self.pi.wave_chain(chain)
+        self.start_tracking(chain, splice=True)
+        self.record_event(CHAIN_START, value=len(chain))
+        if end_speed is not None:
+            self.arrival_speed = end_speed
+
+    def splice_from_estimate(self, target_position):
+        """Speed a running crawl up into a planned move once the position is
+        known. Returns True if the chain was spliced."""
+        if not self.estimator.known or self.estimator.lower_bound:
+            return False
+        # Only while the estimate is still short of the target. Once past it
+        # (a jam, or a missed switch) the distance wraps round to a whole
+        # lap of the belt, which is no place to go at full speed
+        target_mm = self.switches_by_position[target_position].position_mm
+        to_go = self.estimator.distance_to(target_mm, self.clock.time())
+        if not 0 < to_go < self.belt_length - self.estimate_margin:
+            return False
+        speed = self.estimator.speed(self.clock.time())
+        chain, end_speed = self.plan_from_estimate(target_position, start_speed=speed)
+        if chain is self.crawl_waveform:
+            return False
+        logger.info(f"Splicing a planned move onto the crawl at {speed:.0f} mm/s")
+        self.splice_chain(chain, end_speed)
+        return True
+
+    def move_to_target(self, waveform=None, end_speed=None):
 
         duration = 30
-        timeout = time.time() + duration
-        _speed = None
+        timeout = self.clock.time() + duration
+        # How often the chain is checked while waiting for the arrival event,
+        # the stop script has it covered so check it less often
+        watchdog = 0.25 if self.stop_script is None else 1.0
 
         if waveform == None:
-            _speed = 'crawl'
             waveform = self.crawl_waveform
+            end_speed = self.crawl_speed
 
-        logger.debug(f'Starting move to target {self.target_position} at speed {self.target_waveform}')
+        logger.debug(f'Starting move to target {self.target_position}')
 
-        while self.position != self.target_position:
+        if self.pi.wave_tx_busy():
+            raise SystemError('Waveform currently being transmitted but system is not moving.')
 
-            if time.time() > timeout:
-                self.pi.wave_tx_stop()
-                self.moving = 0
-                raise TimeoutError(f"Did not arrive at target after {duration} seconds.")
-
-            # Already moving?
-            if self.moving == 0:
-                # Send command to move if no waveform moving
-                if not self.pi.wave_tx_busy():
-                    logger.debug('sending movement wavechain')
-                    self.pi.wave_chain(waveform)  # Transmit chain
-                    self.moving = 1
+        target = self.target_position
+        # Press to motion latency only means something for foot switch moves
+        requested_at = self.state.event_time if self.state.target_speed not in (None, "crawl") else None
+        self.move_start = None
+        self.begin_stop_tracking(end_speed)
+        self.state.begin_move()
+        try:
+            if self.position != self.target_position:
+                self.send_chain(waveform)
+                self.move_start = self.chain_checked = self.clock.time()
+                if self.stop_script is not None:
+                    self.stop_script.start(self.switches_by_position[self.target_position].pin)
+            self.crawling = waveform is self.crawl_waveform
+
+            # Sleep until the target switch fires, waking only to verify the
+            # chain, or (while crawling) at any switch on the way, or when
+            # the next switch is overdue
+            while not self.state.wait_for_arrival(
+                    self.watch_time(watchdog), self.state.arrivals if self.crawling else None):
+                if self.state.stopped:
+                    return
+                if self.state.cancelled:
+                    logger.info(f"Move to {self.target_position} cancelled")
+                    return
+                if self.belt.overdue(self.clock.time()):
+                    self.belt.stalls += 1
+                    message = (f"Belt stalled, the switch at {self.belt.expected_mm:.0f} mm "
+                               f"is {self.clock.time() - self.belt.deadline:.2f} s overdue")
+                    if self.stop_on_stall:
+                        raise TimeoutError(message)
+                    logger.warning(f"{message}, carrying on as the switch positions aren't measured")
+                    self.belt.deadline = None  # once per leg, the move's timeout still applies
+                if self.clock.time() > timeout:
+                    raise TimeoutError(f"Did not arrive at target after {duration} seconds.")
+                # Movement should be ongoing (unless a switch callback
+                # already stopped it), so verify wavechain is busy
+                if self.stop_script is not None:
+                    chain_running = self.stop_script.result() != daemon_script.CHAIN_ENDED
                 else:
-                    raise SystemError('Waveform currently being transmitted but system is not moving.')
-            else:
-                # Movement should be ongoing, so verify wavechain is busy
-                if not self.pi.wave_tx_busy():
+                    chain_running = self.pi.wave_tx_busy()
+                self.chain_checked = self.clock.time()
+                if self.arrival_time is None and not chain_running:
                     raise SystemError('System is in motion but wavechain is not running')
-
-                # If here then all is well, so sleep
-                # This shouldn't be necessary
-                sleep(0.01)
-
-        # Exit of while loop, should be at target
-        # stop motion
-        self.pi.wave_tx_stop()
-        self.moving = 0
-        logger.info(f"Target position of {self.target_position} reached.")
-        self.target_position = None
-        self.target_waveform = self.crawl_speed
+                if self.stop_script is None:
+                    # Keep the position estimate on the level pigpiod is sending
+                    self.estimator.correct(self.pi.wave_tx_at(), self.clock.time())
+                if self.crawling and self.splice_crawls:
+                    with self.arrival_lock:
+                        # Not once the target switch has stopped the belt,
+                        # the spliced chain would start it again
+                        stopped = self.arrival_time is not None or (
+                            self.stop_script is not None and self.stop_script.result() == daemon_script.ARRIVED)
+                        if not stopped and self.splice_from_estimate(self.target_position):
+                            self.crawling = False
+            logger.info(f"Target position of {self.target_position} reached.")
+        except TimeoutError:
+            self.telemetry.count("timeouts_total")
+            raise
+        except SystemError:
+            self.telemetry.count("errors_total")
+            raise
+        finally:
+            # stop motion
+            if self.stop_script is not None:
+                self.end_stop_script()
+            self.stop_chain()
+            self.crawling = False
+            self.end_stop_tracking()
+            arrived = self.position == target
+            self.state.end_move()
+            self.record_move(target, arrived, requested_at)
+            self.record_position()
+
+    def watch_time(self, watchdog):
+        """How long to sleep waiting for an arrival: the watchdog period,
+        or less if the next switch is overdue before then"""
+        if self.belt.deadline is None:
+            return watchdog
+        return max(0.0, min(watchdog, self.belt.deadline - self.clock.time()))
+
+    def report_headroom(self):
+        """Log how much faster the belt could be driven, as far as measured"""
+        headroom = self.belt.headroom()
+        if headroom is None:
+            return
+        speed_factor, acceleration_factor, speed, acceleration = headroom
+        logger.info(f"Belt kept up to {speed:.0f} mm/s and {acceleration:.0f} mm/s2 over "
+                    f"{len(self.belt.legs)} legs, {self.belt.slips} slips: max_speed could change "
+                    f"by {speed_factor - 1:+.0%}, acceleration by {acceleration_factor - 1:+.0%}")
+
+    def switch_is_pressed(self, switch):
+        if switch.button is not None:
+            return switch.button.is_pressed
+        return self.pi.read(switch.pin) == 1  # pulled down, pressed is high
+
+    def read_switches(self):
+        """Take the position from a limit switch that is already pressed.
+        Button callbacks only fire on edges, so a lid resting on a switch at
+        startup would otherwise look lost."""
+        if self.position is not None:
+            return
+        pressed = [switch for switch in self.limit_switches if self.switch_is_pressed(switch)]
+        if len(pressed) == 1:
+            logger.info(f"Starting on the {pressed[0].name} switch")
+            self.arrived(pressed[0])
+        elif pressed:
+            logger.warning(f"{len(pressed)} limit switches pressed at once, ignoring them")
+
+    def record_position(self):
+        """Journal where the lid stopped"""
+        if self.journal is not None:
+            self.journal.record(self.position, self.position_mm)
+
+    def record_move(self, target, arrived, requested_at=None):
+        """Add a finished move to the telemetry"""
+        if self.move_start is None:
+            return  # was already there, nothing moved
+        telemetry = self.telemetry
+        telemetry.count("moves_total")
+        if target == self.failed_target:
+            telemetry.count("retries_total")
+        if requested_at is not None:
+            telemetry.observe("foot_to_motion_seconds", self.move_start - requested_at)
+        if arrived:
+            telemetry.count("arrivals_total")
+            self.failed_target = None
+            if self.arrival_time is not None:
+                telemetry.observe("move_seconds", self.arrival_time - self.move_start)
+        else:
+            self.failed_target = target
+        if self.stop_latency is not None:
+            telemetry.observe("stop_latency_seconds", self.stop_latency)
+            telemetry.observe("overshoot_millimeters", self.overshoot)
+        # Measured by the callbacks, copied in here so they never touch the telemetry
+        for lag in self.belt.take_lags():
+            telemetry.observe("belt_lag_millimeters", abs(lag))
+        telemetry.counters["slips_total"].value = self.belt.slips
+        telemetry.counters["stalls_total"].value = self.belt.stalls
+        if telemetry.counters["moves_total"].value % self.headroom_every == 0:
+            self.report_headroom()
+        if self.pre_open is not None:
+            for name in ("moves", "hits", "wasted", "cancelled"):
+                telemetry.counters[f"pre_open_{name}_total"].value = getattr(self.pre_open, name)
+        if self.metrics_path is not None:
+            telemetry.write(self.metrics_path)
+
+    def end_stop_script(self):
+        if self.stop_script.result() != daemon_script.ARRIVED:
+            self.stop_script.stop()
+            return
+        # pigpiod stopped the chain, only its ticks say how long after the edge
+        self.stopped_remotely = True
+        if hasattr(self.backend, "stats"):
+            # The I/O process stopped it from its own switch callback
+            latency_us = self.backend.stats()["stop_latency_us"]
+        elif self.arrival_tick is not None:
+            latency_us = (self.stop_script.halt_tick - self.arrival_tick) & TICK_MASK
+        else:
+            return  # no edge tick to time it from
+        if latency_us >= 0:
+            self.record_stop(latency_us / 1e6)
+
+    def begin_stop_tracking(self, end_speed=None):
+        self.arrival_time = None
+        self.arrival_tick = None
+        self.stopped_remotely = False
+        self.arrival_speed = self.crawl_speed if end_speed is None else end_speed
+        self.stop_latency = None
+        self.overshoot = None
+
+    def end_stop_tracking(self):
+        # A switch callback that stopped the chain has already recorded it
+        if self.stop_latency is None and self.arrival_time is not None and not self.stopped_remotely:
+            self.record_stop(self.clock.time() - self.arrival_time)
 
     def home(self):
-        """ This routine crawls until a switch is hit"""
+        """ This routine moves until a switch is hit, fast then slow"""
 
         # Verify that the position isn't already known
         if self.position != None:
@@ -339,88 +918,150 @@ class Garbage:
 
         logger.info("Homing device")
 
-        duration = 30
-        timeout = time.time() + duration
-
-        # start crawling
-        self.pi.wave_chain(self.crawl_waveform)  # Transmit chain
-        self.moving = 1
-        while self.position == None:
-            if time.time() > timeout:
-                self.pi.wave_tx_stop()
-                self.moving = 0
-                raise TimeoutError("Unable to home device after {duration} seconds.")
-            sleep(0.1)
-
-        # stop motion
-        self.pi.wave_tx_stop()
-        self.moving = 0
+        # Seek fast. Stopping at speed can carry the belt off the switch
+        # again, so then re-approach the next one at crawl
+        self.seek(*self.seek_plan())
+        if self.position is None:
+            logger.info("Overshot the switch, re-approaching at crawl")
+            self.seek(self.crawl_waveform, self.crawl_speed)
         logger.info(f"Homing Completed, found location {self.position}")
 
+    def seek_plan(self):
+        """Chain to find a switch, returns (chain, end_speed).
+        With a journalled position, plan a move to the next switch ahead that
+        crawls onto it, otherwise run at seek speed until any switch."""
+        position_mm = self.position_mm
+        if position_mm is None:
+            return self.seek_waveform, self.seek_speed
+        # Aim past switches too close to plan a move to, the belt may have
+        # just left one, and any switch on the way ends the seek anyway
+        margin = self.estimate_margin * (2 if self.estimator.lower_bound else 1)
+        ahead = min(self.limit_switches,
+                    key=lambda switch: (switch.position_mm - position_mm - 2 * margin) % self.belt_length)
+        return self.plan_from_estimate(ahead.position_name)
+
+    def seek(self, waveform, end_speed):
+        """Run waveform until any switch is reached"""
+        duration = 30
+
+        self.begin_stop_tracking(end_speed)
+        self.state.begin_move()
+        try:
+            self.send_chain(waveform)
+            if not self.state.wait_for_position(duration):
+                self.telemetry.count("timeouts_total")
+                raise TimeoutError(f"Unable to home device after {duration} seconds.")
+        finally:
+            # stop motion
+            self.stop_chain()
+            self.end_stop_tracking()
+            self.state.end_move()
+            self.record_position()
+
+    def calibrate(self):
+        """Measure the switch layout: crawl once round the belt from the first
+        switch reached back onto it, counting the steps sent between switch
+        arrivals. Returns the geometry, to pass to Garbage(geometry=...) on
+        the next start, this one keeps the layout it was started with."""
+        duration = 120  # [s] about two laps at crawl speed
+        count = len(self.limit_switches) + 1
+        self.calibration = []
+        self.begin_stop_tracking()
+        self.state.begin_move()
+        try:
+            self.send_chain(self.crawl_waveform)
+            self.belt.stop()  # it would check against the layout being measured
+            deadline = self.clock.time() + duration
+            while len(self.calibration) < count:
+                if self.clock.time() > deadline:
+                    raise TimeoutError(f"Only reached {len(self.calibration)} switches "
+                                       f"in {duration} seconds of calibrating.")
+                self.state.wait_for_arrivals(self.state.arrivals + 1, deadline - self.clock.time())
+        finally:
+            self.stop_chain()
+            arrivals, self.calibration = self.calibration, None
+            self.end_stop_tracking()
+            self.state.end_move()
+            self.record_position()
+
+        switches = [switch for switch, _ in arrivals]
+        if switches[-1] is not switches[0] or len(set(switches)) != len(self.limit_switches):
+            raise ValueError(f"Switches came in an order that isn't a lap of the belt: "
+                             f"{', '.join(switch.position_name for switch in switches)}")
+        steps = {switch.position_name: s for switch, s in arrivals[:-1]}
+        belt_length = (arrivals[-1][1] - arrivals[0][1]) / self.steps_per_mm
+        geometry = {"belt_length": round(belt_length, 1)}
+        for name in self.position_names:
+            geometry[name] = round((steps[name] - steps["Open"]) / self.steps_per_mm % belt_length, 1)
+        logger.info(f"Measured the switch layout: {geometry}")
+        return geometry
+
+    def move(self, target_position, speed=None):
+        """Ask the monitor loop for a move without waiting for it.
+        speed:  "crawl", or None for the target's profile
+        Returns a MoveCommand, result() is True once the lid arrives.
+        """
+        return self.state.request(target_position, speed)
+
+    def next_move(self, timeout=None):
+        """Wait for a target and pick the chain to get there.
+        Returns (waveform, end_speed) for move_to_target, None if stopped or timed out
+        """
+        # Sleep until a switch or foot event produces a target, or a
+        # pre-open has something to do
+        deadline = None if timeout is None else self.clock.time() + timeout
+        while True:
+            wait = None if deadline is None else max(0.0, deadline - self.clock.time())
+            if self.pre_open is not None:
+                self.pre_open.poll()
+                wake = self.pre_open.wake_time()
+                if wake is not None:
+                    wake = max(0.0, wake - self.clock.time())
+                    wait = wake if wait is None else min(wait, wake)
+            command = self.state.wait_for_target(wait)
+            if command is not None or self.state.stopped or wait is None:
+                break
+            if deadline is not None and self.clock.time() >= deadline:
+                break
+        if command is None:
+            return None
+        target_position, target_speed = command
+        profile = self.profiles.get((self.position, target_position))
+        if target_speed == "crawl" or profile is None:
+            # No need to crawl all the way if we know roughly where we are
+            waveform, end_speed = self.plan_from_estimate(target_position)
+        else:
+            waveform, end_speed = profile.chain, profile.end_speed
+        logger.debug(f"Monitor sending command to move to target {target_position} "
+                     f"at {target_speed} speed")
+        return waveform, end_speed
+
+    def run_once(self, timeout=None):
+        """Wait for a target and move to it. Returns False if stopped or timed out"""
+        move = self.next_move(timeout)
+        if move is None:
+            return False
+        self.move_to_target(*move)
+        return True
+
+    def monitor(self):
+        """Move to targets until stopped, recovering if pigpiod restarts"""
+        heartbeat = None if self.supervisor is None else self.supervisor.heartbeat
+        while True:
+            try:
+                if self.run_once(heartbeat):
+                    continue
+                if self.state.stopped or self.supervisor is None:
+                    return
+                self.supervisor.check()  # idle, nothing else would notice
+            except Exception:
+                if self.supervisor is None or not self.supervisor.check():
+                    raise
+
     def run(self):
-        possible_positions = copy(self.position_names)
-        possible_positions.append(None)
         logger.info("Beginning monitor loop")
-        iter=1
         try:
-            while True:
-                # Evaluate if system is happy but not requiring motion
-                if self.target_position == None and self.position != None:
-                    if iter == 1:
-                        logger.debug(f"Sleeping for 1s. "
-                                     f"Position is {self.position}, target is {self.target_position}")
-                    elif iter >= 10:
-                        iter = 0
-                    
-                    iter += 1 # Note that iter never equals zero
-                    
-                    sleep(0.5)
-
-                # Verify the target name is correct
-                if self.target_position not in possible_positions:
-                    raise ValueError(
-                        f"target position of {self.target_position} is invalid"
-                    )
-
-                # Door is moved manually
-                # potential issue here that door can be moved past two switches
-                # not sure this is possible physically, so will not handle yet
-                if self.position == None and self.target_position == None:
-                    logger.debug("Manual motion detected")
-                    if self.last_position == "Open":
-                        logger.warning("Door moved manually from Open position")
-                        self.target_position = "ReadyToClose"
-                        self.target_waveform = self.crawl_waveform
-                    elif self.last_position == "Closed":
-                        logger.warning("Door moved manually from Closed position")
-                        self.target_position = "ReadyToOpen"
-                        self.target_waveform = self.crawl_waveform
-                    elif self.last_position == "ReadyToClose":
-                        logger.info("Door moved manually from ReadyToClose, closing")
-                        self.target_position = "ReadyToOpen"
-                        self.target_waveform = self.crawl_waveform
-                    elif self.last_position == "ReadyToOpen":
-                        logger.info("Door moved manually from ReadyToOpen, opening")
-                        self.target_position = "ReadyToClose"
-                        self.target_waveform = self.crawl_waveform
-
-                # Verify the system is at a ready to open/close state
-                if self.position == "Open":
-                    logger.info(
-                        "Found at Open position, setting target to ReadyToClose"
-                    )
-                    self.target_position = "ReadyToClose"
-                if self.position == "Closed":
-                    logger.info(
-                        "Found at Closed position, setting target to ReadyToOpen"
-                    )
-                    self.target_position = "ReadyToOpen"
-
-                # Only allow movement if there is a target and it's not already moving
-                if self.target_position != None and self.moving == 0:
-                    logger.debug(f"Monitor sending command to move to target {self.target_position} "
-                                 f"at speed {self.target_waveform}")
-                    self.move_to_target(waveform=self.target_waveform)
+            self.monitor()
 
         except KeyboardInterrupt:
             print("\nCtrl-C pressed.  Stopping PIGPIO and exiting...")
@@ -429,26 +1070,89 @@ class Garbage:
         finally:
             logger.debug('Inside finally')
             self.pi.wave_tx_stop() # gives error
-            self.pi.wave_clear()
+            self.wave_registry.clear()
+            if self.stop_script is not None:
+                self.stop_script.delete()
+            self.telemetry.close()
+            if self.recorder is not None:
+                self.recorder.close()
+            if self.journal is not None:
+                self.journal.close()
             self.pi.stop()
             #garbage.pi.set_PWM_dutycycle(garbage.motor.pin_step, 0)  # PWM off
-            self.moving=0
             sys.exit()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Monitor and automate garbage motion")
-
-    #    args = parser.parse_args()
+    parser.add_argument("--fast-stop", action="store_true",
+                        help="stop the motor from the limit switch callback (pigpio ticks)")
+    parser.add_argument("--daemon-stop", action="store_true",
+                        help="stop the motor from a script running inside pigpiod")
+    parser.add_argument("--no-profile-cache", action="store_true",
+                        help="plan the motion profiles from scratch and don't cache them")
+    parser.add_argument("--metrics-file", metavar="PATH",
+                        help="write Prometheus style move metrics to PATH after every move")
+    parser.add_argument("--pir-pin", type=int, metavar="GPIO",
+                        help="open when the PIR on GPIO sees someone, before the foot switch")
+    parser.add_argument("--pre-open-hold", type=float, default=10.0, metavar="S",
+                        help="close a pre-opened lid again after S seconds without a foot press")
+    parser.add_argument("--pre-open-cancel", type=float, default=2.0, metavar="S",
+                        help="drop a PIR trigger that finds the lid busy for S seconds")
+    parser.add_argument("--queued-logging", action="store_true",
+                        help="log through a queue and a background writer, DEBUG only on errors")
+    parser.add_argument("--log-file", metavar="PATH",
+                        help="where --queued-logging writes to, stderr if not given")
+    parser.add_argument("--rt-process", action="store_true",
+                        help="run the switches and stopping in a real-time child process (rt_io)")
+    parser.add_argument("--reconnect-timeout", type=float, default=30.0, metavar="S",
+                        help="give up if pigpiod is not back S seconds after it went away")
+    parser.add_argument("--record", metavar="PATH",
+                        help="record switch edges, foot presses and chains to PATH for replay.py")
+    parser.add_argument("--metrics-socket", metavar="PATH",
+                        help="serve the move metrics on a Unix socket at PATH")
+    parser.add_argument("--geometry", default=GEOMETRY_PATH, metavar="PATH",
+                        help="switch layout measured by --calibrate, placeholders if there is none")
+    parser.add_argument("--calibrate", action="store_true",
+                        help="crawl a lap of the belt, save the switch layout to --geometry and exit")
+    args = parser.parse_args()
+
+    if args.queued_logging:
+        # Keep formatting and SD card writes off the switch callbacks
+        LogPipeline(path=args.log_file).install()
+
+    backend = None
+    if args.rt_process:
+        from rt_io import RtBackend
+        backend = RtBackend()
 
     # Instantiate the Garbage Class
-    garbage = Garbage()
+    garbage = Garbage(backend=backend, fast_stop=args.fast_stop,
+                      daemon_stop=args.daemon_stop or args.rt_process,
+                      profile_cache=None if args.no_profile_cache else DEFAULT_PATH,
+                      metrics_path=args.metrics_file, recording_path=args.record,
+                      pins=None if args.pir_pin is None else {"pir": args.pir_pin},
+                      geometry=None if args.calibrate else load_geometry(args.geometry))
+    if garbage.pre_open is not None:
+        garbage.pre_open.hold_timeout = args.pre_open_hold
+        garbage.pre_open.cancel_timeout = args.pre_open_cancel
+    if args.metrics_socket:
+        garbage.telemetry.serve(args.metrics_socket)
+    if garbage.supervisor is not None:
+        garbage.supervisor.timeout = args.reconnect_timeout
+
+    if args.calibrate:
+        try:
+            save_geometry(args.geometry, garbage.calibrate())
+            print(f"Saved the switch layout to {args.geometry}")
+        finally:
+            garbage.pi.wave_tx_stop()
+            garbage.pi.stop()
+        sys.exit()
 
     # Where are we?
     if garbage.position == None:
         # Home the device by crawling until a switch is hit
-        
-        # FIXME: This isn't working... homing not stopping when interrupted
         try:
             garbage.home()
         except Exception as e:
@@ -464,11 +1168,8 @@ if __name__ == "__main__":
         finally:
             logger.info("Homing Complete")
 
-    # Move to a ready-to-open or ready-to-close position
-    if garbage.position == ["Open"]:
-        garbage.target_position == ["Ready to Close"]
-    elif garbage.position == ["Closed"]:
-        garbage.target_position == ["Ready to Open"]
+    # Open/Closed positions are moved on to a ready position by the
+    # state machine's transition table once the monitor starts
 
     # Start the monitor
     print("Starting the monitor")
@@ -477,4 +1178,3 @@ if __name__ == "__main__":
     garbage.pi.set_PWM_dutycycle(garbage.motor.pin_step, 0)  # PWM off
     garbage.pi.stop()
     sys.exit()
-cd
\ No newline at end of file
@@ -0,0 +1,115 @@
+import atexit
+from collections import deque
+import logging
+from logging.handlers import QueueHandler
+import queue
+import sys
+import threading
+import time
+
+FORMAT = "%(asctime)s %(levelname)-8s %(message)s"
+DATEFMT = "%Y-%m-%d %H:%M:%S"
+
+_STOP = object()
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Puts records on the queue as they are, formatting is left to the
+    log thread (QueueHandler formats the message in the calling thread).
+    Arguments must not change after the call, they are read later."""
+
+    def prepare(self, record):
+        return record
+
+
+class LogPipeline:
+    """Logging off the control path, for the Pi's SD card.
+
+    Every record is handed to a queue without formatting, which is all the
+    switch callbacks and the control loop pay. A background thread formats
+    and writes the records at or above level in batches, flushing at most
+    every flush_interval seconds. Records below level are kept unformatted
+    in a ring of the last ring_size, and only written when an ERROR comes,
+    to show what led up to it.
+    """
+
+    def __init__(self, stream=None, path=None, level=logging.INFO, ring_size=1000,
+                 flush_interval=1.0):
+        self.file = open(path, "a") if path is not None else (stream or sys.stderr)
+        self.own_file = path is not None
+        self.level = level
+        self.ring = deque(maxlen=ring_size)
+        self.flush_interval = flush_interval  # [s]
+        self.formatter = logging.Formatter(FORMAT, DATEFMT)
+        self.queue = queue.SimpleQueue()
+        self.handler = DeferredQueueHandler(self.queue)
+        self.thread = threading.Thread(target=self._run, daemon=True, name="log")
+        self.written = 0
+        self.dumps = 0
+
+    def install(self):
+        """Replace the root logger's handlers with the queue, logging everything"""
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self.handler)
+        root.setLevel(logging.DEBUG)
+        self.thread.start()
+        atexit.register(self.close)
+        return self
+
+    def _run(self):
+        last_flush = time.monotonic()
+        stopping = False
+        while not stopping:
+            try:
+                record = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                record = None
+            lines = []
+            urgent = False
+            # Take everything queued meanwhile as one batch
+            while record is not None:
+                if record is _STOP:
+                    stopping = True
+                    break
+                urgent |= self._handle(record, lines)
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    record = None
+            try:
+                if lines:
+                    self.file.write("".join(lines))
+                    self.written += len(lines)
+                now = time.monotonic()
+                if urgent or stopping or now - last_flush >= self.flush_interval:
+                    self.file.flush()
+                    last_flush = now
+            except (OSError, ValueError):
+                pass  # nowhere left to say so
+
+    def _handle(self, record, lines):
+        """Adds a record's lines to the batch. Returns True if it is an error"""
+        if record.levelno < self.level:
+            self.ring.append(record)
+            return False
+        if record.levelno >= logging.ERROR and self.ring:
+            lines.append(f"---- last {len(self.ring)} records below "
+                         f"{logging.getLevelName(self.level)} ----\n")
+            lines.extend(self.formatter.format(r) + "\n" for r in self.ring)
+            lines.append("---- end ----\n")
+            self.ring.clear()
+            self.dumps += 1
+        lines.append(self.formatter.format(record) + "\n")
+        return record.levelno >= logging.ERROR
+
+    def close(self):
+        """Write out what is queued and stop the log thread"""
+        if not self.thread.is_alive():
+            return
+        logging.getLogger().removeHandler(self.handler)
+        self.queue.put(_STOP)
+        self.thread.join()
+        if self.own_file:
+            self.file.close()
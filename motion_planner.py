@@ -0,0 +1,187 @@
+import logging
+import math
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+PROFILES = ("trapezoidal", "s-curve")
+WAVE_CLOCK = 500000  # [Hz] wave chain levels step at WAVE_CLOCK / n, n us high then n us low
+
+
+class MotionPlanner:
+    """Per-step timing of a move, quantized into wave levels.
+
+    Velocities are planned as a function of distance travelled so every
+    step gets its own speed: accelerate from start_speed, cruise at
+    max_speed and decelerate so end_speed is reached exactly at the end of
+    the move. The trapezoidal profile is acceleration limited, the s-curve
+    profile is also jerk limited.
+    """
+
+    def __init__(self, steps_per_mm, max_speed, acceleration, jerk=None,
+                 start_speed=0.0, end_speed=0.0):
+        self.steps_per_mm = steps_per_mm
+        self.max_speed = max_speed  # mm/s
+        self.acceleration = acceleration  # mm/s2
+        self.jerk = jerk  # mm/s3
+        self.start_speed = start_speed  # mm/s
+        self.end_speed = end_speed  # mm/s
+
+    def step_velocities(self, distance, profile="trapezoidal"):
+        """Velocity of every step of a move [mm/s].
+        distance:  length of the move [mm]
+        """
+        if profile not in PROFILES:
+            raise ValueError(f"profile of {profile} is invalid, use one of {PROFILES}")
+        if profile == "s-curve" and not self.jerk:
+            raise ValueError("s-curve profile needs a jerk limit")
+
+        n_steps = int(round(distance * self.steps_per_mm))
+        # Velocity is evaluated half way through each step
+        s = (np.arange(n_steps) + 0.5) / self.steps_per_mm
+
+        if profile == "trapezoidal":
+            v_peak = self._trapezoidal_peak(distance)
+            v_accel = np.sqrt(self.start_speed**2 + 2 * self.acceleration * s)
+            v_decel = np.sqrt(self.end_speed**2 + 2 * self.acceleration * (distance - s))
+        else:
+            v_peak = self._s_curve_peak(distance)
+            s_a, v_a = self._s_curve_ramp(self.start_speed, v_peak)
+            s_d, v_d = self._s_curve_ramp(self.end_speed, v_peak)
+            v_accel = np.interp(s, s_a, v_a, right=v_peak)
+            v_decel = np.interp(distance - s, s_d, v_d, right=v_peak)
+
+        return np.minimum(np.minimum(v_accel, v_decel), v_peak)
+
+    def step_times(self, distance, profile="trapezoidal"):
+        """Time each step ends at, from the start of the move [s]"""
+        return np.cumsum(1.0 / (self.step_velocities(distance, profile) * self.steps_per_mm))
+
+    def plan_ramp(self, distance, profile="trapezoidal", max_error=0.05):
+        """Ramp of [Frequency, Steps] levels for generate_ramp"""
+        velocities = self.step_velocities(distance, profile)
+        ramp = quantize(velocities * self.steps_per_mm, max_error)
+        logger.debug(f'{profile} move of {distance} mm planned as {len(ramp)} levels '
+                     f'taking {self.step_times(distance, profile)[-1]:.3f} s')
+        return ramp
+
+    def _trapezoidal_peak(self, distance):
+        # Peak speed where the acceleration and deceleration curves meet
+        v_meet = np.sqrt((2 * self.acceleration * distance
+                          + self.start_speed**2 + self.end_speed**2) / 2)
+        return min(self.max_speed, v_meet)
+
+    def _s_curve_ramp(self, v0, v1, samples=2000):
+        """Distance and velocity along a jerk limited ramp from v0 to v1"""
+        dv = v1 - v0
+        if dv <= 0:
+            return np.array([0.0]), np.array([v1])
+        a_max = self.acceleration
+        j = self.jerk
+        if dv >= a_max**2 / j:
+            t_j = a_max / j
+            t_a = (dv - a_max**2 / j) / a_max
+        else:
+            t_j = np.sqrt(dv / j)
+            a_max = j * t_j
+            t_a = 0.0
+        total = 2 * t_j + t_a
+
+        t = np.linspace(0, total, samples)
+        v = np.where(
+            t < t_j,
+            v0 + 0.5 * j * t**2,
+            np.where(
+                t < t_j + t_a,
+                v0 + 0.5 * j * t_j**2 + a_max * (t - t_j),
+                v1 - 0.5 * j * (total - t) ** 2,
+            ),
+        )
+        s = np.concatenate(([0.0], np.cumsum(0.5 * (v[1:] + v[:-1]) * np.diff(t))))
+        return s, v
+
+    def _s_curve_peak(self, distance):
+        # Bisect for the highest peak speed that fits in the distance
+        def fits(v_peak):
+            s_a, _ = self._s_curve_ramp(self.start_speed, v_peak)
+            s_d, _ = self._s_curve_ramp(self.end_speed, v_peak)
+            return s_a[-1] + s_d[-1] <= distance
+
+        low = max(self.start_speed, self.end_speed)
+        high = self.max_speed
+        if fits(high):
+            return high
+        for _ in range(40):
+            mid = 0.5 * (low + high)
+            if fits(mid):
+                low = mid
+            else:
+                high = mid
+        return low
+
+
+def quantize(frequencies, max_error=0.05, clock=WAVE_CLOCK):
+    """Group consecutive steps into the fewest constant frequency levels.
+    frequencies:  step frequency of every step [Hz]
+    max_error:  largest allowed relative velocity error of any step
+    clock:  levels can only be sent at clock / n Hz for a whole n, the
+        wave chain's whole microsecond half periods. None for any frequency
+    Returns a list of [Frequency, Steps].
+
+    Without a clock a run of steps fits one level if max/min <= (1 + e) / (1 - e);
+    the level then uses the harmonic mean of the extremes. On a clock each
+    level gets the fastest frequency of the grid within the error of its
+    slowest step, and takes every step that frequency is within the error
+    of. Runs are grown greedily on the rising and falling halves of the
+    profile.
+    """
+    frequencies = np.asarray(frequencies, dtype=float)
+    if len(frequencies) == 0:
+        return []
+    ratio = (1 + max_error) / (1 - max_error)
+    peak = int(np.argmax(frequencies))
+
+    def level_frequency(low, high):
+        if clock is None:
+            return 2 * low * high / (low + high)
+        # Fastest on the grid that isn't too fast for the slowest step, or
+        # the nearest if no grid frequency is within the error of it
+        sent = clock / math.ceil(clock / (low * (1 + max_error)) - 1e-9)
+        if sent < low * (1 - max_error):
+            sent = clock / max(1, round(clock / low))
+        return sent
+
+    def rising(f):
+        # [lowest, highest, steps] of each level
+        levels = []
+        start = 0
+        while start < len(f):
+            if clock is None:
+                limit = f[start] * ratio
+            else:
+                limit = level_frequency(f[start], f[start]) / (1 - max_error)
+            end = max(start + 1, int(np.searchsorted(f, limit, side="right")))
+            levels.append([f[start], f[end - 1], end - start])
+            start = end
+        return levels
+
+    def fits(low, high):
+        if clock is None:
+            return high <= low * ratio
+        sent = level_frequency(low, high)
+        return high * (1 - max_error) <= sent <= low * (1 + max_error)
+
+    # np.maximum.accumulate guards against tiny float dips on the rise
+    rise = rising(np.maximum.accumulate(frequencies[:peak + 1]))
+    fall = rising(np.maximum.accumulate(frequencies[peak + 1:][::-1]))[::-1]
+
+    # The last rising and first falling level may be merged at the peak
+    if rise and fall:
+        low = min(rise[-1][0], fall[0][0])
+        high = max(rise[-1][1], fall[0][1])
+        if fits(low, high):
+            rise[-1] = [low, high, rise[-1][2] + fall[0][2]]
+            fall = fall[1:]
+
+    return [[float(level_frequency(low, high)), int(n)] for low, high, n in rise + fall]
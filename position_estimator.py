@@ -0,0 +1,177 @@
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+import logging
+import math
+
+logger = logging.getLogger(__name__)
+
+
+class ChainTimeline:
+    """When each step of a wave chain is sent, from its per-level timing.
+    step_periods:  seconds per step of each level
+    step_counts:  steps of each level, math.inf for a level looping forever
+    durations:  seconds of each level, only needed for delays (no steps)
+
+    Plain lists, a chain has few levels and this runs on every move.
+    """
+
+    def __init__(self, step_periods, step_counts, durations=None):
+        self.periods = [float(p) for p in step_periods]
+        counts = [float(n) for n in step_counts]
+        if durations is None:
+            durations = [p * n for p, n in zip(self.periods, counts)]
+        self.cum_time = [0.0] + list(accumulate(durations))
+        self.cum_steps = [0.0] + list(accumulate(counts))
+        self.total_time = self.cum_time[-1]
+        self.total_steps = self.cum_steps[-1]
+        self._arrays = None
+
+    def level_at(self, t):
+        """Index of the level being sent t seconds after the start"""
+        i = bisect_right(self.cum_time, t) - 1
+        return min(max(i, 0), len(self.periods) - 1)
+
+    def steps_at(self, t):
+        """Steps sent t seconds after the start"""
+        t = min(max(t, 0.0), self.total_time)
+        i = self.level_at(t)
+        steps = self.cum_steps[i]
+        if self.cum_steps[i + 1] > steps:
+            steps += (t - self.cum_time[i]) / self.periods[i]
+        return min(steps, self.cum_steps[i + 1])
+
+    def time_at(self, steps):
+        """Seconds after the start steps is reached, inf if never, one at a time"""
+        if steps > self.total_steps:
+            return math.inf
+        i = min(max(bisect_left(self.cum_steps, steps) - 1, 0), len(self.periods) - 1)
+        return self.cum_time[i] + (steps - self.cum_steps[i]) * self.periods[i]
+
+    def time_at_steps(self, steps):
+        """Seconds after the start each of steps is reached, inf if never"""
+        import numpy as np  # only the simulator asks for many at once
+
+        if self._arrays is None:
+            self._arrays = tuple(np.asarray(a) for a in (self.cum_time, self.cum_steps, self.periods))
+        cum_time, cum_steps, periods = self._arrays
+        steps = np.asarray(steps, dtype=float)
+        # Delay levels make no steps, so a positive count never lands in one
+        i = np.clip(np.searchsorted(cum_steps, steps, side="left") - 1, 0, len(periods) - 1)
+        t = cum_time[i] + (steps - cum_steps[i]) * periods[i]
+        return np.where(steps <= self.total_steps, t, np.inf)
+
+
+def chain_timeline(chain):
+    """ChainTimeline and wave ids of the levels of a chain from generate_ramp"""
+    periods = list(chain.step_periods)
+    counts = [steps for _, steps in chain.levels]
+    wids = [wid for wid, _ in chain.levels]
+    if chain.loop_forever:
+        periods.append(periods[-1])
+        counts.append(math.inf)
+        wids.append(wids[-1])
+    return ChainTimeline(periods, counts), wids
+
+
+class PositionEstimator:
+    """Dead-reckoned belt position between the limit switches.
+
+    The steps sent by the running chain are integrated from its planned
+    per-level timing, so position_mm() is live while moving. Every switch
+    arrival re-zeros the estimate to the switch's position, and
+    correct() can pull the estimate onto the level pigpiod reports with
+    wave_tx_at().
+    """
+
+    def __init__(self, steps_per_mm, belt_length):
+        self.steps_per_mm = steps_per_mm
+        self.belt_length = belt_length  # [mm] belt loop, positions wrap
+        self.base_mm = None  # None while the position is unknown
+        self.lower_bound = False  # True if the belt may be further than the estimate
+
+        self.timeline = None
+        self.wids = None
+        self.chain_start = None  # clock time the chain started
+        self.chain_end = None  # clock time the chain was stopped
+        self.base_steps = 0.0  # steps of the chain at base_mm
+
+    @property
+    def known(self):
+        return self.base_mm is not None
+
+    def start_chain(self, chain, t):
+        """A chain from generate_ramp started transmitting at time t"""
+        self.stop(t)
+        self.timeline, self.wids = chain_timeline(chain)
+        self.chain_start = t
+        self.chain_end = None
+        self.base_steps = 0.0
+
+    def stop(self, t):
+        """Transmission stopped at time t, freeze the estimate there"""
+        if self.timeline is None:
+            return
+        if self.base_mm is not None:
+            self.base_mm = self.position_mm(t)
+        self.timeline = None
+        self.base_steps = 0.0
+
+    def steps_sent(self, t):
+        if self.timeline is None:
+            return 0.0
+        return self.timeline.steps_at(t - self.chain_start)
+
+    def position_mm(self, t):
+        """Estimated belt position at time t [mm], None if unknown"""
+        if self.base_mm is None:
+            return None
+        travelled = (self.steps_sent(t) - self.base_steps) / self.steps_per_mm
+        return (self.base_mm + travelled) % self.belt_length
+
+    def distance_to(self, target_mm, t):
+        """[mm] still to go to target_mm at time t, counted on from the last
+        re-zero without wrapping round the belt, so negative once the
+        estimate has run past it. None if the position is unknown."""
+        if self.base_mm is None:
+            return None
+        travelled = (self.steps_sent(t) - self.base_steps) / self.steps_per_mm
+        return (target_mm - self.base_mm) % self.belt_length - travelled
+
+    def speed(self, t):
+        """Commanded belt speed at time t [mm/s]"""
+        if self.timeline is None or t - self.chain_start >= self.timeline.total_time:
+            return 0.0
+        level = self.timeline.level_at(t - self.chain_start)
+        return 1 / (self.timeline.periods[level] * self.steps_per_mm)
+
+    def rezero(self, position_mm, t):
+        """The belt is known to be at position_mm at time t (a switch edge)"""
+        if self.base_mm is not None:
+            error = (position_mm - self.position_mm(t) + self.belt_length / 2) % self.belt_length
+            logger.debug(f'Position estimate was off by {error - self.belt_length / 2:.2f} mm')
+        self.base_mm = position_mm
+        self.base_steps = self.steps_sent(t)
+        self.lower_bound = False
+
+    def correct(self, wid, t):
+        """Pull the estimate onto a level sending wave wid (from wave_tx_at)"""
+        if self.timeline is None or wid not in self.wids:
+            return
+        elapsed = t - self.chain_start
+        current = self.timeline.level_at(elapsed)
+        if self.wids[current] == wid:
+            return
+        # Levels can share a wave, so take the nearest one sending it
+        level = min((i for i, w in enumerate(self.wids) if w == wid),
+                    key=lambda i: abs(i - current))
+        start = self.timeline.cum_time[level]
+        end = self.timeline.cum_time[level + 1]
+        self.chain_start = t - min(max(elapsed, start), end)
+
+    def restore(self, position_mm):
+        """Start from a remembered position the belt may since have been pushed past"""
+        self.base_mm = position_mm % self.belt_length
+        self.lower_bound = True
+
+    def invalidate(self):
+        self.base_mm = None
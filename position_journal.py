@@ -0,0 +1,103 @@
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".local", "state", "garbage_can", "position.journal")
+
+
+class PositionJournal:
+    """Append-only record of the last known belt position, for fast homing.
+
+    Each record is one line of "position_name position_mm". Records are
+    written (and flushed to the OS) as they come, but the fsync that makes
+    them survive a power cut is batched: a background thread syncs at most
+    every sync_interval seconds, so a burst of moves costs one fsync. Once
+    the file grows past max_bytes it is rewritten with only the last record.
+    """
+
+    def __init__(self, path, sync_interval=2.0, max_bytes=65536):
+        self.path = path
+        self.sync_interval = sync_interval  # [s]
+        self.max_bytes = max_bytes
+        self.last = self.load()
+
+        self.condition = threading.Condition()
+        self.dirty = False
+        self.closed = False
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path, "a")
+        self.thread = threading.Thread(target=self._sync_loop, daemon=True)
+        self.thread.start()
+
+    def load(self):
+        """Last complete record as (position_name, position_mm), or None"""
+        try:
+            with open(self.path) as f:
+                lines = f.read().split("\n")
+        except FileNotFoundError:
+            return None
+        # The last line is empty unless a write was cut short
+        for line in reversed(lines[:-1]):
+            fields = line.split()
+            if len(fields) != 2:
+                continue
+            try:
+                return (None if fields[0] == "-" else fields[0]), float(fields[1])
+            except ValueError:
+                continue
+        return None
+
+    def record(self, position_name, position_mm):
+        """Journal a known position, position_name is None between switches"""
+        if position_mm is None or self.closed:
+            return
+        with self.condition:
+            if self.file.tell() > self.max_bytes:
+                self._compact()
+            self.last = (position_name, position_mm)
+            self.file.write(f"{position_name or '-'} {position_mm:.3f}\n")
+            self.file.flush()
+            self.dirty = True
+            self.condition.notify()
+
+    def _compact(self):
+        temp = f"{self.path}.tmp"
+        with open(temp, "w") as f:
+            name, mm = self.last
+            f.write(f"{name or '-'} {mm:.3f}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.path)
+        self.file.close()
+        self.file = open(self.path, "a")
+
+    def sync(self):
+        with self.condition:
+            if self.dirty and not self.file.closed:
+                os.fsync(self.file.fileno())
+                self.dirty = False
+
+    def _sync_loop(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.dirty or self.closed)
+                if self.closed:
+                    return
+            # Let more records pile up behind this one before paying for a sync
+            time.sleep(self.sync_interval)
+            try:
+                self.sync()
+            except OSError as e:
+                logger.warning(f"Could not sync position journal {self.path}: {e}")
+
+    def close(self):
+        self.sync()
+        with self.condition:
+            self.closed = True
+            self.file.close()
+            self.condition.notify()
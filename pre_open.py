@@ -0,0 +1,116 @@
+import logging
+
+from edge_rate import EdgeRateDetector
+
+logger = logging.getLogger(__name__)
+
+
+class PreOpen:
+    """Opens the lid when the PIR sees someone coming, before the foot switch.
+
+    PIR edges go into an EdgeRateDetector, and once they come fast enough
+    the lid is sent open if it is closed and idle. A trigger while the lid
+    is busy waits up to cancel_timeout for it to settle, after that whoever
+    it saw has gone or used the foot switch. The foot press that follows a
+    pre-open, during the move or the hold_timeout after it, is the one the
+    PIR saw coming and is swallowed. If none comes the lid closes again and
+    the move was wasted.
+
+    Triggers and foot presses come from callback threads, the control loop
+    calls poll() to start pending pre-opens and end holds. Everything runs
+    under the state machine's lock.
+    """
+
+    def __init__(self, state, clock, window=5.0, threshold=100, hold_timeout=10.0,
+                 cancel_timeout=2.0, closed_position="ReadyToOpen", open_position="ReadyToClose"):
+        self.state = state
+        self.clock = clock
+        self.detector = EdgeRateDetector(window=window, threshold=threshold)
+        self.hold_timeout = hold_timeout  # [s] open without a foot press before closing again
+        self.cancel_timeout = cancel_timeout  # [s] a trigger waits this long for an idle lid
+        self.closed_position = closed_position
+        self.open_position = open_position
+
+        self.pending = None  # clock time of a trigger waiting for the lid
+        self.command = None  # MoveCommand of the running pre-open
+        self.absorbed = False  # the running pre-open's foot press came
+        self.hold_end = None  # clock time a held lid closes again
+
+        self.moves = 0  # pre-opens started
+        self.hits = 0  # followed by a foot press
+        self.wasted = 0  # closed again on hold_timeout
+        self.cancelled = 0  # triggers that never found the lid idle and closed
+
+    def edge(self, tick):
+        """PIR edge at tick [us]. Returns True if it triggered"""
+        if not self.detector.add(tick):
+            return False
+        self.detector.reset()
+        with self.state.condition:
+            now = self.clock.time()
+            if self.hold_end is not None:
+                self.hold_end = now + self.hold_timeout  # still there, keep it open
+            elif self.command is None and self.pending is None:
+                self.pending = now
+                self._start(now)
+        return True
+
+    def foot_pressed(self):
+        """Returns True if the press was seen coming and the lid is already opening"""
+        with self.state.condition:
+            if self.command is not None and not self.absorbed:
+                self.absorbed = True
+            elif self.hold_end is not None:
+                self.hold_end = None
+            else:
+                self.pending = None  # the foot got there first
+                return False
+            self.hits += 1
+            return True
+
+    def poll(self):
+        """Start a pending pre-open and close a lid held too long, from the control loop"""
+        with self.state.condition:
+            now = self.clock.time()
+            if self.pending is not None:
+                self._start(now)
+            if self.hold_end is not None and now >= self.hold_end:
+                self.hold_end = None
+                self.wasted += 1
+                if self.state.position == self.open_position and self._idle():
+                    logger.info(f"Nobody used the lid within {self.hold_timeout} s, closing")
+                    self.state.request(self.closed_position)
+
+    def wake_time(self):
+        """Clock time poll() next has something to do, None if nothing"""
+        times = [t for t in (self.hold_end,
+                             None if self.pending is None else self.pending + self.cancel_timeout)
+                 if t is not None]
+        return min(times) if times else None
+
+    def _idle(self):
+        state = self.state
+        return not state.moving and state.target_position is None and not state.queue
+
+    def _start(self, now):
+        if now - self.pending > self.cancel_timeout:
+            logger.debug("Pre-open cancelled, the lid stayed busy")
+            self.pending = None
+            self.cancelled += 1
+            return
+        if not self._idle():
+            return
+        self.pending = None
+        if self.state.position != self.closed_position:
+            return  # open already, or nowhere known
+        logger.info("Someone is coming, opening before the foot switch")
+        self.command = self.state.request(self.open_position)
+        self.absorbed = False
+        self.moves += 1
+        self.command.add_done_callback(self._done)
+
+    def _done(self, command):
+        with self.state.condition:
+            self.command = None
+            if not self.absorbed and not command.cancelled() and command.result():
+                self.hold_end = self.clock.time() + self.hold_timeout
@@ -0,0 +1,59 @@
+import hashlib
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 2  # bump when the meaning of a cached profile changes
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".cache", "garbage_can", "profiles.json")
+
+
+def config_key(config):
+    """Hash of a kinematic config dict, any change to it invalidates the cache"""
+    text = json.dumps({"version": CACHE_VERSION, "config": config}, sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class ProfileCache:
+    """Planned motion profiles kept on disk between starts.
+
+    Planning a ramp is the slow part of starting up, so the [Frequency,
+    Steps] ramps are stored under the hash of the config they were planned
+    from. The waves themselves live in pigpiod and are cleared on every
+    start, so they are always rebuilt from the ramps.
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+
+    def load(self, key):
+        """Ramps by profile name stored for key, or None"""
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable profile cache {self.path}: {e}")
+            return None
+        if not isinstance(data, dict) or data.get("key") != key:
+            logger.info("Profile cache is for another config, replanning")
+            return None
+        return data.get("profiles")
+
+    def save(self, key, profiles):
+        """Store ramps by profile name for key, replacing whatever was cached"""
+        directory = os.path.dirname(self.path)
+        try:
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # Write then rename so a power cut never leaves half a cache
+            temp = f"{self.path}.tmp"
+            with open(temp, "w") as f:
+                json.dump({"key": key, "profiles": profiles}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp, self.path)
+        except OSError as e:
+            logger.warning(f"Could not write profile cache {self.path}: {e}")
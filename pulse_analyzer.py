@@ -0,0 +1,155 @@
+"""Check the pulse trains of the motion profiles against their plan.
+
+generate_ramp sends each level as a wave of round(500000 / frequency) us
+high and low, so a level off that grid steps a little off what was asked
+for. This rebuilds the exact step times from the waves and the chain, and
+measures how far they are from the ramp and from the planner's per step
+profile.
+Profiles whose pulse timing error costs more than a given share of the
+open + close cycle time are flagged, and the exit status is 1 if any are.
+
+    python pulse_analyzer.py [--threshold PERCENT]
+"""
+import argparse
+import logging
+import math
+import sys
+
+import numpy as np
+
+from sim_backend import parse_chain
+
+logger = logging.getLogger(__name__)
+
+
+def wave_edges(pulses, pin):
+    """Rising edge times of pin within a wave and the wave's length [s]"""
+    delays = np.array([pulse.delay for pulse in pulses], dtype=float)
+    starts = np.concatenate(([0.0], np.cumsum(delays)[:-1]))
+    rising = np.array([bool(pulse.gpio_on & (1 << pin)) for pulse in pulses])
+    return starts[rising] / 1e6, delays.sum() / 1e6
+
+
+def step_times(chain, waves, pin, forever=0):
+    """Time of every step a chain sends on pin, from the start of the chain.
+    waves:  pulse list of every wave id in the chain
+    forever:  times a loop forever is taken round
+    Returns (step times [s], time the chain ends [s]).
+    """
+    edges = {wid: wave_edges(pulses, pin) for wid, pulses in waves.items()}
+    t = 0.0
+    parts = []
+    for wid, count in parse_chain(chain):
+        if wid is None:
+            t += count / 1e6  # delay
+            continue
+        if count == math.inf:
+            count = forever
+        offsets, length = edges[wid]
+        parts.append((t + length * np.arange(count)[:, None] + offsets[None, :]).ravel())
+        t += length * count
+    return (np.concatenate(parts) if parts else np.empty(0)), t
+
+
+class PulseAnalysis:
+    """Sent step timing of a ramp compared with what was asked for.
+
+    Step times are when each step starts. Frequencies are per level of the
+    ramp, requested is the level frequency, sent is one over the pulse
+    period pigpiod runs.
+    """
+
+    def __init__(self, name, ramp, chain, waves, pin, planned_times=None):
+        self.name = name
+        frequencies = np.array([f for f, _ in ramp], dtype=float)
+        steps = np.array([n for _, n in ramp], dtype=int)
+
+        self.times, self.move_time = step_times(chain, waves, pin)
+        self.steps = len(self.times)
+        if self.steps != steps.sum():
+            raise ValueError(f"{name} chain sends {self.steps} steps, its ramp {steps.sum()}")
+
+        requested_periods = np.repeat(1.0 / frequencies, steps)
+        self.requested_times = np.concatenate(([0.0], np.cumsum(requested_periods)[:-1]))
+        self.requested_time = requested_periods.sum()
+        self.time_errors = self.times - self.requested_times  # [s] of every step
+
+        # Effective frequency of each level as sent
+        bounds = np.concatenate(([0], np.cumsum(steps)))
+        ends = np.append(self.times, self.move_time)
+        self.requested_frequencies = frequencies
+        self.sent_frequencies = steps / (ends[bounds[1:]] - ends[bounds[:-1]])
+        self.frequency_errors = self.sent_frequencies / frequencies - 1
+
+        # Per step planner profile, if given, as step end times
+        self.planned_time = None if planned_times is None else float(planned_times[-1])
+
+    @property
+    def pulse_error(self):
+        """Move time lost (negative) or gained to whole microsecond pulses [s]"""
+        return self.move_time - self.requested_time
+
+    @property
+    def level_error(self):
+        """Move time lost or gained grouping the planned steps into levels [s]"""
+        return None if self.planned_time is None else self.requested_time - self.planned_time
+
+    def cost(self, cycle_time):
+        """Pulse timing error as a percentage of cycle_time"""
+        return 100 * abs(self.pulse_error) / cycle_time
+
+    def report(self, cycle_time=None):
+        lines = [f"{self.name}: {self.steps} steps in {len(self.requested_frequencies)} levels, "
+                 f"{self.move_time:.4f} s sent, {self.requested_time:.4f} s asked for"
+                 + ("" if self.planned_time is None else f", {self.planned_time:.4f} s planned")]
+        lines.append(f"  pulse timing {self.pulse_error * 1e3:+.2f} ms"
+                     + ("" if cycle_time is None else f" ({self.cost(cycle_time):.3f}% of the cycle)")
+                     + ("" if self.level_error is None else
+                        f", level grouping {self.level_error * 1e3:+.2f} ms"))
+        worst = int(np.argmax(np.abs(self.frequency_errors)))
+        lines.append(f"  worst level {worst} asked {self.requested_frequencies[worst]:.0f} Hz, "
+                     f"sent {self.sent_frequencies[worst]:.0f} Hz ({self.frequency_errors[worst]:+.3%}), "
+                     f"largest step lead {-self.time_errors.min() * 1e3:.2f} ms")
+        return "\n".join(lines)
+
+
+def analyze_profiles(garbage):
+    """PulseAnalysis of every foot switch move profile of a Garbage"""
+    ramps = garbage.load_ramps()
+    waves = garbage.wave_registry.pulses()
+    analyses = []
+    for profile in garbage.profiles.values():
+        planner = garbage.make_planner(profile.max_speed, profile.acceleration)
+        planned = planner.step_times(profile.distance, garbage.motion_profile)
+        # step_times skips the crawl looped forever after the planned ramp
+        analyses.append(PulseAnalysis(profile.name, ramps[profile.name], profile.chain, waves,
+                                      garbage.motor.pin_step, planned))
+    return analyses
+
+
+def main():
+    from garbage import Garbage
+    from sim_backend import SimBackend
+
+    parser = argparse.ArgumentParser(description="Check the motion profile pulse trains")
+    parser.add_argument("--threshold", type=float, default=1.0, metavar="PERCENT",
+                        help="flag profiles whose pulse timing error exceeds PERCENT of the cycle")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    garbage = Garbage(backend=SimBackend(), profile_cache=None, journal_path=None)
+    analyses = analyze_profiles(garbage)
+    cycle_time = sum(analysis.move_time for analysis in analyses)
+    print(f"open + close cycle {cycle_time:.4f} s")
+    flagged = []
+    for analysis in analyses:
+        print(analysis.report(cycle_time))
+        if analysis.cost(cycle_time) > args.threshold:
+            flagged.append(analysis.name)
+    if flagged:
+        print(f"pulse timing error over {args.threshold}% of the cycle: {', '.join(flagged)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import logging
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"GCEV"
+VERSION = 1
+HEADER = struct.Struct("<4sHH")  # magic, version, record size
+# kind, pin, value, pigpio tick [us], clock time [s]
+RECORD = struct.Struct("<BBHId")
+
+# Event kinds, value is the level for EDGE and the chain length for CHAIN_START
+EDGE = 1
+FOOT = 2
+CHAIN_START = 3
+CHAIN_STOP = 4
+KIND_NAMES = {EDGE: "edge", FOOT: "foot", CHAIN_START: "chain_start", CHAIN_STOP: "chain_stop"}
+
+
+class EventRecorder:
+    """Switch edges, foot presses and chain starts/stops, in a binary file.
+
+    Events are packed into a preallocated ring of fixed 16 byte records,
+    which costs a struct.pack_into and no allocation in the callback
+    threads. A background thread appends new records to the file every
+    flush_interval seconds. If more than capacity events arrive between
+    flushes the oldest are lost and counted in dropped.
+    """
+
+    def __init__(self, path, capacity=4096, flush_interval=1.0):
+        self.path = path
+        self.capacity = capacity
+        self.flush_interval = flush_interval  # [s]
+        self.ring = bytearray(capacity * RECORD.size)
+        self.count = 0  # events recorded
+        self.flushed = 0  # events written to the file
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+        self.file = open(path, "wb")
+        self.file.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self.thread.start()
+
+    def record(self, kind, pin=0, value=0, tick=0, time=0.0):
+        with self.lock:
+            RECORD.pack_into(self.ring, (self.count % self.capacity) * RECORD.size,
+                             kind, pin, value, tick, time)
+            self.count += 1
+
+    def flush(self):
+        with self.lock:
+            count = self.count
+            if count - self.flushed > self.capacity:
+                self.dropped += count - self.flushed - self.capacity
+                self.flushed = count - self.capacity
+            start = (self.flushed % self.capacity) * RECORD.size
+            end = (count % self.capacity) * RECORD.size
+            if count == self.flushed:
+                data = b""
+            elif start < end:
+                data = bytes(self.ring[start:end])
+            else:
+                data = bytes(self.ring[start:]) + bytes(self.ring[:end])
+            self.flushed = count
+        if data:
+            self.file.write(data)
+            self.file.flush()
+
+    def _flush_loop(self):
+        while not self.closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not flush event recording {self.path}: {e}")
+
+    def close(self):
+        self.closed.set()
+        self.thread.join()
+        self.flush()
+        self.file.close()
+        if self.dropped:
+            logger.warning(f"Event recording dropped {self.dropped} events, "
+                           f"raise its capacity or flush more often")
+
+
+def read_events(path):
+    """Events of a recording as (kind, pin, value, tick, time) tuples"""
+    with open(path, "rb") as f:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise ValueError(f"{path} is too short for an event recording header")
+        magic, version, size = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION or size != RECORD.size:
+            raise ValueError(f"{path} is not a version {VERSION} event recording")
+        data = f.read()
+    usable = len(data) - len(data) % RECORD.size  # a cut short last record is dropped
+    return list(RECORD.iter_unpack(data[:usable]))
@@ -0,0 +1,126 @@
+"""Replay a recording made with garbage.py --record, faster than real time.
+
+The recorded switch edges and foot presses are fed to a Garbage running on
+the simulated backend's virtual clock, so an hour of field recording takes
+well under a second. The belt doesn't move in a replay, switches only
+change when the recording says they did, so races between the switches
+and the control loop play out exactly as timed in the field. The chains
+the replay sends are compared with the recorded ones.
+
+    python replay.py recording.bin [--out replayed.bin]
+"""
+import argparse
+from functools import partial
+import logging
+import os
+import tempfile
+import time
+
+from garbage import Garbage
+from recorder import read_events, EDGE, FOOT, CHAIN_START, CHAIN_STOP, KIND_NAMES
+from sim_backend import SimBackend
+
+logger = logging.getLogger(__name__)
+
+
+class ReplayBackend(SimBackend):
+    """Simulated backend whose switches follow a recording instead of the belt"""
+
+    def __init__(self, events):
+        super().__init__()
+        self.events = events
+        self.t0 = events[0][4] if events else 0.0  # clock time of the first event
+
+    def attach(self, garbage):
+        self.steps_per_mm = garbage.steps_per_mm
+        self.cycle_length = garbage.belt_length
+        for kind, pin, value, _, t in self.events:
+            if kind == EDGE:
+                self.schedule(t - self.t0, partial(self.set_switch, pin, bool(value)))
+            elif kind == FOOT:
+                self.schedule(t - self.t0, partial(self.press_and_release, pin))
+
+    def press_and_release(self, pin):
+        self.press(pin)
+        self.release(pin)
+
+    def pending(self):
+        return bool(self._events)
+
+
+def outputs(events, t0):
+    """Chain starts and stops of a recording as (kind, value, time from t0)"""
+    return [(kind, value, t - t0) for kind, _, value, _, t in events
+            if kind in (CHAIN_START, CHAIN_STOP)]
+
+
+def replay(events, out_path, **options):
+    """Run Garbage on the recorded inputs, record what it does to out_path.
+    options go to Garbage and should match those of the recording.
+    Returns the replayed events and the wall time taken.
+    """
+    backend = ReplayBackend(events)
+    start = time.perf_counter()
+    garbage = Garbage(backend=backend, profile_cache=None, journal_path=None,
+                      recording_path=out_path, **options)
+    backend.run_until(0.0)  # Switches pressed when the recording started
+    try:
+        if garbage.position is None:
+            garbage.home()
+        while backend.pending():
+            garbage.run_once(timeout=1.0)
+    finally:
+        garbage.recorder.close()
+    return read_events(out_path), time.perf_counter() - start
+
+
+def compare(recorded, replayed, tolerance=0.01):
+    """Print where the replayed chain starts/stops part from the recorded ones.
+    Returns the number of differences.
+    """
+    differences = 0
+    for i in range(max(len(recorded), len(replayed))):
+        a = recorded[i] if i < len(recorded) else None
+        b = replayed[i] if i < len(replayed) else None
+        if a is not None and b is not None and a[:2] == b[:2] and abs(a[2] - b[2]) <= tolerance:
+            continue
+        differences += 1
+        describe = lambda o: "-" if o is None else f"{KIND_NAMES[o[0]]} {o[1]} at {o[2]:.4f} s"
+        print(f"  {i:4d}  recorded {describe(a):32s} replayed {describe(b)}")
+    return differences
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a garbage can event recording")
+    parser.add_argument("recording", help="file written by garbage.py --record")
+    parser.add_argument("--out", metavar="PATH", help="where to record the replay")
+    parser.add_argument("--fast-stop", action="store_true", help="as recorded with --fast-stop")
+    parser.add_argument("--daemon-stop", action="store_true", help="as recorded with --daemon-stop")
+    parser.add_argument("--pir-pin", type=int, metavar="GPIO", help="as recorded with --pir-pin")
+    parser.add_argument("--tolerance", type=float, default=0.01,
+                        help="largest chain timing difference to ignore [s]")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    events = read_events(args.recording)
+    if not events:
+        print(f"{args.recording} has no events")
+        return
+    with tempfile.TemporaryDirectory() as directory:
+        out_path = args.out or os.path.join(directory, "replayed.bin")
+        replayed, wall = replay(events, out_path, fast_stop=args.fast_stop,
+                                daemon_stop=args.daemon_stop,
+                                pins=None if args.pir_pin is None else {"pir": args.pir_pin})
+
+    duration = events[-1][4] - events[0][4]
+    kinds = {name: sum(1 for e in events if e[0] == kind) for kind, name in KIND_NAMES.items()}
+    print(f"replayed {len(events)} events ({', '.join(f'{n} {k}' for k, n in kinds.items())})")
+    print(f"  {duration:.2f} s recorded in {wall:.3f} s, {duration / max(wall, 1e-9):.0f}x real time")
+    recorded_outputs = outputs(events, events[0][4])
+    replayed_outputs = outputs(replayed, 0.0)
+    differences = compare(recorded_outputs, replayed_outputs, args.tolerance)
+    print(f"  {len(recorded_outputs)} recorded chain starts/stops, {differences} differ")
+
+
+if __name__ == "__main__":
+    main()
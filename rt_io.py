@@ -0,0 +1,428 @@
+"""Switch I/O and stopping in a process of its own.
+
+Garbage shares one GIL between the switch callbacks, numpy planning, the
+control loop and logging, so any of them can hold up the stop on the
+target switch. RtBackend moves the time critical part into a small child
+process: it owns the transmit and stop calls and the switch callbacks,
+runs SCHED_FIFO on its own CPU where allowed, and stops the chain on the
+target switch itself. Garbage stays in the supervisor process and talks
+to it through two pipes, so neither side ever takes a lock the other
+holds:
+- commands to the I/O process
+- switch edges and snapshots of its state back
+If the supervisor dies the I/O process stops the chain and exits, if the
+I/O process dies the supervisor's next command raises ConnectionError.
+
+Use it with daemon_stop, the I/O process stands in for pigpiod's stop
+script:
+
+    Garbage(backend=RtBackend(), daemon_stop=True)
+"""
+import functools
+import gc
+import logging
+import multiprocessing
+import os
+import select
+import struct
+import threading
+import time
+
+import pigpio
+
+from backend import RealClock, PigpioButton
+import daemon_script
+from edge_rate import TICK_MASK
+
+logger = logging.getLogger(__name__)
+
+# Commands to the I/O process
+CHAIN = 1  # data: chain bytes
+STOP = 2
+WATCH = 3  # pin: switch to report edges of
+UNWATCH = 4
+ARM = 5  # pin: stop the chain when it goes high, value: arm id
+DISARM = 6
+PING = 7  # time: perf_counter when sent, for the command latency
+QUIT = 8
+# Events from the I/O process
+EDGE = 1  # pin, arg: level, value: tick
+STATE = 2  # data: State snapshot
+
+MAX_DATA = 600  # a whole wave chain
+
+
+class Channel:
+    """One way pipe of fixed size records between the two processes.
+
+    Records are shorter than PIPE_BUF, so every write lands whole and in
+    order, even from several threads, and the kernel orders the memory on
+    both sides, which plain stores to shared memory don't get on the Pi's
+    ARM cores. Both ends are non-blocking: a full pipe refuses the record
+    rather than stalling the I/O process. A pipe whose other process
+    exited raises BrokenPipeError on push and EOFError on pop.
+    """
+
+    def __init__(self, data_size=0):
+        self.record = struct.Struct(f"<BBHqdH{data_size}s")  # kind, pin, arg, value, time, length, data
+        if self.record.size > select.PIPE_BUF:
+            raise ValueError(f"{self.record.size} byte records would not be written atomically")
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.read_fd, False)
+        os.set_blocking(self.write_fd, False)
+
+    def push(self, kind, pin=0, arg=0, value=0, time=0.0, data=b""):
+        """Returns False if the pipe is full"""
+        try:
+            os.write(self.write_fd, self.record.pack(kind, pin, arg, value, time, len(data), bytes(data)))
+        except BlockingIOError:
+            return False
+        return True
+
+    def pop(self):
+        """(kind, pin, arg, value, time, data) of the oldest record, None if empty"""
+        try:
+            record = os.read(self.read_fd, self.record.size)
+        except BlockingIOError:
+            return None
+        if not record:
+            raise EOFError("the other end of the channel has closed")
+        kind, pin, arg, value, t, length, data = self.record.unpack(record)
+        return kind, pin, arg, value, t, data[:length]
+
+    def wait(self, timeout):
+        """Wait up to timeout [s] for a record to pop"""
+        select.select([self.read_fd], [], [], timeout)
+
+    def keep_reader(self):
+        """In the reading process, once forked"""
+        os.close(self.write_fd)
+
+    def keep_writer(self):
+        """In the writing process, once forked"""
+        os.close(self.read_fd)
+
+    def close(self):
+        for fd in (self.read_fd, self.write_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass  # closed when forked
+
+
+class State:
+    """State of the I/O process. Every update sends a whole snapshot back,
+    so one refused by a full pipe is made good by the next"""
+
+    FIELDS = ("armed_pin", "arm_id", "result", "stops", "stop_latency_us", "max_stop_latency_us",
+              "loops", "max_late_us", "commands", "max_command_us", "heartbeat")
+    LAYOUT = struct.Struct("<10qd")
+
+    def __init__(self, events):
+        self.events = events
+        self.values = self.initial()
+        self.lock = threading.Lock()  # writers within the I/O process
+
+    @classmethod
+    def initial(cls):
+        values = dict.fromkeys(cls.FIELDS, 0)
+        values["armed_pin"] = -1
+        return values
+
+    @classmethod
+    def unpack(cls, data):
+        return dict(zip(cls.FIELDS, cls.LAYOUT.unpack(data)))
+
+    def update(self, **fields):
+        with self.lock:
+            self.values.update(fields)
+            self.events.push(STATE, data=self.LAYOUT.pack(*(self.values[name] for name in self.FIELDS)))
+
+
+class IoServer:
+    """The I/O process: sends chains, reports switch edges, stops on the armed switch"""
+
+    def __init__(self, commands, events, pi, poll=0.0005):
+        self.commands = commands
+        self.events = events
+        self.state = State(events)
+        self.pi = pi
+        self.poll = poll  # [s] command and chain end polling interval
+        self.callbacks = {}
+        self.armed_pin = -1
+        self.stops = 0
+        self.max_stop_latency_us = 0
+
+    def serve(self):
+        loops = 0
+        max_late_us = 0
+        commands = 0
+        max_command_us = 0
+        next_time = time.perf_counter()
+        while True:
+            now = time.perf_counter()
+            late_us = int((now - next_time) * 1e6)
+            max_late_us = max(max_late_us, late_us)
+            loops += 1
+            while True:
+                try:
+                    command = self.commands.pop()
+                except EOFError:
+                    # The supervisor is gone, nothing would stop the chain
+                    self.pi.wave_tx_stop()
+                    return
+                if command is None:
+                    break
+                kind, pin, arg, value, sent, data = command
+                commands += 1
+                if sent:
+                    max_command_us = max(max_command_us, int((time.perf_counter() - sent) * 1e6))
+                if kind == QUIT:
+                    self.pi.wave_tx_stop()
+                    return
+                self.handle(kind, pin, arg, value, data)
+            if self.armed_pin >= 0 and not self.pi.wave_tx_busy():
+                self.disarm(daemon_script.CHAIN_ENDED)
+            if loops % 64 == 0:
+                self.state.update(loops=loops, max_late_us=max_late_us, commands=commands,
+                                  max_command_us=max_command_us, heartbeat=time.perf_counter())
+            next_time += self.poll
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_time = time.perf_counter()  # fell behind, don't try to catch up
+
+    def handle(self, kind, pin, arg, value, data):
+        if kind == CHAIN:
+            self.pi.wave_chain(list(data))
+        elif kind == STOP:
+            self.pi.wave_tx_stop()
+        elif kind == WATCH:
+            if pin not in self.callbacks:
+                self.callbacks[pin] = self.pi.callback(pin, pigpio.EITHER_EDGE, self.edge)
+        elif kind == UNWATCH:
+            callback = self.callbacks.pop(pin, None)
+            if callback is not None:
+                callback.cancel()
+        elif kind == ARM:
+            self.armed_pin = pin
+            self.state.update(armed_pin=pin, arm_id=value, result=daemon_script.RUNNING)
+            if self.pi.read(pin):
+                self.stop_on(pin, None)
+        elif kind == DISARM:
+            self.disarm(daemon_script.RUNNING)
+
+    def disarm(self, result):
+        self.armed_pin = -1
+        self.state.update(armed_pin=-1, result=result)
+
+    def edge(self, gpio, level, tick):
+        """pigpio callback, stops first and reports after"""
+        if level == 1 and gpio == self.armed_pin:
+            self.stop_on(gpio, tick)
+        if level in (0, 1):
+            self.events.push(EDGE, gpio, level, tick)
+
+    def stop_on(self, pin, tick):
+        self.pi.wave_tx_stop()
+        self.armed_pin = -1
+        # -1 if the switch was already pressed when armed, no edge to time from
+        latency_us = -1 if tick is None else (self.pi.get_current_tick() - tick) & TICK_MASK
+        self.stops += 1
+        self.max_stop_latency_us = max(self.max_stop_latency_us, latency_us)
+        self.state.update(armed_pin=-1, result=daemon_script.ARRIVED, stops=self.stops,
+                          stop_latency_us=latency_us, max_stop_latency_us=self.max_stop_latency_us)
+
+
+def realtime(cpu=None, priority=50):
+    """Pin the calling process to cpu and make it SCHED_FIFO, as far as allowed"""
+    if cpu is not None:
+        try:
+            os.sched_setaffinity(0, {cpu})
+        except (AttributeError, OSError) as e:
+            logger.warning(f"Could not pin the I/O process to CPU {cpu}: {e}")
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        return True
+    except (AttributeError, OSError) as e:
+        logger.warning(f"I/O process runs at normal priority, no SCHED_FIFO: {e}")
+        return False
+
+
+def io_main(commands, events, connect, poll, cpu, priority):
+    """Entry point of the I/O process"""
+    commands.keep_reader()
+    events.keep_writer()
+    realtime(cpu, priority)
+    # Nothing allocated in the loop needs collecting, so no collector pauses
+    gc.freeze()
+    gc.disable()
+    pi = connect()
+    IoServer(commands, events, pi, poll).serve()
+    pi.stop()
+
+
+class IoPi:
+    """pigpio.pi of the supervisor: waves and reads over its own pigpiod
+    connection, transmit, stop and switch callbacks through the I/O process,
+    and the stop script emulated by it"""
+
+    def __init__(self, pi, backend):
+        self._pi = pi
+        self.backend = backend
+        self.arm_id = 0
+
+    def __getattr__(self, name):
+        return getattr(self._pi, name)
+
+    def _send(self, kind, pin=0, arg=0, value=0, data=b""):
+        """Raises ConnectionError if the I/O process is gone or stopped taking
+        commands, nothing else would ever stop the chain"""
+        self.backend.check()
+        deadline = time.perf_counter() + self.backend.command_timeout
+        while not self.backend.push(kind, pin, arg, value, time.perf_counter(), data):
+            # The I/O process is behind, it drains fast if it is still there
+            self.backend.check()
+            if time.perf_counter() > deadline:
+                raise ConnectionError(f"I/O process took no commands for {self.backend.command_timeout} s")
+            time.sleep(self.backend.poll)
+
+    def wave_chain(self, data):
+        self._send(CHAIN, data=bytes(data))
+
+    def wave_tx_stop(self):
+        self._send(STOP)
+
+    def callback(self, user_gpio, edge=pigpio.RISING_EDGE, func=None):
+        return self.backend.watch(user_gpio, edge, func)
+
+    def stop(self):
+        self.backend.close()
+
+    # daemon_script.StopScript, run by the I/O process
+    def store_script(self, script):
+        return 0
+
+    def run_script(self, script_id, params=None):
+        self.arm_id += 1
+        self._send(ARM, pin=params[0], value=self.arm_id)
+
+    def script_status(self, script_id):
+        state = self.backend.stats()
+        if state["arm_id"] != self.arm_id or state["armed_pin"] >= 0:
+            return pigpio.PI_SCRIPT_RUNNING, [0] * 10
+        return pigpio.PI_SCRIPT_HALTED, [0] * 9 + [state["result"]]
+
+    def stop_script(self, script_id):
+        self._send(DISARM)
+
+    def delete_script(self, script_id):
+        pass
+
+
+class IoCallback:
+    def __init__(self, backend, gpio, edge, func):
+        self.backend = backend
+        self.gpio = gpio
+        self.edge = edge
+        self.func = func
+
+    def cancel(self):
+        self.backend.unwatch(self)
+
+
+class RtBackend:
+    """Garbage backend with switch I/O and stopping in a real-time child process.
+    connect:  makes the I/O process's pigpio.pi, pigpiod on host:port if None
+    cpu, priority:  CPU and SCHED_FIFO priority of the I/O process
+    command_timeout:  [s] a full command pipe may take to drain before the
+        I/O process counts as hung
+    """
+
+    def __init__(self, host="localhost", port=8888, connect=None, cpu=None, priority=50,
+                 poll=0.0005, command_timeout=1.0):
+        connect = connect or functools.partial(pigpio.pi, host, port)
+        self.poll = poll  # [s]
+        self.command_timeout = command_timeout
+        self.commands = Channel(MAX_DATA)
+        self.events = Channel(State.LAYOUT.size)
+        self.state = State.initial()  # nothing armed until the I/O process says so
+        # Forked so the child inherits the pipes
+        self.process = multiprocessing.get_context("fork").Process(
+            target=io_main, args=(self.commands, self.events, connect, poll, cpu, priority),
+            name="garbage-io", daemon=True)
+        self.process.start()
+        # Only the I/O process's own ends left open, so either side sees the other exit
+        self.commands.keep_writer()
+        self.events.keep_reader()
+
+        self.pi = IoPi(connect(), self)
+        self.clock = RealClock()
+        self.callbacks = {}  # pin -> [IoCallback]
+        self.closed = threading.Event()
+        self.reader = threading.Thread(target=self._read_events, daemon=True, name="io-events")
+        self.reader.start()
+
+    def button(self, pin, pull_up):
+        return PigpioButton(self.pi, pin, pull_up)
+
+    def attach(self, garbage):
+        pass
+
+    def watch(self, gpio, edge, func):
+        callback = IoCallback(self, gpio, edge, func)
+        if gpio not in self.callbacks:
+            self.callbacks[gpio] = []
+            self.pi._send(WATCH, pin=gpio)
+        self.callbacks[gpio].append(callback)
+        return callback
+
+    def unwatch(self, callback):
+        callbacks = self.callbacks.get(callback.gpio, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+        if not callbacks and self.callbacks.pop(callback.gpio, None) is not None:
+            self.pi._send(UNWATCH, pin=callback.gpio)
+
+    def push(self, kind, pin=0, arg=0, value=0, time=0.0, data=b""):
+        """Command to the I/O process. Returns False if the pipe is full"""
+        return self.commands.push(kind, pin, arg, value, time, data)
+
+    def _read_events(self):
+        while not self.closed.is_set():
+            try:
+                event = self.events.pop()
+            except EOFError:
+                return  # the I/O process exited, check() reports it
+            if event is None:
+                self.events.wait(0.1)
+                continue
+            kind, gpio, level, tick, _, data = event
+            if kind == STATE:
+                self.state = State.unpack(data)
+                continue
+            for callback in list(self.callbacks.get(gpio, [])):
+                if (callback.edge == pigpio.EITHER_EDGE
+                        or (callback.edge == pigpio.RISING_EDGE) == bool(level)):
+                    callback.func(gpio, level, tick)
+
+    def check(self):
+        """Raises ConnectionError if the I/O process has exited"""
+        if not self.process.is_alive():
+            raise ConnectionError(f"I/O process exited with code {self.process.exitcode}")
+
+    def stats(self):
+        """Latest state of the I/O process as a dict"""
+        self.check()
+        return self.state
+
+    def close(self):
+        if self.process.is_alive():
+            self.pi._send(QUIT)
+        self.process.join(5)
+        self.closed.set()
+        self.reader.join()
+        self.pi._pi.stop()
+        self.commands.close()
+        self.events.close()
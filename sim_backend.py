@@ -0,0 +1,602 @@
+"""In-process simulation of pigpiod, the limit switches and the belt.
+
+Time is virtual: whenever the control code waits, the clock jumps straight
+to the next switch edge (or scheduled event) instead of sleeping, so open
+and close cycles run as fast as Python can execute them.
+
+    backend = SimBackend(start_mm=30)
+    garbage = Garbage(backend=backend)
+"""
+import functools
+import heapq
+import math
+
+import numpy as np
+import pigpio
+
+from chain_compiler import LOOP_START, LOOP_REPEAT, LOOP_FOREVER
+import daemon_script
+from position_estimator import ChainTimeline
+
+# Delay command of a wave chain, 255 2 x y
+LOOP_DELAY = [255, 2]
+# Distance below which the belt counts as sitting on a switch edge [mm]
+EDGE_TOLERANCE = 1e-6
+
+
+def parse_chain(chain):
+    """Flatten a wave chain into [wave id, count] runs.
+    A delay is returned as [None, microseconds] and loop forever as a
+    count of math.inf. Only single wave loop bodies can loop forever.
+    """
+    stack = [[]]
+    i = 0
+    while i < len(chain):
+        if chain[i] == 255 and i + 1 < len(chain):
+            command = chain[i:i + 2]
+            if command == LOOP_START:
+                stack.append([])
+                i += 2
+            elif command == LOOP_REPEAT:
+                count = chain[i + 2] + 256 * chain[i + 3]
+                body = stack.pop()
+                stack[-1] += _repeat(body, count)
+                i += 4
+            elif command == LOOP_FOREVER:
+                body = stack.pop()
+                stack[-1] += _repeat(body, math.inf)
+                i += 2
+            elif command == LOOP_DELAY:
+                stack[-1].append([None, chain[i + 2] + 256 * chain[i + 3]])
+                i += 4
+            else:
+                raise ValueError(f"Unknown chain command {command}")
+        else:
+            _append(stack[-1], chain[i], 1)
+            i += 1
+    if len(stack) != 1:
+        raise ValueError("Chain has an unterminated loop")
+    return stack[0]
+
+
+def _append(runs, wid, count):
+    if runs and runs[-1][0] == wid and wid is not None:
+        runs[-1][1] += count
+    else:
+        runs.append([wid, count])
+
+
+def _repeat(body, count):
+    if len(body) == 1 and body[0][0] is not None:
+        return [[body[0][0], body[0][1] * count]]
+    if count == math.inf:
+        raise ValueError("Only a single wave can loop forever in the simulator")
+    runs = []
+    for _ in range(count):
+        for wid, n in body:
+            _append(runs, wid, n)
+    return runs
+
+
+class SimClock:
+    """Virtual clock, waiting runs the simulation up to the next event"""
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def wait_for(self, condition, predicate, timeout=None):
+        deadline = None if timeout is None else self.now + timeout
+        result = predicate()
+        while not result:
+            if not self.sim.run_next_event(deadline):
+                if deadline is not None:
+                    self.now = max(self.now, deadline)
+                break
+            result = predicate()
+        return result
+
+    def sleep(self, seconds):
+        self.sim.run_until(self.now + seconds)
+
+
+class SimButton:
+    """Stands in for gpiozero.Button, driven by the simulator"""
+
+    def __init__(self, pin, pull_up):
+        self.pin = pin
+        self.pull_up = pull_up
+        self.is_pressed = False
+        self.when_pressed = None
+        self.when_released = None
+        self.tick = None  # of the last edge, as backend.PigpioButton
+
+    def _set(self, pressed, tick=None):
+        if pressed == self.is_pressed:
+            return
+        self.is_pressed = pressed
+        self.tick = tick
+        callback = self.when_pressed if pressed else self.when_released
+        if callback is not None:
+            callback()
+
+
+class SimCallback:
+    """Returned by SimPi.callback, like pigpio's _callback"""
+
+    def __init__(self, sim, gpio, edge, func):
+        self.sim = sim
+        self.gpio = gpio
+        self.edge = edge
+        self.func = func
+
+    def cancel(self):
+        self.sim.callbacks[self.gpio].remove(self)
+
+
+def _daemon(method):
+    """Raise as pigpio does on a connection whose pigpiod has gone"""
+    @functools.wraps(method)
+    def call(self, *args, **kwargs):
+        if not self.connected:
+            raise ConnectionResetError(f"{method.__name__}: pigpiod connection lost")
+        return method(self, *args, **kwargs)
+
+    return call
+
+
+class SimPi:
+    """The parts of pigpio.pi used by Garbage, with wave playback on the
+    virtual clock of the simulator it belongs to."""
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.connected = True
+        self.levels = {}
+        self.modes = {}
+        self.pwm = {}  # gpio -> hardware PWM (frequency, duty)
+
+        self.waves = {}  # wid -> step period [s]
+        self._pulses = []
+        self._next_wid = 0
+        self._parsed = {}  # chain -> runs, chains are sent again and again
+        self.chains_sent = 0
+        self.scripts = []
+
+    # GPIO
+    @_daemon
+    def set_mode(self, gpio, mode):
+        self.modes[gpio] = mode
+
+    @_daemon
+    def write(self, gpio, level):
+        self.levels[gpio] = level
+
+    @_daemon
+    def read(self, gpio):
+        if gpio in self.sim.pressed:
+            return self.sim.level(gpio)
+        return self.levels.get(gpio, 0)
+
+    @_daemon
+    def set_pull_up_down(self, gpio, pud):
+        self.sim.pulls[gpio] = pud == pigpio.PUD_UP
+
+    @_daemon
+    def callback(self, user_gpio, edge=pigpio.RISING_EDGE, func=None):
+        callback = SimCallback(self.sim, user_gpio, edge, func)
+        self.sim.callbacks.setdefault(user_gpio, []).append(callback)
+        return callback
+
+    @_daemon
+    def set_PWM_dutycycle(self, gpio, dutycycle):
+        pass
+
+    @_daemon
+    def hardware_PWM(self, gpio, PWMfreq, PWMduty):
+        """Recorded only, the belt doesn't follow PWM steps"""
+        self.pwm[gpio] = (PWMfreq, PWMduty)
+
+    @_daemon
+    def get_PWM_frequency(self, user_gpio):
+        frequency, _ = self.pwm.get(user_gpio, (0, 0))
+        if not frequency:
+            return 0
+        # pigpiod divides a 250 MHz clock
+        return int(round(250e6 / round(250e6 / frequency)))
+
+    @_daemon
+    def get_current_tick(self):
+        return int(self.sim.clock.now * 1e6) & 0xFFFFFFFF
+
+    def stop(self):
+        self.connected = False
+
+    # Waves
+    @_daemon
+    def wave_clear(self):
+        self.sim.stop_motion()
+        self.waves.clear()
+        self._parsed.clear()
+        self._pulses = []
+        self._next_wid = 0
+
+    @_daemon
+    def wave_add_generic(self, pulses):
+        self._pulses += pulses
+        return len(self._pulses)
+
+    @_daemon
+    def wave_create(self):
+        if not self._pulses:
+            raise pigpio.error("'attempt to create an empty waveform'")
+        wid = self._next_wid
+        self._next_wid += 1
+        self.waves[wid] = sum(p.delay for p in self._pulses) / 1e6
+        self._pulses = []
+        return wid
+
+    @_daemon
+    def wave_delete(self, wave_id):
+        del self.waves[wave_id]
+        self._parsed.clear()
+
+    @_daemon
+    def wave_get_max_cbs(self):
+        return 25016
+
+    @_daemon
+    def wave_get_max_pulses(self):
+        return 12000
+
+    @_daemon
+    def wave_get_cbs(self):
+        return 5
+
+    @_daemon
+    def wave_chain(self, data):
+        self.chains_sent += 1
+        key = tuple(data)
+        runs = self._parsed.get(key)
+        if runs is None:
+            runs = self._parsed[key] = parse_chain(data)
+        self.sim.start_chain(runs)
+
+    @_daemon
+    def wave_tx_busy(self):
+        return int(self.sim.busy())
+
+    @_daemon
+    def wave_tx_stop(self):
+        self.sim.stop_motion()
+
+    @_daemon
+    def wave_tx_at(self):
+        wid = self.sim.wave_at()
+        return pigpio.NO_TX_WAVE if wid is None else wid
+
+    # Scripts, only daemon_script.STOP_SCRIPT is understood
+    @_daemon
+    def store_script(self, script):
+        self.scripts.append(script)
+        return len(self.scripts) - 1
+
+    @_daemon
+    def run_script(self, script_id, params=None):
+        self.sim.run_stop_script(params[0])
+
+    @_daemon
+    def script_status(self, script_id):
+        return self.sim.stop_script_status()
+
+    @_daemon
+    def stop_script(self, script_id):
+        self.sim.script_pin = None
+
+    @_daemon
+    def delete_script(self, script_id):
+        self.scripts[script_id] = None
+
+
+class SimBackend:
+    """Stepper, belt and limit switch simulation behind the backend API.
+
+    The belt loop and switch positions come from Garbage (belt_length and
+    each switch's position_mm), unless belt_length and switch_positions
+    ({position name: mm}) say the switches really sit somewhere else. A switch is pressed while the belt is within
+    [-switch_before, switch_after) mm of it. The motor only ever drives
+    forward (the sprag bearing freewheels the other way).
+
+    The belt follows every step unless it creeps: a fraction
+    creep_per_speed * speed + creep_per_acceleration * acceleration of the
+    steps of each chain level is lost, speed in mm/s and acceleration in
+    mm/s2 of the level. jam() stops it dead.
+    """
+
+    def __init__(self, start_mm=0.0, switch_before=0.0, switch_after=10.0,
+                 stop_latency=0.0, creep_per_speed=0.0, creep_per_acceleration=0.0,
+                 belt_length=None, switch_positions=None):
+        self.clock = SimClock(self)
+        self.pi = SimPi(self)
+        self.buttons = {}  # pin -> SimButton
+        self.callbacks = {}  # pin -> [SimCallback]
+        self.pulls = {}  # pin -> True if pulled up
+        self.pressed = {}  # pin -> switch state
+        self.switch_offsets = {}  # pin -> position along the belt [mm]
+        self.belt_length = belt_length
+        self.switch_positions = switch_positions or {}
+
+        self.switch_before = switch_before
+        self.switch_after = switch_after
+        self.stop_latency = stop_latency  # [s] wave_tx_stop takes this long to take effect
+        self.creep_per_speed = creep_per_speed
+        self.creep_per_acceleration = creep_per_acceleration
+        self.jammed = False
+        self._stopping = False
+
+        # Emulated daemon_script.STOP_SCRIPT, the pin it watches while running
+        self.script_pin = None
+        self.script_result = daemon_script.RUNNING
+        self.script_halt_tick = 0
+        self.daemon_up = True
+        self.daemon_restarts = 0
+
+        self.steps_per_mm = None
+        self.cycle_length = None
+        self.belt_mm = start_mm
+        self._events = []  # heap of (time, order, callback)
+        self._order = 0
+
+        # Playback of the current chain
+        self._start = None
+        self._timeline = None
+        self._wids = None
+        self._end = None
+        self._edges = None  # belt positions where a switch changes [mm]
+        self._next_edge = None  # cached time of the next edge
+
+    def button(self, pin, pull_up):
+        button = SimButton(pin, pull_up)
+        self.buttons[pin] = button
+        self.pulls[pin] = pull_up
+        self.pressed.setdefault(pin, False)
+        return button
+
+    def attach(self, garbage):
+        """Lay the switches out along the belt from the Garbage kinematics"""
+        self.steps_per_mm = garbage.steps_per_mm
+        self.cycle_length = self.belt_length or garbage.belt_length
+        for switch in garbage.limit_switches:
+            self.switch_offsets[switch.pin] = self.switch_positions.get(switch.position_name,
+                                                                        switch.position_mm)
+            self.pressed.setdefault(switch.pin, False)
+        self._edges = np.array([
+            edge
+            for offset in self.switch_offsets.values()
+            for edge in (offset - self.switch_before, offset + self.switch_after)
+        ])
+        self.belt_mm %= self.cycle_length
+        self._update_switches()
+
+    def connect(self):
+        """A new connection to the simulated pigpiod, unconnected while it is down"""
+        pi = SimPi(self)
+        pi.connected = self.daemon_up
+        if pi.connected:
+            self.pi = pi
+        return pi
+
+    def restart_daemon(self, downtime=0.5):
+        """pigpiod dies and is back downtime [s] later. The chain stops, its
+        waves, callbacks and scripts are gone and connections to it are dead.
+        gpiozero buttons don't go through pigpiod and keep working."""
+        self.stop_motion()
+        self.pi.connected = False
+        self.callbacks.clear()
+        self.script_pin = None
+        self.daemon_up = False
+        self.daemon_restarts += 1
+        self.schedule(downtime, lambda: setattr(self, "daemon_up", True))
+
+    # Scripted events
+    def schedule(self, delay, callback):
+        """Run callback after delay [s] of virtual time"""
+        heapq.heappush(self._events, (self.clock.now + delay, self._order, callback))
+        self._order += 1
+
+    def press(self, pin):
+        self.set_switch(pin, True)
+
+    def release(self, pin):
+        self.set_switch(pin, False)
+
+    def push(self, mm):
+        """Push the belt on by mm by hand, ignored while the motor runs"""
+        if self.busy():
+            return
+        self.stop_motion()
+        step = max(EDGE_TOLERANCE, (self.switch_before + self.switch_after) / 2)
+        while mm > 0:
+            self.belt_mm = (self.belt_mm + min(step, mm)) % self.cycle_length
+            mm -= step
+            self._update_switches()
+
+    def level(self, pin):
+        return int(self.pressed.get(pin, False)) ^ int(self.pulls.get(pin, False))
+
+    def set_switch(self, pin, pressed):
+        """Change a switch and run the button and pigpio callbacks of its pin"""
+        if self.pressed.get(pin) == pressed:
+            return
+        self.pressed[pin] = pressed
+        tick = int(self.clock.now * 1e6) & 0xFFFFFFFF
+        if pin == self.script_pin and self.level(pin) and self.busy():
+            # pigpiod's stop script gets there before any callback
+            self.stop_motion()
+            self.script_pin = None
+            self.script_result = daemon_script.ARRIVED
+            self.script_halt_tick = int(self.clock.now * 1e6) & 0xFFFFFFFF
+        button = self.buttons.get(pin)
+        if button is not None:
+            button._set(pressed, tick)
+        level = self.level(pin)
+        for callback in list(self.callbacks.get(pin, [])):
+            if (callback.edge == pigpio.EITHER_EDGE
+                    or (callback.edge == pigpio.RISING_EDGE) == bool(level)):
+                callback.func(pin, level, tick)
+
+    def run_stop_script(self, pin):
+        self.script_pin = pin
+        self.script_result = daemon_script.RUNNING
+
+    def stop_script_status(self):
+        if self.script_pin is not None and not self.busy():
+            self.script_pin = None
+            self.script_result = daemon_script.CHAIN_ENDED
+        status = pigpio.PI_SCRIPT_HALTED if self.script_pin is None else pigpio.PI_SCRIPT_RUNNING
+        return status, [0] * 8 + [self.script_halt_tick, self.script_result]
+
+    # Motion
+    def start_chain(self, runs):
+        self.belt_mm = self.position_at(self.clock.now)
+        # Delays take time but make no steps
+        periods = [self.pi.waves[wid] if wid is not None else 0.0 for wid, _ in runs]
+        counts = [0 if wid is None else n for wid, n in runs]
+        durations = [n / 1e6 if wid is None else self.pi.waves[wid] * n for wid, n in runs]
+        if self.creep_per_speed or self.creep_per_acceleration:
+            periods, counts = self._creep(periods, counts, durations)
+        # Steps of the timeline are the steps the belt follows
+        self._timeline = ChainTimeline(periods, counts, durations)
+        self._wids = [wid for wid, _ in runs]
+        self._start = self.clock.now
+        self._start_mm = self.belt_mm
+        self._end = self._start + self._timeline.total_time
+        self._next_edge = None
+
+    def _creep(self, periods, counts, durations):
+        """Per level step periods and counts of the belt, short of the chain's"""
+        speed = None
+        duration = None
+        for i, period in enumerate(periods):
+            if not counts[i]:
+                continue
+            level_speed = 1 / (period * self.steps_per_mm)
+            acceleration = 0.0
+            if speed is not None:
+                acceleration = abs(level_speed - speed) / (0.5 * (duration + min(durations[i], duration)))
+            speed, duration = level_speed, durations[i]
+            follow = max(0.0, 1 - self.creep_per_speed * speed - self.creep_per_acceleration * acceleration)
+            periods[i] = period / follow if follow else math.inf
+            counts[i] = counts[i] * follow if follow else 0
+        return periods, counts
+
+    def jam(self):
+        """The belt stops dead while the chain keeps running"""
+        self.belt_mm = self.position_at(self.clock.now)
+        self.jammed = True
+        self._next_edge = None
+
+    def wave_at(self):
+        """Wave id being sent now, None if idle or in a delay"""
+        if not self.busy():
+            return None
+        return self._wids[self._timeline.level_at(self.clock.now - self._start)]
+
+    def busy(self):
+        return self._start is not None and self.clock.now < self._end
+
+    def stop_motion(self):
+        """Stop the chain, after stop_latency of the belt still running"""
+        if self._start is None or self._stopping:
+            return
+        if self.stop_latency:
+            self._stopping = True
+            try:
+                self.run_until(self.clock.now + self.stop_latency)
+            finally:
+                self._stopping = False
+        self._end = min(self._end, self.clock.now)
+        self.belt_mm = self.position_at(self.clock.now)
+        self._start = None
+        self._next_edge = None
+
+    def steps_at(self, t):
+        """Steps sent by the current chain up to time t"""
+        if self._start is None:
+            return 0.0
+        return self._timeline.steps_at(min(t, self._end) - self._start)
+
+    def time_at_steps(self, steps):
+        """Times the current chain will have sent each of steps, inf if never"""
+        steps = np.asarray(steps, dtype=float)
+        if self._start is None:
+            return np.full(steps.shape, np.inf)
+        t = self._start + self._timeline.time_at_steps(steps)
+        return np.where(t <= self._end, t, np.inf)
+
+    def position_at(self, t):
+        if self._start is None or self.jammed:
+            return self.belt_mm
+        return (self._start_mm + self.steps_at(t) / self.steps_per_mm) % self.cycle_length
+
+    # Events
+    def _next_switch_edge(self):
+        """Time of the next switch press/release by the belt, or None"""
+        if self._start is None or self._edges is None or self.jammed:
+            return None
+        if self._next_edge is None:
+            travelled = self.steps_at(self.clock.now) / self.steps_per_mm
+            ahead = (self._edges - (self._start_mm + travelled)) % self.cycle_length
+            # The edge the belt sits on has just been handled
+            ahead = np.where((ahead < EDGE_TOLERANCE) | (ahead > self.cycle_length - EDGE_TOLERANCE),
+                             ahead + self.cycle_length, ahead)
+            self._next_edge = float(self.time_at_steps((travelled + ahead) * self.steps_per_mm).min())
+        return self._next_edge if self._next_edge != np.inf else None
+
+    def run_next_event(self, deadline=None):
+        """Advance the clock to the next event and run it.
+        Returns False if nothing happens before deadline.
+        """
+        edge = self._next_switch_edge()
+        scheduled = self._events[0][0] if self._events else None
+        candidates = [t for t in (edge, scheduled) if t is not None]
+        if not candidates:
+            return False
+        t = min(candidates)
+        if deadline is not None and t > deadline:
+            return False
+
+        self.clock.now = max(self.clock.now, t)
+        if scheduled is not None and scheduled <= t:
+            _, _, callback = heapq.heappop(self._events)
+            callback()
+        else:
+            self._next_edge = None
+            self._update_switches()
+        return True
+
+    def run_until(self, t):
+        while self.run_next_event(t):
+            pass
+        self.clock.now = max(self.clock.now, t)
+        self._update_switches()
+
+    def _update_switches(self):
+        if self.cycle_length is None:
+            return
+        belt = self.position_at(self.clock.now)
+        states = {}
+        for pin, offset in self.switch_offsets.items():
+            # Tolerance so the edge that woke us counts as crossed
+            distance = (belt - offset + self.switch_before + EDGE_TOLERANCE) % self.cycle_length
+            states[pin] = distance < self.switch_before + self.switch_after
+        # Releases first, so a departure never hides an arrival
+        now = self.clock.now
+        for pin in sorted(states, key=states.get):
+            self.set_switch(pin, states[pin])
+            if self.clock.now != now:
+                # A callback ran the simulation on, which updated the switches
+                return
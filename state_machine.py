@@ -0,0 +1,289 @@
+from collections import deque
+from concurrent.futures import Future
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Events fed into the state machine by the switch callbacks
+FOOT_PRESSED = "foot_pressed"
+ARRIVED = "arrived"
+DEPARTED = "departed"
+
+# Declarative transition table used while the lid is idle.
+# (position, event) -> (target position, speed name)
+# For DEPARTED the position is the switch that was just left, which is how
+# manual motion of the door is detected.
+TRANSITIONS = {
+    # Foot switch toggles between the two ready positions, closing past the
+    # Closed switch or opening past the Open switch
+    ("ReadyToClose", FOOT_PRESSED): ("ReadyToOpen", "close"),
+    ("ReadyToOpen", FOOT_PRESSED): ("ReadyToClose", "open"),
+    # Resting on Open/Closed is not allowed, move on to a ready position
+    ("Open", ARRIVED): ("ReadyToClose", "crawl"),
+    ("Closed", ARRIVED): ("ReadyToOpen", "crawl"),
+    # Door is moved manually
+    # potential issue here that door can be moved past two switches
+    # not sure this is possible physically, so will not handle yet
+    ("Open", DEPARTED): ("ReadyToClose", "crawl"),
+    ("Closed", DEPARTED): ("ReadyToOpen", "crawl"),
+    ("ReadyToClose", DEPARTED): ("ReadyToOpen", "crawl"),
+    ("ReadyToOpen", DEPARTED): ("ReadyToClose", "crawl"),
+}
+
+
+class MoveCommand(Future):
+    """Handle of a requested or queued move.
+
+    Resolves to True if the lid arrived at the target, False if the move
+    ended anywhere else. cancel() drops it from the queue, or stops the
+    motor if it is already moving. Wait on it with result(timeout), or
+    await it from asyncio.
+    """
+
+    def __init__(self, event=None, target=None, speed=None, time=None):
+        super().__init__()
+        self.event = event  # event that asked for the move, its target is looked up when it runs
+        self.target = target
+        self.speed = speed
+        self.time = time  # clock time of the request
+
+    def __await__(self):
+        import asyncio
+
+        return asyncio.wrap_future(self).__await__()
+
+
+class LidStateMachine:
+    """Tracks lid position and wakes the control loop on events only.
+
+    Switch callbacks call dispatch(), the control loop blocks in
+    wait_for_target() / wait_for_arrival() on a condition variable instead
+    of polling.
+
+    Foot presses and request()s that come in while a move is running are
+    queued, and the next one starts as soon as the move ends. A press
+    within coalesce_window of the previous one is a bounce and is dropped,
+    and a second queued foot press cancels the first (the toggles cancel).
+    """
+
+    def __init__(self, position_names, transitions=None, clock=None,
+                 queue_length=4, coalesce_window=0.3):
+        self.position_names = position_names
+        self.transitions = TRANSITIONS if transitions is None else transitions
+        self.condition = threading.Condition()
+        # Anything with time() and wait_for(condition, predicate, timeout),
+        # the simulator swaps in a virtual clock
+        self.clock = clock
+
+        self.position = None
+        self.last_position = None
+        self.target_position = None
+        self.target_speed = None
+        self.moving = False
+        # clock time of the event that produced the current target
+        self.event_time = None
+        self.stopped = False
+        self.arrivals = 0  # ARRIVED events so far, at any switch
+
+        self.command = None  # MoveCommand of the current target
+        self.queue = deque()  # MoveCommands waiting for the current move
+        self.queue_length = queue_length
+        self.coalesce_window = coalesce_window  # [s]
+
+    def dispatch(self, event, position=None):
+        """Feed an event into the state machine.
+        event:  One of FOOT_PRESSED, ARRIVED, DEPARTED
+        position:  position name of the switch for ARRIVED/DEPARTED
+        """
+        event_time = self._time()
+        with self.condition:
+            if event == ARRIVED:
+                self.position = position
+                self.arrivals += 1
+            elif event == DEPARTED:
+                self.last_position = position
+                self.position = None
+
+            if self.moving:
+                # Wake the mover, it decides if this is the switch it wants
+                if event == ARRIVED:
+                    self.condition.notify_all()
+                elif event == FOOT_PRESSED:
+                    self._enqueue(MoveCommand(event, time=event_time))
+                return
+
+            if self.target_position is None:
+                key = (self.position if event != DEPARTED else position, event)
+                self._apply(key, event_time)
+            elif event == FOOT_PRESSED:
+                self._enqueue(MoveCommand(event, time=event_time))
+
+    def request(self, target, speed=None):
+        """Ask for a move to target, queued behind any running move.
+        Returns its MoveCommand without waiting.
+        """
+        if target not in self.position_names:
+            raise ValueError(f"target position of {target} is invalid")
+        command = MoveCommand(target=target, speed=speed, time=self._time())
+        with self.condition:
+            if self.moving or self.target_position is not None:
+                return self._enqueue(command)
+            self._set_target(target, speed, command.time, command)
+        return command
+
+    def _apply(self, key, event_time, command=None):
+        """Set the target from the transition table. Returns False if there is no rule"""
+        rule = self.transitions.get(key)
+        if rule is None:
+            logger.debug("No transition for %s", key)
+            return False
+        target, speed = rule
+        logger.debug("Transition %s -> %s at %s speed", key, target, speed)
+        if command is None:
+            command = MoveCommand(key[1], time=event_time)
+        self._set_target(target, speed, event_time, command)
+        return True
+
+    def _set_target(self, target, speed, event_time, command):
+        if target not in self.position_names:
+            raise ValueError(f"target position of {target} is invalid")
+        command.target = target
+        command.speed = speed
+        command.add_done_callback(self._wake)  # so cancel() stops the move
+        self.target_position = target
+        self.target_speed = speed
+        self.event_time = event_time
+        self.command = command
+        self.condition.notify_all()
+
+    def _enqueue(self, command):
+        """Queue a command, coalescing it with the last one where it makes sense.
+        Returns the command it ended up as.
+        """
+        while self.queue and self.queue[-1].cancelled():
+            self.queue.pop()
+        last = self.queue[-1] if self.queue else self.command
+        if last is not None and command.event == last.event:
+            if command.event == FOOT_PRESSED:
+                if command.time - last.time < self.coalesce_window:
+                    logger.debug("Foot press coalesced with the previous one")
+                    return last
+                if self.queue:
+                    logger.info("Foot pressed again, cancelling the queued foot press")
+                    self.queue.pop().cancel()
+                    command.cancel()
+                    return command
+            elif command.event is None and command.target == last.target:
+                return last
+        if len(self.queue) >= self.queue_length:
+            logger.warning(f"Move queue is full, dropping move to {command.target or command.event}")
+            command.cancel()
+            return command
+        self.queue.append(command)
+        logger.debug("Queued %s, %d waiting", command.target or command.event, len(self.queue))
+        return command
+
+    def _next_command(self):
+        """Start the oldest queued command that has somewhere to go"""
+        while self.queue:
+            command = self.queue.popleft()
+            if command.cancelled():
+                continue
+            # Queued time is not press to motion latency, so time from now
+            if command.event is None:
+                self._set_target(command.target, command.speed, self._time(), command)
+                return
+            if self._apply((self.position, command.event), self._time(), command):
+                return
+            command.set_result(False)
+
+    def _wake(self, command):
+        with self.condition:
+            self.condition.notify_all()
+
+    @property
+    def cancelled(self):
+        """True if the command of the current move was cancelled"""
+        return self.command is not None and self.command.cancelled()
+
+    def wait_for_target(self, timeout=None):
+        """Block until there is a target and no move is running.
+        Returns (target_position, target_speed) or None on timeout/stop.
+        """
+        with self.condition:
+            ready = self._wait_for(
+                lambda: self.stopped or (self.target_position is not None and not self.moving),
+                timeout,
+            )
+            if not ready or self.stopped:
+                return None
+            return self.target_position, self.target_speed
+
+    def begin_move(self, target_position=None):
+        with self.condition:
+            if target_position is not None:
+                self.target_position = target_position
+            self.moving = True
+
+    def wait_for_arrival(self, timeout=None, arrivals=None):
+        """Block until the target position is reached. Returns True on arrival.
+        arrivals:  also wake (returning False) once the arrivals count moves on
+        from this, that is on reaching any switch
+        """
+        with self.condition:
+            return self._wait_for(
+                lambda: (self.stopped or self.cancelled or self.position == self.target_position
+                         or (arrivals is not None and self.arrivals != arrivals)),
+                timeout,
+            ) and self.position == self.target_position and not self.stopped and not self.cancelled
+
+    def wait_for_arrivals(self, count, timeout=None):
+        """Block until count ARRIVED events in all. Returns True if they came."""
+        with self.condition:
+            return self._wait_for(
+                lambda: self.stopped or self.arrivals >= count, timeout
+            ) and not self.stopped
+
+    def wait_for_position(self, timeout=None):
+        """Block until any switch is reached. Returns True if position is known."""
+        with self.condition:
+            return self._wait_for(
+                lambda: self.stopped or self.position is not None, timeout
+            ) and not self.stopped
+
+    def end_move(self):
+        """Resolve the move's command, then re-evaluate the table for where we
+        ended up, or start the next queued command. A move that ended between
+        switches still starts it: explicit targets are planned from the
+        position estimate or crawl there, foot presses with no rule fail."""
+        with self.condition:
+            command = self.command
+            arrived = self.position is not None and self.position == self.target_position
+            self.moving = False
+            self.target_position = None
+            self.target_speed = None
+            self.command = None
+            if command is not None and not command.done():
+                command.set_result(arrived)
+            if self.position is None or not self._apply((self.position, ARRIVED), self._time()):
+                self._next_command()
+            self.condition.notify_all()
+
+    def _time(self):
+        return time.perf_counter() if self.clock is None else self.clock.time()
+
+    def _wait_for(self, predicate, timeout):
+        if self.clock is None:
+            return self.condition.wait_for(predicate, timeout)
+        return self.clock.wait_for(self.condition, predicate, timeout)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            while self.queue:
+                self.queue.popleft().cancel()
+            if self.command is not None:
+                self.command.cancel()
+            self.condition.notify_all()
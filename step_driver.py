@@ -0,0 +1,194 @@
+"""Ways of making step pulses, behind one interface.
+
+- WaveChainDriver:  pigpiod wave chains, exact step counts at DMA timing,
+  costs wave memory per step rate (garbage.py)
+- HardwarePWMDriver:  the PWM peripheral, any rate on a few pins and no
+  wave memory, but levels are switched by the host so step counts are not
+  exact (stepper_test2.py)
+- BitBangDriver:  the host writes every edge and sleeps in between, any pin
+  and exact counts but slow and jittery (stepper_test1.py)
+
+A ramp is a list of [Frequency, Steps] levels as planned by MotionPlanner.
+select_driver() picks a driver by what a ramp needs.
+"""
+from abc import ABC, abstractmethod
+import logging
+
+import pigpio
+
+from chain_compiler import compile_chain, MAX_CHAIN_LENGTH
+from wave_registry import WaveRegistry
+
+logger = logging.getLogger(__name__)
+
+
+class StepDriver(ABC):
+    """Sends ramps of step pulses on one pin.
+
+    Subclasses say what they can do in max_rate (highest step rate [Hz]),
+    pins (step pins they can drive, None for any) and exact_counts (every
+    step asked for is sent, no more and no less).
+    """
+
+    name = None
+    max_rate = None
+    pins = None
+    exact_counts = False
+
+    def __init__(self, pi, pin, clock):
+        self.pi = pi
+        self.pin = pin
+        self.clock = clock  # times the levels of host timed drivers
+
+    @classmethod
+    def supports(cls, pin, rate, exact_counts=False):
+        """True if the driver can step pin at rate [Hz]"""
+        return (rate <= cls.max_rate and (cls.pins is None or pin in cls.pins)
+                and (cls.exact_counts or not exact_counts))
+
+    @abstractmethod
+    def run(self, ramp, loop_forever=False):
+        """Send ramp, then keep stepping at its last rate until stop() if loop_forever"""
+
+    @abstractmethod
+    def busy(self):
+        """True while steps are being sent"""
+
+    @abstractmethod
+    def stop(self):
+        """Stop stepping now"""
+
+
+class WaveChainDriver(StepDriver):
+    """Ramps as pigpiod wave chains, timed by DMA.
+    Half step periods are whole microseconds, so rates are rounded to the
+    nearest 500000 / n Hz. The planner already puts its levels on that grid.
+    """
+
+    name = "wave chain"
+    max_rate = 500000 / 2  # 2 us half period, shorter starves pigpiod's DMA
+    exact_counts = True
+
+    def __init__(self, pi, pin, clock, wave_registry=None):
+        super().__init__(pi, pin, clock)
+        self.wave_registry = WaveRegistry(pi) if wave_registry is None else wave_registry
+
+    def compile(self, ramp, loop_forever=False):
+        """Chain of ramp, with its waves created"""
+        length = len(ramp)  # number of ramp levels
+        logger.debug(f'Generating ramp of {length} levels up to {max(f for f, _ in ramp):.0f} Hz')
+
+        # Get a wave per ramp level, levels of the same frequency share one
+        micros = [round(500000 / ramp[i][0]) for i in range(length)]
+        wid = self.wave_registry.acquire(self.pin, micros)
+
+        # Generate a chain of waves, any step count fits with nested loops
+        chain = compile_chain([[wid[i], ramp[i][1]] for i in range(length)], loop_forever)
+        chain.step_periods = [2 * m / 1e6 for m in micros]  # as sent, not as asked for
+        logger.debug(f'Ramp of {length} levels uses {len(chain)} of {MAX_CHAIN_LENGTH} chain bytes')
+        return chain
+
+    def run(self, ramp, loop_forever=False):
+        self.pi.wave_chain(self.compile(ramp, loop_forever))
+
+    def busy(self):
+        return bool(self.pi.wave_tx_busy())
+
+    def stop(self):
+        self.pi.wave_tx_stop()
+
+
+class HardwarePWMDriver(StepDriver):
+    """Steps from the PWM peripheral at a 50% duty cycle.
+    The rate comes from a divided 250 MHz clock so it is all but exact,
+    but each level change is a call from the host, so the steps of a level
+    are off by the rate times the call's latency. Best for long runs at
+    one rate, like crawling, which then take no wave memory at all.
+    """
+
+    name = "hardware PWM"
+    max_rate = 125000000  # pigpio's limit, far beyond any stepper driver
+    pins = (12, 13, 18, 19)  # the header pins wired to PWM0/PWM1
+    exact_counts = False
+
+    def __init__(self, pi, pin, clock):
+        super().__init__(pi, pin, clock)
+        self.running = False
+
+    def run(self, ramp, loop_forever=False):
+        """Blocks while the host times the levels, returns with the last one
+        still running if loop_forever"""
+        self.running = True
+        last = len(ramp) - 1
+        for i, (frequency, steps) in enumerate(ramp):
+            self.pi.hardware_PWM(self.pin, int(round(frequency)), 500000)
+            if i == last and loop_forever:
+                return
+            self.clock.sleep(steps / self.pi.get_PWM_frequency(self.pin))
+            if not self.running:
+                return  # stop() turned the PWM off meanwhile
+        self.stop()
+
+    def busy(self):
+        return self.running
+
+    def stop(self):
+        self.running = False
+        self.pi.hardware_PWM(self.pin, 0, 0)
+
+
+class BitBangDriver(StepDriver):
+    """Writes every step edge from the host and sleeps in between.
+    Each edge costs a pigpiod round trip and sleeps overshoot, so the rate
+    falls short of the one asked for, more the faster it is asked to go.
+    """
+
+    name = "bit-bang"
+    max_rate = 1000  # two round trips and two oversleeps a step, it never gets much past 3 kHz
+    exact_counts = True
+
+    def __init__(self, pi, pin, clock):
+        super().__init__(pi, pin, clock)
+        self.running = False
+        self.stopped = False
+
+    def run(self, ramp, loop_forever=False):
+        """Blocks until the ramp is sent, or until stop() if loop_forever"""
+        self.pi.set_mode(self.pin, pigpio.OUTPUT)
+        self.stopped = False
+        self.running = True
+        try:
+            last = len(ramp) - 1
+            for i, (frequency, steps) in enumerate(ramp):
+                half = 0.5 / frequency
+                n = 0
+                while not self.stopped and (n < steps or (i == last and loop_forever)):
+                    self.pi.write(self.pin, 1)
+                    self.clock.sleep(half)
+                    self.pi.write(self.pin, 0)
+                    self.clock.sleep(half)
+                    n += 1
+        finally:
+            self.running = False
+
+    def busy(self):
+        return self.running
+
+    def stop(self):
+        self.stopped = True
+
+
+# In order of preference: no wave memory, then DMA timing, then anything
+DRIVERS = (HardwarePWMDriver, WaveChainDriver, BitBangDriver)
+
+
+def select_driver(pin, rate, exact_counts=False, drivers=DRIVERS):
+    """First driver class able to step pin at rate [Hz].
+    Runs that can stop anywhere, like crawling onto a switch, need no exact
+    counts and go to hardware PWM on a PWM pin.
+    """
+    for driver in drivers:
+        if driver.supports(pin, rate, exact_counts):
+            return driver
+    raise ValueError(f"No step driver can {'exactly ' if exact_counts else ''}"
+                     f"step GPIO {pin} at {rate:.0f} Hz")
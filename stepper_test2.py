@@ -4,33 +4,25 @@ import pigpio
 import asyncio
 import sys
 
+from chain_compiler import compile_chain
+from wave_registry import WaveRegistry
+
 def generate_ramp(ramp):
     """Generate ramp wave forms.
     ramp:  List of [Frequency, Steps]
     """
-    pi.wave_clear()     # clear existing waves
+    global ramp_wids
+    # Waves of the previous ramp stay resident and are reused if they match
+    registry.release(ramp_wids)
     length = len(ramp)  # number of ramp levels
-    wid = [-1] * length
-
-    # Generate a wave per ramp level
-    for i in range(length):
-        frequency = ramp[i][0]
-        micros = int(500000 / frequency)
-        wf = []
-        wf.append(pigpio.pulse(1 << STEP, 0, micros))  # pulse on
-        wf.append(pigpio.pulse(0, 1 << STEP, micros))  # pulse off
-        pi.wave_add_generic(wf)
-        wid[i] = pi.wave_create()
 
-    # Generate a chain of waves
-    chain = []
-    for i in range(length):
-        steps = ramp[i][1]
-        x = steps & 255
-        y = steps >> 8
-        chain += [255, 0, wid[i], 255, 1, x, y]
+    # Get a wave per ramp level
+    micros = [int(500000 / ramp[i][0]) for i in range(length)]
+    wid = registry.acquire(STEP, micros)
+    ramp_wids = wid
 
-    return chain
+    # Generate a chain of waves
+    return compile_chain([[wid[i], ramp[i][1]] for i in range(length)])
 
 def switch_callback(gpio, level, tick):
     print(gpio, level, tick)
@@ -41,6 +33,9 @@ STEP = 18    # Step GPIO Pin
 
 # Connect to pigpiod daemon
 pi = pigpio.pi()
+registry = WaveRegistry(pi)
+registry.clear()     # clear existing waves
+ramp_wids = []
 
 # Set up pins as an output
 pi.set_mode(DIR, pigpio.OUTPUT)
@@ -0,0 +1,142 @@
+from bisect import bisect_left
+import logging
+import os
+import socketserver
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def log_buckets(start, factor, count):
+    """Bucket upper bounds growing by factor from start"""
+    return [start * factor**i for i in range(count)]
+
+
+class Histogram:
+    """Fixed buckets in the Prometheus style, memory never grows with samples"""
+
+    def __init__(self, name, help, bounds):
+        self.name = name
+        self.help = help
+        self.bounds = sorted(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)  # the last is above every bound
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        total = 0
+        for bound, n in zip(self.bounds, self.counts):
+            total += n
+            yield f'{self.name}_bucket{{le="{bound:.6g}"}} {total}'
+        yield f'{self.name}_bucket{{le="+Inf"}} {self.count}'
+        yield f"{self.name}_sum {self.sum:.9g}"
+        yield f"{self.name}_count {self.count}"
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def lines(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        yield f"{self.name} {self.value}"
+
+
+class Telemetry:
+    """Per-move metrics, rendered in the Prometheus text format.
+
+    Samples are only recorded from the control loop thread once a move has
+    ended, never from the switch callbacks, so recording costs nothing
+    while the motor runs. Export either by writing a text file for
+    node_exporter's textfile collector, or by serving the text on a Unix
+    socket to anyone who connects.
+    """
+
+    def __init__(self, prefix="garbage"):
+        self.histograms = {}
+        self.counters = {}
+        for name, help, bounds in [
+            ("foot_to_motion_seconds", "Foot switch press to wave chain start",
+             log_buckets(50e-6, 2, 14)),
+            ("move_seconds", "Wave chain start to arrival at the target switch",
+             log_buckets(0.25, 1.25, 16)),
+            ("stop_latency_seconds", "Target switch edge to wave chain stop",
+             log_buckets(50e-6, 2, 14)),
+            ("overshoot_millimeters", "Belt travel past the target switch edge",
+             log_buckets(0.01, 2, 12)),
+            ("recovery_seconds", "pigpiod connection lost to ready to move again",
+             log_buckets(0.01, 2, 14)),
+            ("belt_lag_millimeters", "Belt travel short of the plan at a switch arrival",
+             log_buckets(0.01, 2, 16)),
+        ]:
+            self.histograms[name] = Histogram(f"{prefix}_{name}", help, bounds)
+        for name, help in [
+            ("moves_total", "Moves started"),
+            ("arrivals_total", "Moves that reached their target switch"),
+            ("retries_total", "Moves to a target the previous move failed to reach"),
+            ("timeouts_total", "Moves and homings that timed out"),
+            ("errors_total", "Moves that stopped on a SystemError"),
+            ("pre_open_moves_total", "Lid opened on the PIR before the foot switch"),
+            ("pre_open_hits_total", "Pre-opens followed by a foot press"),
+            ("pre_open_wasted_total", "Pre-opens closed again without a foot press"),
+            ("pre_open_cancelled_total", "PIR triggers dropped as the lid stayed busy"),
+            ("reconnects_total", "pigpiod restarts recovered from"),
+            ("slips_total", "Switch arrivals further off the plan than the slip tolerance"),
+            ("stalls_total", "Moves stopped as the next switch was overdue"),
+        ]:
+            self.counters[name] = Counter(f"{prefix}_{name}", help)
+        self.server = None
+
+    def observe(self, name, value):
+        self.histograms[name].observe(value)
+
+    def count(self, name, n=1):
+        self.counters[name].value += n
+
+    def render(self):
+        lines = []
+        for metric in list(self.counters.values()) + list(self.histograms.values()):
+            lines.extend(metric.lines())
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Write the metrics to path, atomically so a scrape never sees half"""
+        temp = f"{path}.tmp"
+        try:
+            with open(temp, "w") as f:
+                f.write(self.render())
+            os.replace(temp, path)
+        except OSError as e:
+            logger.warning(f"Could not write metrics to {path}: {e}")
+
+    def serve(self, path):
+        """Dump the metrics to every connection on Unix socket path, in a thread"""
+        telemetry = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                self.wfile.write(telemetry.render().encode())
+
+        if os.path.exists(path):
+            os.remove(path)
+        self.server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logger.info(f"Serving metrics on {path}")
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            os.remove(self.server.server_address)
+            self.server = None
@@ -0,0 +1,100 @@
+"""Checks of Garbage on the simulated hardware.
+
+    python -m pytest test_sim.py
+"""
+import logging
+
+import pytest
+
+from garbage import Garbage, DEFAULT_GEOMETRY
+from sim_backend import SimBackend
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+def make(start_mm, geometry=DEFAULT_GEOMETRY, **kwargs):
+    # The simulated switches sit where the defaults say unless moved
+    backend = SimBackend(start_mm=start_mm, **kwargs)
+    garbage = Garbage(backend=backend, profile_cache=None, journal_path=None, geometry=geometry)
+    splices = []
+    splice_chain = garbage.splice_chain
+    garbage.splice_chain = lambda *args: (splices.append(backend.clock.now), splice_chain(*args))
+    return backend, garbage, splices
+
+
+def test_no_splice_once_the_estimate_passes_the_target():
+    # Crawling from Closed onto ReadyToOpen, 50 mm on, the belt jams and the
+    # estimate runs on past the target switch
+    backend, garbage, splices = make(385)
+    garbage.home()
+    assert garbage.position == "Closed"
+    garbage.move("ReadyToOpen", "crawl")
+    start = backend.clock.now
+    backend.schedule(0.5, backend.jam)
+    with pytest.raises(TimeoutError, match="switch at 440 mm"):
+        garbage.run_once(timeout=0)
+    assert splices == []
+    assert backend.clock.now - start < 1.5
+
+
+def test_splice_onto_a_crawl_from_an_unknown_position():
+    # 20 mm past ReadyToClose, the crawl round to it speeds up once the
+    # Closed switch has pinned the position down
+    backend, garbage, splices = make(70)
+    garbage.move("ReadyToClose", "crawl")
+    start = backend.clock.now
+    while garbage.position != "ReadyToClose" and garbage.run_once(timeout=0):
+        pass
+    assert len(splices) == 1
+    assert backend.clock.now - start < 10
+    assert garbage.belt.slips == 0
+
+
+def test_calibrate_measures_the_switch_layout():
+    layout = {"Open": 0.0, "ReadyToClose": 62.0, "Closed": 371.5, "ReadyToOpen": 430.0}
+    backend = SimBackend(start_mm=200, belt_length=765.0, switch_positions=layout)
+    garbage = Garbage(backend=backend, profile_cache=None, journal_path=None)
+    assert not garbage.geometry_measured
+    geometry = garbage.calibrate()
+    assert geometry["belt_length"] == pytest.approx(765.0, abs=0.5)
+    for name, position_mm in layout.items():
+        assert geometry[name] == pytest.approx(position_mm, abs=0.5)
+
+    backend = SimBackend(start_mm=200, belt_length=765.0, switch_positions=layout)
+    garbage = Garbage(backend=backend, profile_cache=None, journal_path=None, geometry=geometry)
+    assert garbage.geometry_measured
+    garbage.home()
+    foot = garbage.switch_foot.pin
+    for _ in range(4):
+        backend.press(foot)
+        backend.release(foot)
+        garbage.run_once(timeout=0)
+    assert garbage.position in ("ReadyToOpen", "ReadyToClose")
+    assert garbage.belt.slips == 0 and garbage.belt.stalls == 0
+
+
+def test_misplaced_switch_is_counted_not_raised():
+    # ReadyToClose 70 mm further on than the placeholder layout says
+    backend, garbage, _ = make(435, geometry=None, switch_positions={"ReadyToClose": 120.0})
+    assert not garbage.stop_on_stall
+    garbage.home()
+    foot = garbage.switch_foot.pin
+    for position in ("ReadyToClose", "ReadyToOpen", "ReadyToClose"):
+        backend.press(foot)
+        backend.release(foot)
+        garbage.run_once(timeout=0)
+        assert garbage.position == position
+    assert garbage.belt.stalls == 2
+
+
+def test_push_by_hand_is_planned_from_the_estimate():
+    backend, garbage, _ = make(20)
+    garbage.home()
+    assert garbage.position == "ReadyToClose"
+    backend.push(120)
+    assert garbage.position is None and garbage.estimator.lower_bound
+    backend.press(garbage.switch_foot.pin)
+    backend.release(garbage.switch_foot.pin)
+    garbage.run_once(timeout=0)
+    assert garbage.position == "ReadyToOpen"
+    assert len(garbage.estimate_plans) == 1
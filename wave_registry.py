@@ -0,0 +1,174 @@
+from collections import OrderedDict
+import logging
+
+import pigpio
+
+logger = logging.getLogger(__name__)
+
+# Defaults of pigpiod, used when the daemon can't be asked
+DEFAULT_MAX_CBS = 25016
+DEFAULT_MAX_PULSES = 12000
+# pigpiod's PI_MAX_WAVES, wave ids run out here whatever the DMA budget
+DEFAULT_MAX_WAVES = 250
+# A two pulse step wave takes about this many DMA control blocks
+DEFAULT_CBS_PER_WAVE = 5
+
+
+def step_pulses(pin, micros):
+    """Pulses of one step on pin, high then low for micros each"""
+    return [pigpio.pulse(1 << pin, 0, micros),  # pulse on
+            pigpio.pulse(0, 1 << pin, micros)]  # pulse off
+
+
+class Wave:
+    def __init__(self, wid, cbs, pulses):
+        self.wid = wid
+        self.cbs = cbs
+        self.pulses = pulses
+        self.refs = 0
+
+
+class WaveRegistry:
+    """Cache of single step waves keyed by (step pin, pulse period).
+
+    Ramps share waves of the same period instead of creating new ones,
+    and the pigpio DMA control block, pulse and wave id budget is tracked so waves
+    no longer used by any profile are deleted (least recently used first)
+    when a new profile doesn't fit.
+
+    All step waves have the same shape, so pigpiod reuses the resources of
+    a deleted wave for the next one created (see wave_delete docs).
+    """
+
+    def __init__(self, pi, max_cbs=None, max_pulses=None, max_waves=DEFAULT_MAX_WAVES):
+        self.pi = pi
+        if max_cbs is None:
+            max_cbs = self._ask(pi, "wave_get_max_cbs", DEFAULT_MAX_CBS)
+        if max_pulses is None:
+            max_pulses = self._ask(pi, "wave_get_max_pulses", DEFAULT_MAX_PULSES)
+        self.max_cbs = max_cbs
+        self.max_pulses = max_pulses
+        self.max_waves = max_waves
+
+        self.waves = OrderedDict()  # (pin, micros) -> Wave, oldest use first
+        self.used_cbs = 0
+        self.used_pulses = 0
+        self.cbs_per_wave = DEFAULT_CBS_PER_WAVE
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _ask(pi, name, default):
+        try:
+            return getattr(pi, name)()
+        except (AttributeError, pigpio.error):
+            return default
+
+    def clear(self):
+        """Delete every wave from pigpiod and forget them"""
+        self.pi.wave_clear()
+        self.waves.clear()
+        self.used_cbs = 0
+        self.used_pulses = 0
+
+    def acquire(self, pin, periods):
+        """Return wave ids for a profile, creating missing waves.
+        pin:  step GPIO pin
+        periods:  list of half step periods [us]
+        The waves are held until release() is called with the same ids.
+        """
+        keys = [(pin, int(micros)) for micros in periods]
+        missing = {key for key in keys if key not in self.waves}
+        self._make_room(len(missing), len(missing) * self.cbs_per_wave, len(missing) * 2, set(keys))
+
+        wids = []
+        for key in keys:
+            wave = self.waves.get(key)
+            if wave is None:
+                wave = self._create(*key)
+                self.misses += 1
+            else:
+                self.waves.move_to_end(key)
+                self.hits += 1
+            wave.refs += 1
+            wids.append(wave.wid)
+        return wids
+
+    def release(self, wids):
+        """Mark the waves of a profile as no longer needed (but keep them)"""
+        wids = list(wids)
+        for wave in self.waves.values():
+            while wave.wid in wids and wave.refs > 0:
+                wave.refs -= 1
+                wids.remove(wave.wid)
+
+    def _create(self, pin, micros):
+        wf = step_pulses(pin, micros)
+        self.pi.wave_add_generic(wf)
+        wid = self.pi.wave_create()
+
+        cbs = self._ask(self.pi, "wave_get_cbs", self.cbs_per_wave)
+        self.cbs_per_wave = max(self.cbs_per_wave, cbs)
+        wave = Wave(wid, cbs, len(wf))
+        self.waves[(pin, micros)] = wave
+        self.used_cbs += cbs
+        self.used_pulses += wave.pulses
+        return wave
+
+    def _make_room(self, waves, cbs, pulses, keep):
+        def fits():
+            return (len(self.waves) + waves <= self.max_waves
+                    and self.used_cbs + cbs <= self.max_cbs
+                    and self.used_pulses + pulses <= self.max_pulses)
+
+        if fits():
+            return
+        free = [wave for key, wave in self.waves.items() if not wave.refs and key not in keep]
+        if (len(self.waves) - len(free) + waves > self.max_waves
+                or self.used_cbs - sum(w.cbs for w in free) + cbs > self.max_cbs
+                or self.used_pulses - sum(w.pulses for w in free) + pulses > self.max_pulses):
+            raise MemoryError(
+                f"Profile needs {waves} waves, {cbs} control blocks and {pulses} pulses but only "
+                f"{self.max_waves - len(self.waves)}, {self.max_cbs - self.used_cbs} and "
+                f"{self.max_pulses - self.used_pulses} are free and unused waves can't make up "
+                f"the difference"
+            )
+
+        for key in list(self.waves):
+            if fits():
+                return
+            wave = self.waves[key]
+            if wave.refs or key in keep:
+                continue
+            self.pi.wave_delete(wave.wid)
+            del self.waves[key]
+            self.used_cbs -= wave.cbs
+            self.used_pulses -= wave.pulses
+            self.evictions += 1
+            logger.debug(f"Evicted wave {wave.wid} of {key[1]} us on pin {key[0]}")
+
+    def recreate(self, pi):
+        """Create every wave again on pi, after pigpiod lost them in a
+        restart, keeping who holds them. Returns {old wave id: new wave id}"""
+        self.pi = pi
+        self.pi.wave_clear()
+        waves = self.waves
+        self.waves = OrderedDict()
+        self.used_cbs = 0
+        self.used_pulses = 0
+        wids = {}
+        for key, wave in waves.items():
+            new = self._create(*key)
+            new.refs = wave.refs
+            wids[wave.wid] = new.wid
+        logger.debug(f"Created {len(wids)} waves again")
+        return wids
+
+    def pulses(self):
+        """Pulse list of every wave by wave id"""
+        return {wave.wid: step_pulses(pin, micros) for (pin, micros), wave in self.waves.items()}
+
+    def __len__(self):
+        return len(self.waves)